@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import sep
+from .peakdetect import peakdet
+
+
+class ApertureOps:
+
+    def __init__(self, max_aper=30, seeing_bin=0.5, delta=0.1):
+
+        """
+        Curve of growth aperture optimizer. Optimum apertures are kept
+        per (target, night, seeing bin) for the life of the instance,
+        so a target is optimized again only when the FWHM of its frames
+        drifts to another bin.
+        @param max_aper: Number of the tested aperture radii (0..max_aper-1).
+        @type max_aper: int
+        @param seeing_bin: Width of the FWHM bins (in pixels).
+        @type seeing_bin: float
+        @param delta: SNR drop that marks a maximum of the curve of growth.
+        @type delta: float
+        """
+
+        self.max_aper = max_aper
+        self.seeing_bin = seeing_bin
+        self.delta = delta
+        self.cache = {}
+
+    def growth_curves(self, data_sub, x, y, err=None, gain=0.57):
+
+        """
+        SNR curves of growth of many sources measured with one sep call.
+        @param data_sub: Background subtracted image data.
+        @type data_sub: numpy array
+        @param x: X coordinates of sources.
+        @type x: array
+        @param y: Y coordinates of sources.
+        @type y: array
+        @param err: Global background RMS.
+        @type err: float
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @return: tuple (apertures, SNR array [source, aperture])
+        """
+
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        apers = np.arange(self.max_aper, dtype=float)
+
+        flux, fluxerr, flag = sep.sum_circle(data_sub,
+                                             np.repeat(x, self.max_aper),
+                                             np.repeat(y, self.max_aper),
+                                             np.tile(apers, len(x)),
+                                             err=err,
+                                             gain=gain)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snr = flux / fluxerr
+
+        return(apers, snr.reshape(len(x), self.max_aper))
+
+    def frames_growth_curves(self, frames, gain=0.57):
+
+        """
+        Curves of growth of the sources of many frames, measured with
+        one sep call. The frames are stacked into one image, separated
+        by empty rows wider than the largest aperture; empty pixels have
+        no error, so they change neither fluxes nor flux errors.
+        @param frames: Frames, dicts with data_sub, x, y and rms keys
+        (as PhotOps.load_frame returns).
+        @type frames: list
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @return: tuple (apertures, SNR array [source, aperture])
+        """
+
+        apers = np.arange(self.max_aper, dtype=float)
+
+        if len(frames) == 0:
+            return(apers, np.empty((0, self.max_aper)))
+
+        gap = self.max_aper + 1
+        height = sum(np.shape(frame['data_sub'])[0] + gap
+                     for frame in frames)
+        width = max(np.shape(frame['data_sub'])[1] for frame in frames)
+
+        stack = np.zeros((height, width), dtype=float)
+        err = np.zeros((height, width), dtype=float)
+        xs = []
+        ys = []
+
+        row = 0
+        for frame in frames:
+            ny, nx = np.shape(frame['data_sub'])
+            stack[row:row + ny, :nx] = frame['data_sub']
+            err[row:row + ny, :nx] = frame['rms']
+            xs.append(np.atleast_1d(np.asarray(frame['x'], dtype=float)))
+            ys.append(np.atleast_1d(np.asarray(frame['y'],
+                                               dtype=float)) + row)
+            row += ny + gap
+
+        return(self.growth_curves(stack,
+                                  np.concatenate(xs),
+                                  np.concatenate(ys),
+                                  err=err,
+                                  gain=gain))
+
+    def best_apertures(self, apers, snr):
+
+        """
+        Optimum apertures of curves of growth: the first SNR maximum
+        of every curve.
+        @param apers: Tested apertures.
+        @type apers: array
+        @param snr: SNR array [source, aperture].
+        @type snr: numpy array
+        @return: numpy array (NaN for curves without a maximum)
+        """
+
+        snr = np.atleast_2d(snr)
+
+        if len(snr) == 0:
+            return(np.empty(0))
+
+        maxtabs, mintabs = peakdet(snr, self.delta, apers)
+
+        return(np.array([maxtab[0, 0] if len(maxtab) > 0 else np.nan
+                         for maxtab in maxtabs]))
+
+    def fwhm(self, data_sub, x, y, max_radius=None):
+
+        """
+        Median FWHM of sources from their half flux radii.
+        @param data_sub: Background subtracted image data.
+        @type data_sub: numpy array
+        @param x: X coordinates of sources.
+        @type x: array
+        @param y: Y coordinates of sources.
+        @type y: array
+        @param max_radius: Radius of the flux integration. If None,
+        the largest tested aperture.
+        @type max_radius: float
+        @return: float (NaN if it could not be measured)
+        """
+
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+
+        if len(x) == 0:
+            return(np.nan)
+
+        if max_radius is None:
+            max_radius = self.max_aper - 1
+
+        half_radius, flag = sep.flux_radius(data_sub,
+                                            x,
+                                            y,
+                                            np.repeat(float(max_radius),
+                                                      len(x)),
+                                            0.5,
+                                            subpix=5)
+
+        good = (flag == 0) & np.isfinite(half_radius) & (half_radius > 0)
+
+        if not np.any(good):
+            return(np.nan)
+
+        # half flux radius of a Gaussian is FWHM / 2
+        return(float(2 * np.median(half_radius[good])))
+
+    def seeing_key(self, fwhm):
+
+        """
+        Seeing bin of a FWHM.
+        @param fwhm: FWHM (in pixels).
+        @type fwhm: float
+        @return: int (-1 if FWHM is unknown)
+        """
+
+        if not np.isfinite(fwhm):
+            return(-1)
+
+        return(int(np.floor(fwhm / self.seeing_bin)))
+
+    def apertures(self, data_sub, x, y, targets, night,
+                  err=None,
+                  gain=0.57):
+
+        """
+        Optimum apertures of the targets of a frame. Curves of growth
+        are measured, in one call, only for the targets whose
+        (target, night, seeing bin) is not in the cache.
+        @param data_sub: Background subtracted image data.
+        @type data_sub: numpy array
+        @param x: X coordinates of targets.
+        @type x: array
+        @param y: Y coordinates of targets.
+        @type y: array
+        @param targets: Names of targets.
+        @type targets: list
+        @param night: Observation night.
+        @type night: str
+        @param err: Global background RMS.
+        @type err: float
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @return: numpy array (NaN for targets without an optimum)
+        """
+
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+
+        seeing = self.seeing_key(self.fwhm(data_sub, x, y))
+        keys = [(str(target), str(night), seeing) for target in targets]
+
+        missing = np.array([key not in self.cache for key in keys],
+                           dtype=bool)
+
+        if np.any(missing):
+            apers, snr = self.growth_curves(data_sub,
+                                            x[missing],
+                                            y[missing],
+                                            err=err,
+                                            gain=gain)
+            best = self.best_apertures(apers, snr)
+
+            missing_keys = [key for key, miss in zip(keys, missing) if miss]
+            for key, aper in zip(missing_keys, best):
+                self.cache[key] = float(aper)
+
+        return(np.array([self.cache[key] for key in keys]))
@@ -12,8 +12,6 @@ from astropy.table import Table, Column
 from ccdproc import ImageFileCollection
 import ccdproc
 
-# from pyraf import iraf
-
 from datetime import datetime
 from datetime import timedelta
 
@@ -25,10 +23,66 @@ import sep
 import os
 import time
 import glob
+import shutil
+import signal
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from astropy.utils.exceptions import AstropyWarning
 import warnings
 
 
+@lru_cache(maxsize=256)
+def epoch_mjd(odate):
+
+    """
+    Modified Julian Date of an epoch (cached, stars of a frame share it).
+    @param odate: Observation time.
+    @type odate: str
+    @return: float
+    """
+
+    return(TimeOps().date2mjd(odate))
+
+
+@lru_cache(maxsize=256)
+def earth_barycentric(odate):
+
+    """
+    Barycentric position of the Earth at an epoch (cached, stars of a
+    frame share it).
+    @param odate: Observation time.
+    @type odate: str
+    @return: tuple (x, y, z in au)
+    """
+
+    xyz = get_body_barycentric('earth', Time(odate), ephemeris='de432s')
+
+    return(tuple(xyz.xyz.to(u.au).value))
+
+
+@lru_cache(maxsize=256)
+def image_celestial_wcs(file_name, mtime_ns, size):
+
+    """
+    Celestial WCS of a FITS image (cached, the modification time and
+    size of the file are parts of the key, so a changed file is read
+    again).
+    @param file_name: FITS image file name with absolute path.
+    @type file_name: str
+    @param mtime_ns: Modification time of the file (in ns).
+    @type mtime_ns: int
+    @param size: Size of the file (in bytes).
+    @type size: int
+    @return: astropy.wcs.WCS
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', AstropyWarning)
+        return(WCS(fits.getheader(file_name)).celestial)
+
+
 class FitsOps:
 
     def __init__(self, file_name, checksum=True):
@@ -245,15 +299,15 @@ class AstCalc:
         """
         Converts flux to magnitude.
         @param flux: Flux.
-        @type flux: float
+        @type flux: float or array
         @param exptime: Exposure time.
         @type exptime: float
-        @return: float
+        @return: float or array
         """
 
         try:
             # This calculation for normalize flux to exposure time
-            mag = -2.5 * math.log10(flux) + 2.5 * math.log10(exptime)
+            mag = -2.5 * np.log10(flux) + 2.5 * np.log10(exptime)
             return(mag)
         except Exception as e:
             print(e)
@@ -355,88 +409,91 @@ class AstCalc:
             print(e)
             pass
 
+    def image_wcs(self, file_name):
+
+        """
+        Celestial WCS of a FITS image, read once and cached until the
+        file changes.
+        @param file_name: FITS image file name with path.
+        @type file_name: str
+        @return: astropy.wcs.WCS
+        """
+
+        stat = os.stat(file_name)
+
+        return(image_celestial_wcs(path.abspath(file_name),
+                                   stat.st_mtime_ns,
+                                   stat.st_size))
+
     def xy2skywcs(self, file_name, x, y):
 
         """
         Converts physical coordinates to WCS coordinates
-        for STDOUT with wcstools' xy2sky.
+        for STDOUT in the format of wcstools' xy2sky
+        ("HH:MM:SS.sss +DD:MM:SS.ss", FITS pixels start from 1).
 
         @param file_name: FITS image file name with path.
         @type file_name: str
-        @param A_x: A_x coordinate of object.
-        @type A_x: float
-        @param y: y coordinate of object.
-        @type y: float
-        @return: str
+        @param x: x coordinate(s) of object(s).
+        @type x: float or array
+        @param y: y coordinate(s) of object(s).
+        @type y: float or array
+        @return: str (numpy array of str for array input)
         """
 
-        try:
-            file_path, file_and_ext = path.split(file_name)
-            system("xy2sky {0} {1} {2} > {3}/coors".format(
-                file_name,
-                x,
-                y,
-                file_path))
-            coors = np.genfromtxt('{0}/coors'.format(file_path),
-                                  comments='#',
-                                  invalid_raise=False,
-                                  delimiter=None,
-                                  usecols=(0, 1),
-                                  dtype="U")
-
-            system("rm -rf {0}/coors".format(file_path))
-
-            c = coordinates.SkyCoord('{0} {1}'.format(coors[0], coors[1]),
-                                     unit=(u.hourangle, u.deg), frame='fk5')
+        c = self.xy2sky2wcs(file_name, x, y)
 
-            alpha = c.to_string(style='hmsdms', sep=sep, precision=2)[0]
-            delta = c.to_string(style='hmsdms', sep=sep, precision=1)[0]
+        if c is None:
+            return(None)
 
-            return("{0} {1}".format(alpha.split(" ")[0],
-                                    delta.split(" ")[1]))
+        # rounded to ms of time and 10 mas like xy2sky
+        ra_ms = np.rint(np.atleast_1d(c.ra.hour) * 3600000).astype(np.int64)
+        ra_ms %= 24 * 3600000
+        dec_cas = np.rint(np.abs(np.atleast_1d(c.dec.degree)) *
+                          360000).astype(np.int64)
+        signs = np.where(np.atleast_1d(c.dec.degree) < 0, "-", "+")
 
-            # return('{0} {1}'.format(alpha, delta))
+        coors = np.array(["{0:02d}:{1:02d}:{2:02d}.{3:03d} "
+                          "{4}{5:02d}:{6:02d}:{7:02d}.{8:02d}".format(
+                              r // 3600000, r // 60000 % 60,
+                              r // 1000 % 60, r % 1000,
+                              sign, d // 360000, d // 6000 % 60,
+                              d // 100 % 60, d % 100)
+                          for r, sign, d in zip(ra_ms.tolist(),
+                                                signs.tolist(),
+                                                dec_cas.tolist())])
 
-        except Exception as e:
-            pass
+        if c.isscalar:
+            return(str(coors[0]))
+
+        return(coors)
 
     def xy2sky2wcs(self, file_name, x, y):
 
         """
         Converts physical coordinates to WCS coordinates for
-        calculations with wcstools' xy2sky.
-        
+        calculations, as wcstools' xy2sky does (FITS pixels start
+        from 1).
+
         @param file_name: FITS image file name with path.
         @type file_name: str
-        @param A_x: A_x coordinate of object.
-        @type A_x: float
-        @param y: y coordinate of object.
-        @type y: float
-        @return: str
+        @param x: x coordinate(s) of object(s).
+        @type x: float or array
+        @param y: y coordinate(s) of object(s).
+        @type y: float or array
+        @return: astropy.coordinates.SkyCoord
         """
 
         try:
-            file_path, file_and_ext = path.split(file_name)
-            system("xy2sky {0} {1} {2} > {3}/coors".format(
-                file_name,
-                x,
-                y,
-                file_path))
-            coors = np.genfromtxt('{0}/coors'.format(file_path),
-                                  comments='#',
-                                  invalid_raise=False,
-                                  delimiter=None,
-                                  usecols=(0, 1),
-                                  dtype="U")
-
-            system("rm -rf {0}/coors".format(file_path))
-
-            c = coordinates.SkyCoord('{0} {1}'.format(coors[0], coors[1]),
-                                     unit=(u.hourangle, u.deg), frame='icrs')
+            w = self.image_wcs(file_name)
+            ra, dec = w.all_pix2world(x, y, 1)
+
+            c = coordinates.SkyCoord(ra * u.deg, dec * u.deg,
+                                     frame='icrs')
 
             return(c)
         except Exception as e:
-            pass
+            print(e)
 
     def sky2xy(self, image_path, ra, dec):
 
@@ -479,6 +536,34 @@ class AstCalc:
         else:
             return(float(t_x), float(t_y))
 
+    def sky2pix(self, w, ra, dec, naxis1, naxis2):
+
+        """
+        Converts sky coordinates of many objects to pixel coordinates
+        in one call and flags the ones that fall on the frame.
+        @param w: WCS of the frame.
+        @type w: astropy.wcs.WCS
+        @param ra: RA coordinates of objects (in degrees).
+        @type ra: array
+        @param dec: DEC coordinates of objects (in degrees).
+        @type dec: array
+        @param naxis1: NAXIS1 of the frame.
+        @type naxis1: int
+        @param naxis2: NAXIS2 of the frame.
+        @type naxis2: int
+        @return: tuple (x, y, on_frame mask)
+        """
+
+        ra = np.atleast_1d(np.asarray(ra, dtype=float))
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+
+        x, y = w.wcs_world2pix(ra, dec, 1)
+
+        on_frame = ((x >= 0) & (y >= 0) &
+                    (x <= naxis1) & (y <= naxis2))
+
+        return(x, y, on_frame)
+
     def center_finder(self, file_name, wcs_ref=False):
 
         """
@@ -520,7 +605,8 @@ class AstCalc:
                     ra=None,
                     dec=None,
                     ra_keyword="objctra",
-                    dec_keyword="objctdec"):
+                    dec_keyword="objctdec",
+                    wcs_cache=None):
 
         """
         The astrometry engine will take any image and return
@@ -544,9 +630,14 @@ class AstCalc:
         @type ra_keyword: str
         @param dec_keyword: DEC keyword in the FITS image header
         @type dec_keyword: str
+        @param wcs_cache: Solved WCS cache (io.WCSCache or its file).
+        If None, no cache is used.
+        @type wcs_cache: object
         @return: boolean
         """
-    
+
+        wcs_cache = self.wcs_cache(wcs_cache)
+
         try:
             if ra is None and dec is None:
                 fo = FitsOps(image_path)
@@ -561,7 +652,23 @@ class AstCalc:
                 dec = dec.strip()
                 ra = ra.replace(" ", ":")
                 dec = dec.replace(" ", ":")
-                
+
+            params = {"solver": "astrometry.net",
+                      "tweak_order": tweak_order,
+                      "downsample": downsample,
+                      "radius": radius,
+                      "ra": ra,
+                      "dec": dec}
+
+            if wcs_cache is not None:
+                cache_key = wcs_cache.key(image_path, params)
+                cached = wcs_cache.get(cache_key)
+                if cached is not None:
+                    out_file = self.apply_wcs(image_path, cached)
+                    print("{0} --> {1}: solved from cache!".format(
+                        image_path, out_file))
+                    return(True)
+
             system(("solve-field --no-plots "
                     "--no-verify --tweak-order {0} "
                     "--downsample {1} --overwrite --radius {2} --no-tweak "
@@ -589,11 +696,625 @@ class AstCalc:
             else:
                 system("mv {0}.new {0}_new.fits".format(root))
                 print("{0}.fits --> {0}_new.fits: solved!".format(root))
+
+                if wcs_cache is not None:
+                    wcs_cache.put(cache_key,
+                                  fits.getheader(root + '_new.fits'))
+
                 return(True)
         
         except Exception as e:
             print(e)
 
+    def solved_path(self, image_path):
+
+        """
+        Path of the solved image of an image (<root>_new.fits).
+        @param image_path: FITS image file name with path
+        @type image_path: str
+        @return: str
+        """
+
+        if ".gz" in image_path:
+            root = '.'.join(image_path.split('.')[:-2])
+        else:
+            root, extension = path.splitext(image_path)
+
+        return(root + '_new.fits')
+
+    def apply_wcs(self, image_path, wcs_header):
+
+        """
+        Writes an image with a WCS solution as <root>_new.fits.
+        @param image_path: FITS image file name with path
+        @type image_path: str
+        @param wcs_header: WCS solution.
+        @type wcs_header: astropy.io.fits.Header
+        @return: str, path of the solved image
+        """
+
+        hdu = fits.open(image_path)
+        data = hdu[0].data
+        header = hdu[0].header.copy()
+        hdu.close()
+
+        self.remove_wcs_keywords(header)
+        header.update(wcs_header)
+
+        out_file = self.solved_path(image_path)
+        fits.writeto(out_file, data, header, overwrite=True)
+
+        return(out_file)
+
+    def wcs_cache(self, wcs_cache):
+
+        """
+        Solved WCS cache of a wcs_cache argument.
+        @param wcs_cache: io.WCSCache, its file or None.
+        @type wcs_cache: object
+        @return: io.WCSCache or None
+        """
+
+        from .io import WCSCache
+
+        if wcs_cache is None or isinstance(wcs_cache, WCSCache):
+            return(wcs_cache)
+
+        return(WCSCache(wcs_cache))
+
+    def solve_field_job(self,
+                        image_path,
+                        tweak_order=2,
+                        downsample=4,
+                        radius=0.2,
+                        ra=None,
+                        dec=None,
+                        ra_keyword="objctra",
+                        dec_keyword="objctdec",
+                        timeout=300,
+                        wcs_cache=None):
+
+        """
+        Solves one image with astrometry.net in a private temporary
+        directory. The solved image is written as <root>_new.fits
+        next to the input, like solve_field does.
+        @param image_path: FITS image file name with path
+        @type image_path: str
+        @param tweak_order: Polynomial order of SIP WCS corrections
+        @type tweak_order: integer
+        @param downsample: Downsample the image by factor int before
+        running source extraction
+        @type downsample: integer
+        @param radius: Only search in indexes within 'radius' of the
+        field center given by --ra and --dec
+        @type radius: str
+        @param ra: RA of field center for search, format: degrees or hh:mm:ss
+        @type ra: str
+        @param dec: DEC of field center for search, format: degrees or hh:mm:ss
+        @type dec: str
+        @param ra_keyword: RA keyword in the FITS image header
+        @type ra_keyword: str
+        @param dec_keyword: DEC keyword in the FITS image header
+        @type dec_keyword: str
+        @param timeout: Time limit of the job (in seconds).
+        @type timeout: float
+        @param wcs_cache: Solved WCS cache (io.WCSCache or its file).
+        If None, no cache is used.
+        @type wcs_cache: object
+        @return: dict (image, solved, cached, output, wcs, elapsed, error)
+        """
+
+        start = time.time()
+        result = {"image": image_path,
+                  "solved": False,
+                  "cached": False,
+                  "output": None,
+                  "wcs": None,
+                  "elapsed": 0.0,
+                  "error": None}
+
+        wcs_cache = self.wcs_cache(wcs_cache)
+        work_dir = None
+
+        try:
+            if ra is None and dec is None:
+                fo = FitsOps(image_path)
+                ra = fo.get_header(ra_keyword)
+                dec = fo.get_header(dec_keyword)
+
+            ra = str(ra).strip().replace(" ", ":")
+            dec = str(dec).strip().replace(" ", ":")
+
+            params = {"solver": "astrometry.net",
+                      "tweak_order": tweak_order,
+                      "downsample": downsample,
+                      "radius": radius,
+                      "ra": ra,
+                      "dec": dec}
+
+            if wcs_cache is not None:
+                cache_key = wcs_cache.key(image_path, params)
+                cached = wcs_cache.get(cache_key)
+                if cached is not None:
+                    result.update({"solved": True,
+                                   "cached": True,
+                                   "output": self.apply_wcs(image_path,
+                                                            cached),
+                                   "wcs": cached,
+                                   "elapsed": time.time() - start})
+                    return(result)
+
+            if ".gz" in image_path:
+                root = '.'.join(image_path.split('.')[:-2])
+            else:
+                root, extension = path.splitext(image_path)
+
+            base = path.basename(root)
+            work_dir = tempfile.mkdtemp(prefix="solve_field_")
+
+            # own process group, so a timeout also stops the
+            # astrometry-engine started by the solve-field wrapper
+            process = subprocess.Popen(["solve-field",
+                                        "--no-plots",
+                                        "--no-verify",
+                                        "--tweak-order", str(tweak_order),
+                                        "--downsample", str(downsample),
+                                        "--overwrite",
+                                        "--radius", str(radius),
+                                        "--no-tweak",
+                                        "--cpulimit", str(int(timeout)),
+                                        "--ra", ra,
+                                        "--dec", dec,
+                                        "--dir", work_dir,
+                                        image_path],
+                                       stdout=subprocess.DEVNULL,
+                                       stderr=subprocess.PIPE,
+                                       start_new_session=True)
+
+            try:
+                stdout, stderr = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.communicate()
+                raise
+
+            new_file = path.join(work_dir, base + '.new')
+            wcs_file = path.join(work_dir, base + '.wcs')
+
+            if not path.exists(new_file):
+                # last lines of the solver's errors
+                stderr = stderr.decode(errors='replace').strip()
+                if stderr:
+                    result["error"] = "not solved: {0}".format(
+                        " | ".join(stderr.splitlines()[-5:]))
+                else:
+                    result["error"] = "not solved"
+            else:
+                if path.exists(wcs_file):
+                    result["wcs"] = fits.getheader(wcs_file)
+                shutil.move(new_file, root + '_new.fits')
+                result["solved"] = True
+                result["output"] = root + '_new.fits'
+
+                if wcs_cache is not None and result["wcs"] is not None:
+                    wcs_cache.put(cache_key, result["wcs"])
+
+        except subprocess.TimeoutExpired:
+            result["error"] = "timeout"
+        except Exception as e:
+            result["error"] = str(e)
+        finally:
+            if work_dir is not None:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+        result["elapsed"] = time.time() - start
+
+        return(result)
+
+    def solve_field_batch(self,
+                          image_paths,
+                          n_jobs=None,
+                          timeout=300,
+                          tweak_order=2,
+                          downsample=4,
+                          radius=0.2,
+                          ra_keyword="objctra",
+                          dec_keyword="objctdec",
+                          wcs_cache=None):
+
+        """
+        Solves many images with astrometry.net concurrently. Every job
+        runs in its own temporary directory with a time limit.
+        @param image_paths: FITS image file names with path, or a
+        glob pattern.
+        @type image_paths: list or str
+        @param n_jobs: Number of concurrent jobs. If None, the number
+        of CPUs.
+        @type n_jobs: int
+        @param timeout: Time limit of a job (in seconds).
+        @type timeout: float
+        @param tweak_order: Polynomial order of SIP WCS corrections
+        @type tweak_order: integer
+        @param downsample: Downsample the images by factor int before
+        running source extraction
+        @type downsample: integer
+        @param radius: Only search in indexes within 'radius' of the
+        field center in the image header
+        @type radius: str
+        @param ra_keyword: RA keyword in the FITS image header
+        @type ra_keyword: str
+        @param dec_keyword: DEC keyword in the FITS image header
+        @type dec_keyword: str
+        @param wcs_cache: Solved WCS cache (io.WCSCache or its file).
+        If None, no cache is used.
+        @type wcs_cache: object
+        @return: list of dicts (return of the solve_field_job)
+        """
+
+        wcs_cache = self.wcs_cache(wcs_cache)
+
+        if isinstance(image_paths, str):
+            image_paths = sorted(glob.glob(image_paths))
+
+        if n_jobs is None:
+            n_jobs = os.cpu_count() or 1
+
+        n_jobs = max(1, min(n_jobs, len(image_paths)))
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(self.solve_field_job,
+                                       image_path,
+                                       tweak_order=tweak_order,
+                                       downsample=downsample,
+                                       radius=radius,
+                                       ra_keyword=ra_keyword,
+                                       dec_keyword=dec_keyword,
+                                       timeout=timeout,
+                                       wcs_cache=wcs_cache)
+                       for image_path in image_paths]
+
+            results = []
+            for future in futures:
+                result = future.result()
+                if result["solved"]:
+                    print("{0} --> {1}: solved{2}! ({3:.1f} s)".format(
+                        result["image"], result["output"],
+                        " from cache" if result["cached"] else "",
+                        result["elapsed"]))
+                else:
+                    print("{0} cannot be solved! ({1})".format(
+                        result["image"], result["error"]))
+                results.append(result)
+
+        print("{0}/{1} images solved.".format(
+            sum(result["solved"] for result in results), len(results)))
+
+        return(results)
+
+    def refine_wcs(self, data, wcs_header, catalog, max_sources=100,
+                   match_radius=2.0, search_radius=60.0, order=1,
+                   sigma=3.0):
+
+        """
+        Refines a WCS predicted for an image (e.g. the solution of the
+        previous frame) with catalogue stars: sources are detected,
+        their shift from the predicted positions is found within
+        search_radius and the plate is fitted to the stars matched
+        within match_radius.
+        @param data: Image data.
+        @type data: numpy array
+        @param wcs_header: Predicted WCS.
+        @type wcs_header: astropy.io.fits.Header
+        @param catalog: Reference stars.
+        @type catalog: astropy.coordinates.SkyCoord
+        @param max_sources: Number of the brightest sources to be used.
+        @type max_sources: int
+        @param match_radius: Match radius (in arcsec).
+        @type match_radius: float
+        @param search_radius: Largest pointing offset (in arcsec).
+        @type search_radius: float
+        @param order: Polynomial order of the plate solution (1-4).
+        @type order: int
+        @param sigma: Clipping limit of the reference stars.
+        @type sigma: float
+        @return: dict (return of the plate_solve) or False
+        """
+
+        data = np.ascontiguousarray(data, dtype=float)
+        bkg = sep.Background(data)
+        data_sub = data - bkg
+        objects = sep.extract(data_sub, 5, err=bkg.globalrms)
+
+        if len(objects) < 3 or len(catalog) < 3:
+            return(False)
+
+        objects = objects[np.argsort(objects['flux'])[::-1][:max_sources]]
+        x = objects['x']
+        y = objects['y']
+
+        w = WCS(wcs_header).celestial
+        p_ra, p_dec = w.all_pix2world(x, y, 0)
+        predicted = coordinates.SkyCoord(p_ra * u.deg, p_dec * u.deg,
+                                         frame='icrs')
+
+        # pointing offset from the nearest neighbours
+        idx, sep2d, _ = predicted.match_to_catalog_sky(catalog)
+        near = sep2d.arcsec < search_radius
+        if np.count_nonzero(near) < 3:
+            return(False)
+
+        d_lon, d_lat = predicted[near].spherical_offsets_to(
+            catalog[idx[near]])
+        d_lon = np.median(d_lon.to(u.arcsec).value)
+        d_lat = np.median(d_lat.to(u.arcsec).value)
+        shifted = predicted.spherical_offsets_by(d_lon * u.arcsec,
+                                                 d_lat * u.arcsec)
+
+        idx, sep2d, _ = shifted.match_to_catalog_sky(catalog)
+        matched = sep2d.arcsec < match_radius
+
+        # a star is matched once
+        unique_idx, first = np.unique(idx[matched], return_index=True)
+        rows = np.flatnonzero(matched)[first]
+
+        if len(rows) <= len(self.plate_terms(order)) + 2:
+            return(False)
+
+        ra_center, dec_center = w.wcs.crval
+
+        return(self.plate_solve(ra_center,
+                                dec_center,
+                                x[rows],
+                                y[rows],
+                                catalog.ra.degree[unique_idx],
+                                catalog.dec.degree[unique_idx],
+                                order=order,
+                                sigma=sigma,
+                                crpix=((data.shape[1] - 1) / 2.0,
+                                       (data.shape[0] - 1) / 2.0),
+                                origin=0))
+
+    def solve_field_sequence(self,
+                             image_paths,
+                             wcs_hint=None,
+                             max_sources=100,
+                             max_mag=18,
+                             match_radius=2.0,
+                             search_radius=60.0,
+                             min_matches=10,
+                             max_rms=1.0,
+                             order=1,
+                             timeout=300,
+                             wcs_cache=None,
+                             **solve_field_kwargs):
+
+        """
+        Solves consecutive frames of a sequence. The WCS of the last
+        solved frame is refined with Gaia stars (see refine_wcs);
+        astrometry.net is run only when the refinement fails.
+        Solved images are written as <root>_new.fits like solve_field
+        does.
+        @param image_paths: FITS image file names with path, or a
+        glob pattern.
+        @type image_paths: list or str
+        @param wcs_hint: WCS of the first frame. If None, the first
+        frame is solved with astrometry.net.
+        @type wcs_hint: astropy.io.fits.Header
+        @param max_sources: Number of the brightest sources to be used.
+        @type max_sources: int
+        @param max_mag: Limit G magnitude of the reference stars.
+        @type max_mag: float
+        @param match_radius: Match radius (in arcsec).
+        @type match_radius: float
+        @param search_radius: Largest pointing offset between
+        consecutive frames (in arcsec).
+        @type search_radius: float
+        @param min_matches: Minimum number of the matched stars of a
+        refined solution.
+        @type min_matches: int
+        @param max_rms: Maximum RMS of a refined solution (in arcsec).
+        @type max_rms: float
+        @param order: Polynomial order of the refined solutions (1-4).
+        @type order: int
+        @param timeout: Time limit of an astrometry.net job (in seconds).
+        @type timeout: float
+        @param wcs_cache: Solved WCS cache (io.WCSCache or its file).
+        If None, no cache is used.
+        @type wcs_cache: object
+        @param solve_field_kwargs: Other arguments of the solve_field_job.
+        @type solve_field_kwargs: dict
+        @return: list of dicts (image, solved, method, output, wcs,
+        n_matches, rms, elapsed, error)
+        """
+
+        from .catalog import Query
+
+        if isinstance(image_paths, str):
+            image_paths = sorted(glob.glob(image_paths))
+
+        wcs_cache = self.wcs_cache(wcs_cache)
+        params = {"solver": "sequence",
+                  "max_sources": max_sources,
+                  "max_mag": max_mag,
+                  "match_radius": match_radius,
+                  "min_matches": min_matches,
+                  "max_rms": max_rms,
+                  "order": order}
+
+        qry = Query()
+        last_wcs = wcs_hint
+        catalog = None
+        catalog_center = None
+        catalog_radius = 0.0
+
+        results = []
+        for image_path in image_paths:
+            start = time.time()
+
+            result = {"image": image_path,
+                      "solved": False,
+                      "method": None,
+                      "output": None,
+                      "wcs": None,
+                      "n_matches": 0,
+                      "rms": None,
+                      "elapsed": 0.0,
+                      "error": None}
+
+            cached = None
+            if wcs_cache is not None:
+                cache_key = wcs_cache.key(image_path, params)
+                cached = wcs_cache.get(cache_key)
+
+            solution = False
+            if cached is not None:
+                result.update({"solved": True,
+                               "method": "cache",
+                               "output": self.apply_wcs(image_path,
+                                                        cached),
+                               "wcs": cached})
+            elif last_wcs is not None:
+                data = fits.getdata(image_path)
+                w = WCS(last_wcs).celestial
+                ny, nx = data.shape
+                center = w.pixel_to_world((nx - 1) / 2.0, (ny - 1) / 2.0)
+                corner = w.pixel_to_world(0, 0)
+                field_radius = center.separation(corner).degree
+
+                # reference stars are queried again when the
+                # pointing drifts away
+                if catalog is None or \
+                        center.separation(catalog_center).degree + \
+                        field_radius > catalog_radius:
+                    catalog_radius = 1.5 * field_radius
+                    try:
+                        gaia = qry.gaia_query(center.ra.degree,
+                                              center.dec.degree,
+                                              2 * catalog_radius,
+                                              max_mag=max_mag,
+                                              max_sources=10000)
+                        catalog = coordinates.SkyCoord(
+                            np.asarray(gaia['RA_ICRS'], dtype=float),
+                            np.asarray(gaia['DE_ICRS'], dtype=float),
+                            unit=(u.deg, u.deg),
+                            frame='icrs')
+                        catalog_center = center
+                    except Exception as e:
+                        print(e)
+                        catalog = None
+
+                if catalog is not None:
+                    solution = self.refine_wcs(data,
+                                               last_wcs,
+                                               catalog,
+                                               max_sources=max_sources,
+                                               match_radius=match_radius,
+                                               search_radius=search_radius,
+                                               order=order)
+
+            if result["solved"]:
+                pass
+            elif solution is not False and \
+                    solution['n_used'] >= min_matches and \
+                    solution['rms_delta'] <= max_rms:
+                wcs_header = self.plate_wcs_header(solution)
+
+                result.update({"solved": True,
+                               "method": "refine",
+                               "output": self.apply_wcs(image_path,
+                                                        wcs_header),
+                               "wcs": wcs_header,
+                               "n_matches": solution['n_used'],
+                               "rms": solution['rms_delta']})
+
+                if wcs_cache is not None:
+                    wcs_cache.put(cache_key, wcs_header)
+            else:
+                job = self.solve_field_job(image_path,
+                                           timeout=timeout,
+                                           wcs_cache=wcs_cache,
+                                           **solve_field_kwargs)
+                result.update({"solved": job["solved"],
+                               "method": "astrometry.net",
+                               "output": job["output"],
+                               "wcs": job["wcs"],
+                               "error": job["error"]})
+
+            if result["solved"]:
+                last_wcs = result["wcs"]
+                print("{0} --> {1}: solved with {2}!".format(
+                    image_path, result["output"], result["method"]))
+            else:
+                print("{0} cannot be solved! ({1})".format(
+                    image_path, result["error"]))
+
+            result["elapsed"] = time.time() - start
+            results.append(result)
+
+        return(results)
+
+    def std2equ_array(self, ra0, dec0, xx, yy):
+
+        """
+        Calculation of equatorial coordinates from standard coordinates
+        of many objects at once.
+        @param ra0: Right ascension of optical axis [rad]
+        @type ra0: float
+        @param dec0: Declination of optical axis [rad]
+        @type dec0: float
+        @param xx: Standard coordinates of X
+        @type xx: array
+        @param yy: Standard coordinates of Y
+        @type yy: array
+        @return: Tuple, ra, dec arrays in [rad]
+        """
+
+        xx = np.asarray(xx, dtype=float)
+        yy = np.asarray(yy, dtype=float)
+
+        ra = ra0 + np.arctan(-xx /
+                             (np.cos(dec0) -
+                              (yy * np.sin(dec0))))
+
+        dec = np.arcsin((np.sin(dec0) + (yy * np.cos(dec0))) /
+                        np.sqrt(1 + np.power(xx, 2) +
+                                np.power(yy, 2)))
+
+        return(ra, dec)
+
+    def equ2std_array(self, ra0, dec0, ra, dec):
+
+        """
+        Calculation of standard coordinates from equatorial coordinates
+        of many objects at once.
+        @param ra0: Right ascension of optical axis [rad]
+        @type ra0: float
+        @param dec0: Declination of optical axis [rad]
+        @type dec0: float
+        @param ra: Right ascensions [rad]
+        @type ra: array
+        @param dec: Declinations [rad]
+        @type dec: array
+        @return: Tuple, xx, yy arrays
+        """
+
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+
+        cos_dec = np.cos(dec)
+        sin_dec = np.sin(dec)
+        cos_dra = np.cos(ra - ra0)
+
+        denom = (np.cos(dec0) * cos_dec * cos_dra +
+                 np.sin(dec0) * sin_dec)
+
+        xx = -(cos_dec * np.sin(ra - ra0)) / denom
+
+        yy = -(np.sin(dec0) * cos_dec * cos_dra -
+               np.cos(dec0) * sin_dec) / denom
+
+        return(xx, yy)
+
     def std2equ(self, ra0, dec0, xx, yy):
 
         """
@@ -610,15 +1331,9 @@ class AstCalc:
         @return: Tuple, ra, dec in [rad]
         """
 
-        ra = ra0 + math.atan(-xx /
-                             (math.cos(dec0) -
-                              (yy * math.sin(dec0))))
+        ra, dec = self.std2equ_array(ra0, dec0, xx, yy)
 
-        dec = math.asin((math.sin(dec0) + (yy * math.cos(dec0))) /
-                        math.sqrt(1 + math.pow(xx, 2) +
-                                  math.pow(yy, 2)))
-
-        return(ra, dec)
+        return(float(ra), float(dec))
 
     def equ2std(self, ra0, dec0, ra, dec):
 
@@ -634,16 +1349,411 @@ class AstCalc:
         @type dec: float
         @return: Tuple, xx, yy
         """
-        xx = (-(math.cos(dec) * math.sin(ra - ra0)) /
-              (math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0) +
-               math.sin(dec0) * math.sin(dec)))
 
-        yy = (-(math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0) -
-                math.cos(dec0) * math.sin(dec)) /
-              (math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0) +
-               math.sin(dec0) * math.sin(dec)))
+        xx, yy = self.equ2std_array(ra0, dec0, ra, dec)
 
-        return(xx, yy)
+        return(float(xx), float(yy))
+
+    def plate_terms(self, order=1):
+
+        """
+        Polynomial terms of a plate model.
+        @param order: Polynomial order (1-4).
+        @type order: int
+        @return: list of (p, q) powers of x and y, by degree
+        """
+
+        return([(degree - q, q)
+                for degree in range(order + 1)
+                for q in range(degree + 1)])
+
+    def plate_design(self, x, y, terms):
+
+        """
+        Design matrix of a plate model.
+        @param x: X coordinates relative to the reference pixel.
+        @type x: array [object] or [frame, object]
+        @param y: Y coordinates relative to the reference pixel.
+        @type y: array [object] or [frame, object]
+        @param terms: Return of the plate_terms.
+        @type terms: list
+        @return: numpy array [object, term] or [frame, object, term]
+        """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        return(np.stack([np.power(x, p) * np.power(y, q)
+                         for p, q in terms], axis=-1))
+
+    def plate_fit(self, design, std_coords, sigma=3.0, iters=5,
+                  valid=None):
+
+        """
+        Least squares fit of both standard coordinates with one SVD
+        of the design matrix, with iterative sigma clipping of the
+        objects whose total residual is larger than sigma * RMS.
+        Stacked design matrices of many frames are factorised together
+        and clipped at once; a frame stops clipping when its objects
+        do not change.
+        @param design: Return of the plate_design.
+        @type design: numpy array [object, term] or [frame, object, term]
+        @param std_coords: Standard coordinates (xi, eta) [rad].
+        @type std_coords: numpy array [object, 2] or [frame, object, 2]
+        @param sigma: Clipping limit. If None, nothing is clipped.
+        @type sigma: float
+        @param iters: Maximum number of clipping iterations.
+        @type iters: int
+        @param valid: Objects that can be used (padding of stacked
+        frames is not). If None, all objects.
+        @type valid: numpy array [object] or [frame, object]
+        @return: tuple (coefficients [term, 2], covariances
+        [2, term, term], used objects mask), with a leading frame axis
+        for stacked frames
+        """
+
+        stacked = np.ndim(design) == 3
+        design = np.asarray(design, dtype=float).reshape(
+            (-1,) + np.shape(design)[-2:])
+        std_coords = np.asarray(std_coords, dtype=float).reshape(
+            (-1,) + np.shape(std_coords)[-2:])
+
+        if valid is None:
+            valid = np.ones(design.shape[:2], dtype=bool)
+        valid = np.asarray(valid, dtype=bool).reshape(design.shape[:2])
+
+        n_terms = design.shape[2]
+        used = valid.copy()
+        clipping = np.ones(len(design), dtype=bool)
+
+        for i in range(iters + 1):
+            # unused objects are zero rows, they do not change the fit;
+            # columns are scaled to unit norm for high order terms
+            weighted = design * used[..., None]
+            norms = np.sqrt(np.sum(np.power(weighted, 2), axis=1))
+            norms[norms == 0] = 1.0
+            u_mat, s_vec, vt_mat = np.linalg.svd(weighted / norms[:, None],
+                                                 full_matrices=False)
+            coeffs = (np.swapaxes(vt_mat, 1, 2) @ (
+                (np.swapaxes(u_mat, 1, 2) @ (std_coords * used[..., None])) /
+                s_vec[..., None])) / norms[..., None]
+
+            residuals = std_coords - design @ coeffs
+            delta = np.hypot(residuals[..., 0], residuals[..., 1])
+
+            if sigma is None or i == iters:
+                break
+
+            rms = np.sqrt(np.sum(np.power(delta, 2) * used, axis=1) /
+                          np.count_nonzero(used, axis=1))
+            new_used = valid & (delta <= sigma * rms[:, None])
+
+            clipping &= ~(np.all(new_used == used, axis=1) |
+                          (np.count_nonzero(new_used, axis=1) <= n_terms))
+
+            if not np.any(clipping):
+                break
+
+            used[clipping] = new_used[clipping]
+
+        dof = np.maximum(np.count_nonzero(used, axis=1) - n_terms, 1)
+        variance = np.sum(np.power(residuals, 2) * used[..., None],
+                          axis=1) / dof[:, None]
+        normal_inv = ((np.swapaxes(vt_mat, 1, 2) /
+                       np.power(s_vec, 2)[:, None, :]) @ vt_mat /
+                      (norms[:, :, None] * norms[:, None, :]))
+        cov = variance[:, :, None, None] * normal_inv[:, None]
+
+        if not stacked:
+            return(coeffs[0], cov[0], used[0])
+
+        return(coeffs, cov, used)
+
+    def plate_solve(self, ra_center, dec_center, x, y, ra, dec,
+                    order=1,
+                    sigma=3.0,
+                    iters=5,
+                    crpix=None,
+                    origin=1,
+                    recenter=True):
+
+        """
+        Plate solution of reference stars with a polynomial model of
+        standard coordinates. The tangent point is moved to the
+        reference pixel unless recenter is False.
+        @param ra_center: RA coordinate of center of optical axis [deg]
+        @type ra_center: float
+        @param dec_center: DEC coordinate of center of optical axis [deg]
+        @type dec_center: float
+        @param x: X coordinates of reference stars.
+        @type x: array
+        @param y: Y coordinates of reference stars.
+        @type y: array
+        @param ra: RA coordinates of reference stars [deg].
+        @type ra: array
+        @param dec: DEC coordinates of reference stars [deg].
+        @type dec: array
+        @param order: Polynomial order (1-4).
+        @type order: int
+        @param sigma: Clipping limit. If None, nothing is clipped.
+        @type sigma: float
+        @param iters: Maximum number of clipping iterations.
+        @type iters: int
+        @param crpix: Reference pixel (x, y). If None, the median
+        position of reference stars.
+        @type crpix: tuple
+        @param origin: Origin of pixel coordinates (0 or 1).
+        @type origin: int
+        @param recenter: Move the tangent point to the reference pixel?
+        @type recenter: boolean
+        @return: dict or False
+        """
+
+        return(self.plate_solve_batch([{"ra_center": ra_center,
+                                        "dec_center": dec_center,
+                                        "x": x,
+                                        "y": y,
+                                        "ra": ra,
+                                        "dec": dec,
+                                        "crpix": crpix}],
+                                      order=order,
+                                      sigma=sigma,
+                                      iters=iters,
+                                      origin=origin,
+                                      recenter=recenter)[0])
+
+    def plate_solve_batch(self, frames, order=1, sigma=3.0, iters=5,
+                          origin=1,
+                          recenter=True):
+
+        """
+        Plate solutions of many frames. Reference stars of the frames
+        are padded to the same number, so the recentring, the fits and
+        the clipping of all frames are done together on stacked arrays.
+        @param frames: Frames, dicts with ra_center, dec_center [deg],
+        x, y, ra, dec [deg] keys and an optional crpix.
+        @type frames: list
+        @param order: Polynomial order (1-4).
+        @type order: int
+        @param sigma: Clipping limit. If None, nothing is clipped.
+        @type sigma: float
+        @param iters: Maximum number of clipping iterations.
+        @type iters: int
+        @param origin: Origin of pixel coordinates (0 or 1).
+        @type origin: int
+        @param recenter: Move the tangent points to the reference pixels?
+        @type recenter: boolean
+        @return: list of dicts (False for unsolved frames)
+        """
+
+        if order not in (1, 2, 3, 4):
+            print("Polynomial order must be between 1 and 4!")
+            raise SystemExit
+
+        terms = self.plate_terms(order)
+        solutions = [False] * len(frames)
+
+        stars = []
+        for i, frame in enumerate(frames):
+            x, y, ra, dec = [np.atleast_1d(np.asarray(frame[key],
+                                                      dtype=float))
+                             for key in ('x', 'y', 'ra', 'dec')]
+
+            if len(x) <= len(terms):
+                print("{0} reference stars are not enough for "
+                      "order {1} plate solution!".format(len(x), order))
+                continue
+
+            crpix = frame.get('crpix')
+            if crpix is None:
+                crpix = (float(np.median(x)), float(np.median(y)))
+
+            stars.append((i, x, y, ra, dec,
+                          (float(crpix[0]), float(crpix[1]))))
+
+        if len(stars) == 0:
+            return(solutions)
+
+        # frames are padded to the same number of stars
+        n_stars = max(len(star[1]) for star in stars)
+        valid = np.zeros((len(stars), n_stars), dtype=bool)
+        x = np.zeros((len(stars), n_stars))
+        y = np.zeros((len(stars), n_stars))
+        ra = np.zeros((len(stars), n_stars))
+        dec = np.zeros((len(stars), n_stars))
+        crpix = np.array([star[5] for star in stars])
+        ra0 = np.radians([frames[star[0]]['ra_center'] for star in stars])
+        dec0 = np.radians([frames[star[0]]['dec_center'] for star in stars])
+
+        for j, (i, s_x, s_y, s_ra, s_dec, s_crpix) in enumerate(stars):
+            n = len(s_x)
+            valid[j, :n] = True
+            x[j, :n] = s_x
+            y[j, :n] = s_y
+            ra[j] = np.radians(frames[i]['ra_center'])
+            dec[j] = np.radians(frames[i]['dec_center'])
+            ra[j, :n] = np.radians(s_ra)
+            dec[j, :n] = np.radians(s_dec)
+
+        design = self.plate_design(x - crpix[:, :1], y - crpix[:, 1:],
+                                   terms)
+
+        for i in range(4 if recenter else 1):
+            xx, yy = self.equ2std_array(ra0[:, None], dec0[:, None],
+                                        ra, dec)
+            # xi is -xx
+            std_coords = np.stack((-xx, yy), axis=-1)
+            coeffs, cov, used = self.plate_fit(design, std_coords,
+                                               sigma=sigma,
+                                               iters=iters,
+                                               valid=valid)
+            if recenter and i < 3:
+                # constant terms are the tangent point offset
+                ra0, dec0 = self.std2equ_array(ra0, dec0,
+                                               -coeffs[:, 0, 0],
+                                               coeffs[:, 0, 1])
+
+        for j, (i, s_x, s_y, s_ra, s_dec, s_crpix) in enumerate(stars):
+            n = len(s_x)
+            s_used = used[j, :n]
+            solution = {"order": order,
+                        "terms": terms,
+                        "crval": (math.degrees(ra0[j]),
+                                  math.degrees(dec0[j])),
+                        "crpix": s_crpix,
+                        "origin": origin,
+                        "coeffs": coeffs[j],
+                        "cov": cov[j],
+                        "used": s_used}
+
+            c_ra, c_dec = self.plate_pix2world(solution, s_x, s_y)
+
+            d_ra = (np.radians((c_ra - s_ra + 180.0) % 360.0 - 180.0) *
+                    np.cos(np.radians(s_dec)))
+            d_dec = np.radians(c_dec - s_dec)
+            delta = 3600.0 * np.degrees(np.hypot(d_ra, d_dec))
+
+            solution.update({"c_ra": c_ra,
+                             "c_dec": c_dec,
+                             "e_c_ra": np.degrees(d_ra) * 3600.0,
+                             "e_c_dec": np.degrees(d_dec) * 3600.0,
+                             "error": delta,
+                             "n_used": int(np.count_nonzero(s_used)),
+                             "rms_ra": np.sqrt(np.mean(np.power(
+                                 np.degrees(d_ra[s_used]) * 3600.0, 2))),
+                             "rms_dec": np.sqrt(np.mean(np.power(
+                                 np.degrees(d_dec[s_used]) * 3600.0, 2))),
+                             "rms_delta": np.sqrt(np.mean(np.power(
+                                 delta[s_used], 2)))})
+
+            solutions[i] = solution
+
+        return(solutions)
+
+    def plate_pix2world(self, solution, x, y):
+
+        """
+        Sky coordinates of pixels with a plate solution.
+        @param solution: Return of the plate_solve.
+        @type solution: dict
+        @param x: X coordinates.
+        @type x: array
+        @param y: Y coordinates.
+        @type y: array
+        @return: Tuple, ra, dec arrays in [deg]
+        """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        design = self.plate_design(x - solution['crpix'][0],
+                                   y - solution['crpix'][1],
+                                   solution['terms'])
+        std_coords = design @ solution['coeffs']
+
+        ra, dec = self.std2equ_array(math.radians(solution['crval'][0]),
+                                     math.radians(solution['crval'][1]),
+                                     -std_coords[:, 0],
+                                     std_coords[:, 1])
+
+        return(np.degrees(ra) % 360.0, np.degrees(dec))
+
+    def plate_wcs_header(self, solution):
+
+        """
+        TAN (order 1) or TAN-SIP WCS header of a plate solution.
+        The tangent point must be at the reference pixel, otherwise
+        ValueError is raised.
+        @param solution: Return of the plate_solve.
+        @type solution: dict
+        @return: astropy.io.fits.Header
+        """
+
+        coeffs = np.degrees(solution['coeffs'])
+        terms = solution['terms']
+
+        if np.any(np.abs(coeffs[0]) > 1e-9):
+            raise ValueError("Plate solution is not centered at the "
+                             "reference pixel, it cannot be written as "
+                             "WCS (solve it with recenter=True)!")
+
+        cd = coeffs[1:3].T
+        sip = solution['order'] > 1
+        ctype = "-SIP" if sip else ""
+
+        header = fits.Header()
+        header['WCSAXES'] = 2
+        header['CTYPE1'] = "RA---TAN{0}".format(ctype)
+        header['CTYPE2'] = "DEC--TAN{0}".format(ctype)
+        header['CUNIT1'] = "deg"
+        header['CUNIT2'] = "deg"
+        header['CRVAL1'] = solution['crval'][0]
+        header['CRVAL2'] = solution['crval'][1]
+        # FITS pixels start from 1
+        header['CRPIX1'] = solution['crpix'][0] + 1 - solution['origin']
+        header['CRPIX2'] = solution['crpix'][1] + 1 - solution['origin']
+        header['CD1_1'] = cd[0, 0]
+        header['CD1_2'] = cd[0, 1]
+        header['CD2_1'] = cd[1, 0]
+        header['CD2_2'] = cd[1, 1]
+        header['RADESYS'] = "ICRS"
+
+        if sip:
+            # distortions in pixels, CD^-1 of higher order terms
+            sip_coeffs = np.linalg.solve(cd, coeffs[3:].T)
+            header['A_ORDER'] = solution['order']
+            header['B_ORDER'] = solution['order']
+            for (p, q), a_pq, b_pq in zip(terms[3:],
+                                          sip_coeffs[0],
+                                          sip_coeffs[1]):
+                header['A_{0}_{1}'.format(p, q)] = a_pq
+                header['B_{0}_{1}'.format(p, q)] = b_pq
+
+        return(header)
+
+    def remove_wcs_keywords(self, header):
+
+        """
+        Removes WCS keywords (including SIP distortions) from a header.
+        @param header: FITS header.
+        @type header: astropy.io.fits.Header
+        @return: astropy.io.fits.Header
+        """
+
+        old_keys = [key for key in header.keys()
+                    if key in ('WCSAXES', 'EQUINOX', 'EPOCH', 'RADESYS',
+                               'RADECSYS', 'LONPOLE', 'LATPOLE',
+                               'A_ORDER', 'B_ORDER', 'AP_ORDER',
+                               'BP_ORDER', 'A_DMAX', 'B_DMAX',
+                               'IMAGEW', 'IMAGEH') or
+                    key.startswith(('CTYPE', 'CRVAL', 'CRPIX', 'CUNIT',
+                                    'CDELT', 'CROTA', 'CD1_', 'CD2_',
+                                    'PC1_', 'PC2_', 'PV1_', 'PV2_',
+                                    'A_', 'B_', 'AP_', 'BP_'))]
+        for key in set(old_keys):
+            del header[key]
+
+        return(header)
 
     def plate_constants(self, ra_center, dec_center,
                         objects_matrix, target_xy):
@@ -662,79 +1772,54 @@ class AstCalc:
         @type target_xy: list
         @return: astropy.table
         """
-        x_xy = []
-        b_xx = []
-        b_yy = []
-        
-        ra0 = ra_center
-        dec0 = dec_center
-
-        for m_object in objects_matrix:
-            ra = math.radians(m_object[3])
-            dec = math.radians(m_object[4])
-            x_xy.append([m_object[1], m_object[2], 1])
-            b_xx.append(self.equ2std(ra0, dec0, ra, dec)[0])
-            b_yy.append(self.equ2std(ra0, dec0, ra, dec)[1])
-
-        A_x = np.linalg.lstsq(np.array(x_xy), np.asarray(b_xx))[0]
-        A_y = np.linalg.lstsq(np.array(x_xy), np.asarray(b_yy))[0]
-
-        a, b, c = A_x
-        d, e, f = A_y
-
-        coor_list = []
-
-        for s_object in objects_matrix:
-            xx = a * s_object[1] + b * s_object[2] + c
-            yy = f * s_object[1] + e * s_object[2] + f
-
-            ra, dec = self.std2equ(ra0, dec0, xx, yy)
- 
-            d_ra = ((ra - math.radians(s_object[3])) *
-                    math.cos(math.radians(s_object[4])))
-            d_dec = (dec - math.radians(s_object[4]))
-
-            delta = 3600.0 * math.sqrt(math.pow(d_ra, 2) +
-                                       math.pow(d_dec, 2))
-
-            coor_list.append([s_object[0],
-                              s_object[1],
-                              s_object[2],
-                              s_object[3],
-                              s_object[4],
-                              math.degrees(ra),
-                              math.degrees(dec),
-                              math.degrees(d_ra) * 3600.0,
-                              math.degrees(d_dec) * 3600.0,
-                              delta,
-                              (s_object[3] - math.degrees(ra)),
-                              (s_object[4] - math.degrees(dec))])
-
-        for i, xy in enumerate(target_xy):
-            xx = a * xy[0] + b * xy[1] + c
-            yy = f * xy[0] + e * xy[1] + f
-
-            ra, dec = self.std2equ(ra0, dec0, xx, yy)
-
-            coor_list.append([i,
-                              xy[0],
-                              xy[1],
-                              None,
-                              None,
-                              math.degrees(ra),
-                              math.degrees(dec),
-                              None,
-                              None,
-                              None,
-                              None,
-                              None])
-
-        results = np.array(coor_list, dtype=np.float)
-        # results = results[np.isnan(results)] = 0
-        
-        rms_ra = np.sqrt(np.mean(np.power(results[:, 7], 2)))
-        rms_dec = np.sqrt(np.mean(np.power(results[:, 8], 2)))
-        rms_delta = np.sqrt(np.mean(np.power(results[:, 9], 2)))
+
+        # id, x, y, ra, dec columns
+        if isinstance(objects_matrix, Table):
+            objects = np.column_stack(
+                [np.asarray(objects_matrix[col], dtype=float)
+                 for col in objects_matrix.colnames[:5]])
+        else:
+            objects = np.asarray(objects_matrix, dtype=float)[:, :5]
+
+        obj_id, obj_x, obj_y, obj_ra, obj_dec = objects.T
+
+        solution = self.plate_solve(math.degrees(ra_center),
+                                    math.degrees(dec_center),
+                                    obj_x,
+                                    obj_y,
+                                    obj_ra,
+                                    obj_dec,
+                                    order=1,
+                                    sigma=None,
+                                    crpix=(0, 0),
+                                    recenter=False)
+
+        if solution is False:
+            raise SystemExit
+
+        refs = np.column_stack((obj_id,
+                                obj_x,
+                                obj_y,
+                                obj_ra,
+                                obj_dec,
+                                solution['c_ra'],
+                                solution['c_dec'],
+                                solution['e_c_ra'],
+                                solution['e_c_dec'],
+                                solution['error'],
+                                obj_ra - solution['c_ra'],
+                                obj_dec - solution['c_dec']))
+
+        target_xy = np.asarray(target_xy, dtype=float).reshape(-1, 2)
+
+        targets = np.full((len(target_xy), refs.shape[1]), np.nan)
+        targets[:, 0] = np.arange(len(target_xy))
+        targets[:, 1] = target_xy[:, 0]
+        targets[:, 2] = target_xy[:, 1]
+        targets[:, 5], targets[:, 6] = self.plate_pix2world(
+            solution, target_xy[:, 0], target_xy[:, 1])
+
+        results = np.vstack((refs, targets))
 
         tb_results = Table(results, names=('id',
                                            'x',
@@ -750,16 +1835,17 @@ class AstCalc:
                                            'diff_dec'))
 
         return(tb_results,
-               rms_ra,
-               rms_dec,
-               rms_delta)
+               solution['rms_ra'],
+               solution['rms_dec'],
+               solution['rms_delta'])
 
-    """
     def ccmap(self, objects_matrix, image_path,
               ppm_parallax_cor=True,
-              stdout=False):
+              stdout=False,
+              order=1,
+              sigma=3.0):
 
-        
+        """
         Compute plate solutions using
         matched pixel and celestial coordinate lists.
         @param objects_matrix: Return of the match_catalog function
@@ -772,139 +1858,112 @@ class AstCalc:
         @type ppm_parallax_cor: boolean
         @param stdout: Print result as a STDOUT?
         @type stdout: boolean
-        @return: boolean, FITS image with WCS solutions
-
-        remove_nan = objects_matrix['x',
-                                    'y',
-                                    'ra',
-                                    'dec',
-                                    'plx',
-                                    'pmra',
-                                    'pmdec']
-
-        remove_nan = Table(remove_nan, masked=True)
-        for col in remove_nan.columns.values():
-            col.mask = np.isnan(col)
-            col.fill_value = 0.0
-
-        trimmed_om = remove_nan.filled()
-        
-        del objects_matrix
-        del remove_nan
-
-        if ppm_parallax_cor:
-            corrected_coords = []
-            fo = FitsOps(image_path)
-            odate = fo.get_header("date-obs")
-
-            for i in range(len(trimmed_om)):
-                ra_plx, dec_plx = self.stellar_parallax_cor(
-                    (trimmed_om['plx'][i] / 1000),
-                    trimmed_om['ra'][i],
-                    trimmed_om['dec'][i],
-                    odate)
-
-                cra_ppm, cdec_ppm = self.ppm_cor(trimmed_om['ra'][i],
-                                                 trimmed_om['dec'][i],
-                                                 trimmed_om['pmra'][i],
-                                                 trimmed_om['pmdec'][i],
-                                                 odate)
+        @param order: Polynomial order of the plate solution (1-4).
+        Orders above 1 are written as TAN-SIP.
+        @type order: int
+        @param sigma: Clipping limit of the reference stars.
+        If None, nothing is clipped.
+        @type sigma: float
+        @return: astropy.table, FITS image with WCS solutions
+        """
 
-                cra = cra_ppm + (ra_plx / 3600)
-                cdec = cdec_ppm + (dec_plx / 3600)
+        trimmed_om = {}
+        for col in ('x', 'y', 'ra', 'dec', 'plx', 'pmra', 'pmdec'):
+            trimmed_om[col] = np.asarray(objects_matrix[col], dtype=float)
+            if col in ('plx', 'pmra', 'pmdec'):
+                trimmed_om[col] = np.nan_to_num(trimmed_om[col])
 
-                corrected_coords.append([cra, cdec])
+        good = np.isfinite(trimmed_om['x']) & \
+            np.isfinite(trimmed_om['y']) & \
+            np.isfinite(trimmed_om['ra']) & \
+            np.isfinite(trimmed_om['dec'])
 
-            cra_cdec = Table(np.array(corrected_coords),
-                             names=("cra",
-                                    "cdec"))
+        for col in trimmed_om:
+            trimmed_om[col] = trimmed_om[col][good]
 
-            c = coordinates.SkyCoord(cra_cdec['cra'] * u.deg,
-                                     cra_cdec['cdec'] * u.deg, frame='icrs')
+        hdu = fits.open(image_path, mode='update')
+        header = hdu[0].header
 
+        if ppm_parallax_cor:
+            cra, cdec = self.ppm_parallax_cor(trimmed_om['ra'],
+                                              trimmed_om['dec'],
+                                              trimmed_om['pmra'],
+                                              trimmed_om['pmdec'],
+                                              trimmed_om['plx'],
+                                              header['date-obs'])
         else:
-            c = coordinates.SkyCoord(trimmed_om['ra'] * u.deg,
-                                     trimmed_om['dec'] * u.deg, frame='icrs')
-
-        rd = c.to_string('hmsdms', sep=":", precision=5)
-        radec = np.reshape(rd, (-1, 1))
-
-        iraf.digiphot(_doprint=0)
-        iraf.daophot(_doprint=0)
-
-        ra_dec = Column(name='ra_dec', data=radec[:, 0])
-        x_y = Table(trimmed_om['x', 'y'])
-
-        x_y.add_column(ra_dec, 0)
-        np.savetxt("{0}/coords".format(getcwd()), x_y, fmt='%s')
-
-        # InputCooList should have the following columns
-        SolutionsList = "{0}/solutions.txt".format(getcwd())
-
-        iraf.ccmap.setParam('images', image_path)
-        iraf.ccmap.setParam('input', "{0}/coords".format(getcwd()))
-        iraf.ccmap.setParam('database', SolutionsList)
-        iraf.ccmap.setParam('lngcolumn', 1)
-        iraf.ccmap.setParam('latcolumn', 2)
-        iraf.ccmap.setParam('xcolumn', 3)
-        iraf.ccmap.setParam('ycolumn', 4)
-        iraf.ccmap.setParam('results', "{0}/results".format(getcwd()))
-        iraf.ccmap.setParam('refsystem', 2015.0)
-        iraf.ccmap.setParam('insystem', 'icrs')
-        iraf.ccmap.setParam('update', 'yes')
-        iraf.ccmap(interactive='no')
-
-        system("rm -rf {0}/coords".format(getcwd()))
+            cra = trimmed_om['ra']
+            cdec = trimmed_om['dec']
+
+        # x, y of match_catalog are sep (0-based) coordinates
+        crpix = ((header['naxis1'] - 1) / 2.0,
+                 (header['naxis2'] - 1) / 2.0)
+
+        # tangent point is moved to crpix by plate_solve
+        solution = self.plate_solve(cra[0],
+                                    cdec[0],
+                                    trimmed_om['x'],
+                                    trimmed_om['y'],
+                                    cra,
+                                    cdec,
+                                    order=order,
+                                    sigma=sigma,
+                                    crpix=crpix,
+                                    origin=0)
+
+        if solution is False:
+            hdu.close()
+            raise SystemExit
 
-        return_list = []
-        
-        with open("{0}/results".format(getcwd())) as f:
-
-            for line in f:
-                if "Ra/Dec or Long/Lat fit rms:" in line:
-                    rms_ra_dec = line.split()
-                    rms_ra = rms_ra_dec[6]
-                    rms_dec = rms_ra_dec[7]
-                    return_list.append([rms_ra,
-                                        rms_dec,
-                                        "(arcsec  arcsec)"])
-
-                if "(hours  degrees)" in line:
-                    ref_point = line.split()
-                    ref_point_ra = ref_point[3]
-                    ref_point_dec = ref_point[4]
-                    return_list.append([ref_point_ra,
-                                        ref_point_dec,
-                                        "(hours  degrees)"])
-                if "(pixels  pixels)" in line:
-                    ref_point = line.split()
-                    ref_point_x = ref_point[3]
-                    ref_point_y = ref_point[4]
-                    return_list.append([ref_point_x,
-                                        ref_point_y,
-                                        "(pixels  pixels)"])
-                if "X and Y scale:" in line:
-                    pix_scale = line.split()
-                    pix_scale_x = pix_scale[5]
-                    pix_scale_y = pix_scale[6]
-                    return_list.append([pix_scale_x,
-                                        pix_scale_y,
-                                        "(arcsec/pixel  arcsec/pixel)"])
-                if "X and Y axis rotation:" in line:
-                    axis_rotation = line.split()
-                    axis_rotation_x = axis_rotation[6]
-                    axis_rotation_y = axis_rotation[7]
-                    return_list.append([axis_rotation_x,
-                                        axis_rotation_y,
-                                        "(degrees  degrees)"])
-                if "Ra/Dec or Long/Lat wcs rms:" in line:
-                    rms_ra_dec_wcs = line.split()
-                    rms_ra_wcs = rms_ra_dec_wcs[6]
-                    rms_dec_wcs = rms_ra_dec_wcs[7]
-                    return_list.append([rms_ra_wcs,
-                                        rms_dec_wcs,
-                                        "(arcsec  arcsec)"])
-        f.close()
+        wcs_header = self.plate_wcs_header(solution)
+
+        # old solutions (e.g. of astrometry.net) are removed
+        self.remove_wcs_keywords(header)
+        header.update(wcs_header)
+        hdu.flush()
+        hdu.close()
+
+        w = WCS(wcs_header)
+        w_ra, w_dec = w.all_pix2world(trimmed_om['x'], trimmed_om['y'], 0)
+        used = solution['used']
+        w_d_ra = ((w_ra - cra + 180.0) % 360.0 - 180.0) * \
+            np.cos(np.radians(cdec)) * 3600.0
+        w_d_dec = (w_dec - cdec) * 3600.0
+        wcs_rms_ra = np.sqrt(np.mean(np.power(w_d_ra[used], 2)))
+        wcs_rms_dec = np.sqrt(np.mean(np.power(w_d_dec[used], 2)))
+
+        cd = np.array([[wcs_header['CD1_1'], wcs_header['CD1_2']],
+                       [wcs_header['CD2_1'], wcs_header['CD2_2']]])
+        x_scale, y_scale = 3600.0 * np.hypot(cd[0], cd[1])
+        x_rot = math.degrees(math.atan2(cd[1, 0], cd[0, 0])) % 360.0
+        y_rot = math.degrees(math.atan2(-cd[0, 1], cd[1, 1])) % 360.0
+
+        ref_point = coordinates.SkyCoord(solution['crval'][0] * u.deg,
+                                         solution['crval'][1] * u.deg,
+                                         frame='icrs')
+        ref_ra = ref_point.ra.to_string(unit=u.hourangle, sep=':',
+                                        precision=3, pad=True)
+        ref_dec = ref_point.dec.to_string(sep=':', precision=2,
+                                          alwayssign=True, pad=True)
+
+        return_list = [["{0:.4g}".format(solution['rms_ra']),
+                        "{0:.4g}".format(solution['rms_dec']),
+                        "(arcsec  arcsec)"],
+                       [ref_ra,
+                        ref_dec,
+                        "(hours  degrees)"],
+                       ["{0:.3f}".format(wcs_header['CRPIX1']),
+                        "{0:.3f}".format(wcs_header['CRPIX2']),
+                        "(pixels  pixels)"],
+                       ["{0:.3f}".format(x_scale),
+                        "{0:.3f}".format(y_scale),
+                        "(arcsec/pixel  arcsec/pixel)"],
+                       ["{0:.3f}".format(x_rot),
+                        "{0:.3f}".format(y_rot),
+                        "(degrees  degrees)"],
+                       ["{0:.4g}".format(wcs_rms_ra),
+                        "{0:.4g}".format(wcs_rms_dec),
+                        "(arcsec  arcsec)"]]
 
         ccmap_result = Table(return_list,
                              names=("Ra/Dec or Long/Lat fit rms",
@@ -915,10 +1974,49 @@ class AstCalc:
                                     "Ra/Dec or Long/Lat wcs rms"))
 
         if stdout:
-            with open("{0}/results".format(getcwd())) as f:
-                results = f.read()
-                print(results)
-            f.close()
+            print("Image: {0}".format(image_path))
+            print("Coordinate mapping status")
+            print("    Matched objects: {0}  Used objects: {1}".format(
+                len(used), solution['n_used']))
+            print("    Ra/Dec or Long/Lat fit rms: {0}  {1}   {2}".format(
+                *return_list[0]))
+            print("Coordinate mapping parameters")
+            print("    Sky projection geometry: {0}".format(
+                "tan-sip" if order > 1 else "tan"))
+            print("    Reference point: {0}  {1}  {2}".format(
+                *return_list[1]))
+            print("    Reference point: {0}  {1}  {2}".format(
+                *return_list[2]))
+            print("    X and Y scale: {0}  {1}  {2}".format(
+                *return_list[3]))
+            print("    X and Y axis rotation: {0}  {1}  {2}".format(
+                *return_list[4]))
+            print("Wcs mapping status")
+            print("    Ra/Dec or Long/Lat wcs rms: {0}  {1}   {2}".format(
+                *return_list[5]))
+            print("")
+            print("# Input Coordinate Listing")
+            print("#     Column 1: X (pixels)")
+            print("#     Column 2: Y (pixels)")
+            print("#     Column 3: Ra / Longitude (degrees)")
+            print("#     Column 4: Dec / Latitude (degrees)")
+            print("#     Column 5: Fitted Ra / Longitude (degrees)")
+            print("#     Column 6: Fitted Dec / Latitude (degrees)")
+            print("#     Column 7: Residual Ra / Longitude (arcseconds)")
+            print("#     Column 8: Residual Dec / Latitude (arcseconds)")
+            print("#     Column 9: Used in the fit")
+            for i in range(len(used)):
+                print("{0:10.3f} {1:10.3f} {2:12.7f} {3:12.7f} "
+                      "{4:12.7f} {5:12.7f} {6:7.3f} {7:7.3f} {8}".format(
+                          trimmed_om['x'][i],
+                          trimmed_om['y'][i],
+                          cra[i],
+                          cdec[i],
+                          solution['c_ra'][i],
+                          solution['c_dec'][i],
+                          -solution['e_c_ra'][i],
+                          -solution['e_c_dec'][i],
+                          "yes" if used[i] else "no"))
 
         return(ccmap_result["Ra/Dec or Long/Lat fit rms",
                             "Ra/Dec or Long/Lat wcs rms",
@@ -926,75 +2024,148 @@ class AstCalc:
                             "Reference point (X, Y)",
                             "X and Y scale",
                             "X and Y axis rotation"])
-    """
 
     def ppm_cor(self, ra, dec, pmRA, pmDE, odate):
         """
         Compute stellar parallax corrections with given parameters.
         @param ra: RA coordinate of object (in degrees).
-        @type ra: float
+        @type ra: float or array
         @param dec: DEC coordinate of object (in degrees).
-        @type dec: float
+        @type dec: float or array
         @param pmRA: Proper motion in right ascension µ_α* of
         the source in ICRS at the reference epoch Epoch.
         This is the projection of the proper motion vector
         in the direction of increasing right ascension (in milliarcsec)
-        @type pmRA: float
+        @type pmRA: float or array
         @param pmDE: Proper motion in declination direction (in milliarcsec)
-        @type pmDE: float
+        @type pmDE: float or array
         @param odate: Observation time of the frame.
         @type odate: date
         @return: list
         """
 
-        ra = math.radians(ra)
-        dec = math.radians(dec)
+        ra = np.radians(ra)
+        dec = np.radians(dec)
 
-        mu_ra = math.radians(pmRA / 3600000) / math.cos(dec)
+        mu_ra = np.radians(np.asarray(pmRA) / 3600000) / np.cos(dec)
 
-        to = TimeOps()
-        t0 = to.date2mjd("2015-01-01 00:00:00.000000")
-        t = to.date2mjd(odate)
+        t0 = epoch_mjd("2015-01-01 00:00:00.000000")
+        t = epoch_mjd(str(odate))
 
         cra = ra + ((t - t0) / 365.2568983) * mu_ra
-        cdec = dec + ((t - t0) / 365.2568983) * math.radians(pmDE / 3600000)
+        cdec = dec + ((t - t0) / 365.2568983) * np.radians(
+            np.asarray(pmDE) / 3600000)
 
-        return(math.degrees(cra),
-               math.degrees(cdec))
+        return(np.degrees(cra),
+               np.degrees(cdec))
     
     def stellar_parallax_cor(self, parallax, ra, dec, odate):
         """
         Compute stellar parallax corrections with given parameters.
         @param parallax: Parallax value in gaia catalogue in (arcsec)
-        @type parallax: float
+        @type parallax: float or array
         @param ra: RA coordinate of object (in degrees).
-        @type ra: float
+        @type ra: float or array
         @param dec: DEC coordinate of object (in degrees).
-        @type dec: float
+        @type dec: float or array
         @param odate: Observation time of the frame.
         @type odate: date
         @return: list
         """
 
-        ra = math.radians(ra)
-        dec = math.radians(dec)
+        ra = np.radians(ra)
+        dec = np.radians(dec)
+        parallax = np.asarray(parallax)
 
-        t = Time(odate)
-        xyz = get_body_barycentric('earth', t, ephemeris='de432s')
-        
-        x = xyz.x.to(u.au)
-        y = xyz.y.to(u.au)
-        z = xyz.z.to(u.au)
+        x, y, z = earth_barycentric(str(odate))
 
-        delta_ra = (parallax * (x * math.sin(ra) -
-                                y * math.cos(ra))) / math.cos(dec)
+        delta_ra = (parallax * (x * np.sin(ra) -
+                                y * np.cos(ra))) / np.cos(dec)
 
-        delta_dec = parallax * ((x * math.cos(ra) + y * math.sin(ra)) *
-                                math.sin(dec) - z * math.cos(dec))
+        delta_dec = parallax * ((x * np.cos(ra) + y * np.sin(ra)) *
+                                np.sin(dec) - z * np.cos(dec))
 
         # in arcsec
-        return(delta_ra.value,
-               delta_dec.value)
+        return(delta_ra,
+               delta_dec)
+
+    def ppm_parallax_cor(self, ra, dec, pmra, pmdec, plx, odate):
+
+        """
+        Proper motion and stellar parallax corrected coordinates of
+        many stars observed at the same epoch. Missing (NaN) proper
+        motions and parallaxes are taken as zero.
+        @param ra: RA coordinates (in degrees).
+        @type ra: array
+        @param dec: DEC coordinates (in degrees).
+        @type dec: array
+        @param pmra: Proper motions in right ascension µ_α* (in milliarcsec)
+        @type pmra: array
+        @param pmdec: Proper motions in declination (in milliarcsec)
+        @type pmdec: array
+        @param plx: Parallaxes (in milliarcsec)
+        @type plx: array
+        @param odate: Observation time of the frame.
+        @type odate: date
+        @return: tuple (ra, dec arrays in degrees)
+        """
+
+        ra = np.asarray(ra, dtype=float)
+        dec = np.asarray(dec, dtype=float)
+        pmra = np.nan_to_num(np.asarray(pmra, dtype=float))
+        pmdec = np.nan_to_num(np.asarray(pmdec, dtype=float))
+        plx = np.nan_to_num(np.asarray(plx, dtype=float))
+
+        ra_plx, dec_plx = self.stellar_parallax_cor(plx / 1000,
+                                                    ra,
+                                                    dec,
+                                                    odate)
+
+        cra_ppm, cdec_ppm = self.ppm_cor(ra, dec, pmra, pmdec, odate)
+
+        return(cra_ppm + (ra_plx / 3600),
+               cdec_ppm + (dec_plx / 3600))
+
+    def ppm_parallax_cor_table(self, table, odate,
+                               ra="ra",
+                               dec="dec",
+                               pmra="pmra",
+                               pmdec="pmdec",
+                               plx="plx"):
+
+        """
+        Proper motion and stellar parallax corrections of a catalogue
+        table (e.g. a Gaia cutout).
+        @param table: Catalogue table.
+        @type table: astropy.table
+        @param odate: Observation time of the frame.
+        @type odate: date
+        @param ra: RA column (in degrees).
+        @type ra: str
+        @param dec: DEC column (in degrees).
+        @type dec: str
+        @param pmra: Proper motion in RA column (in milliarcsec).
+        @type pmra: str
+        @param pmdec: Proper motion in DEC column (in milliarcsec).
+        @type pmdec: str
+        @param plx: Parallax column (in milliarcsec).
+        @type plx: str
+        @return: astropy.table with cra, cdec columns
+        """
+
+        cra, cdec = self.ppm_parallax_cor(np.ma.filled(table[ra], np.nan),
+                                          np.ma.filled(table[dec], np.nan),
+                                          np.ma.filled(table[pmra], np.nan),
+                                          np.ma.filled(table[pmdec],
+                                                       np.nan),
+                                          np.ma.filled(table[plx], np.nan),
+                                          odate)
+
+        corrected = Table(table, copy=False)
+        corrected['cra'] = cra
+        corrected['cdec'] = cdec
+
+        return(corrected)
 
 
 class TimeOps:
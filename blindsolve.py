@@ -0,0 +1,961 @@
+# -*- coding: utf-8 -*-
+
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+from astropy.coordinates import SkyCoord
+from astropy import units as u
+from scipy.spatial import cKDTree
+from .astronomy import AstCalc
+from collections import OrderedDict
+import numpy as np
+import sep
+import glob
+import json
+import math
+import os
+import time
+
+
+# arcsec in a radian
+ARCSEC = 180.0 * 3600.0 / math.pi
+
+
+class BlindSolver:
+
+    # unbinned pixel scales (arcsec/pixel) of TUG telescopes
+    # T100: 1 m f/10 with 15 micron pixels
+    # T60: 0.6 m f/10.5 with 15 micron pixels
+    pixel_scales = {"T100": 0.309, "T60": 0.491}
+
+    # a ratio error of hash_tol counts as a size error of 5 hash_tol
+    feature_weights = np.array([1.0, 1.0, 0.2])
+
+    def __init__(self,
+                 tile_dir,
+                 max_mag=18.0,
+                 max_sources=40,
+                 n_neighbours=6,
+                 hash_tol=0.01,
+                 scale_tol=0.05,
+                 match_radius=2.0,
+                 min_matches=8,
+                 max_hypotheses=1000,
+                 max_tiles=64):
+
+        """
+        Blind plate solver for narrow fields with a known pixel scale.
+        Triangles of the brightest sources are matched to triangles of
+        Gaia stars (read from local tiles of gaiacut.sh) with a KD-tree
+        on their shape and size. Triangles of a tile are made once and
+        kept next to its index. A match is verified by projecting all
+        sources, and the WCS is fitted with AstCalc.plate_solve.
+        @param tile_dir: Directory of the Gaia tiles (FITS tables with
+        ra, dec and phot_g_mean_mag columns).
+        @type tile_dir: path
+        @param max_mag: Limit G magnitude of the reference stars.
+        @type max_mag: float
+        @param max_sources: Number of the brightest sources to be used.
+        @type max_sources: int
+        @param n_neighbours: Triangles are made of a star and two of
+        its n_neighbours nearest neighbours.
+        @type n_neighbours: int
+        @param hash_tol: Tolerance of the triangle side ratios.
+        @type hash_tol: float
+        @param scale_tol: Tolerance of the pixel scale (fraction).
+        @type scale_tol: float
+        @param match_radius: Match radius of verification (in arcsec).
+        @type match_radius: float
+        @param min_matches: Minimum number of the matched stars.
+        @type min_matches: int
+        @param max_hypotheses: Maximum number of the verified triangle
+        matches of a search region.
+        @type max_hypotheses: int
+        @param max_tiles: Number of the tiles (and of their triangles)
+        kept in memory, the least recently used ones are released.
+        @type max_tiles: int
+        """
+
+        self.tile_dir = tile_dir
+        self.max_mag = max_mag
+        self.max_sources = max_sources
+        self.n_neighbours = n_neighbours
+        self.hash_tol = hash_tol
+        self.scale_tol = scale_tol
+        self.match_radius = match_radius
+        self.min_matches = min_matches
+        self.max_hypotheses = max_hypotheses
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+        self.tile_triangles = OrderedDict()
+        self.index = None
+        self.ac = AstCalc()
+
+    def tile_index(self, refresh=False):
+
+        """
+        Sky caps of the Gaia tiles, loaded once with a KD-tree of their
+        centers. The index is kept in the tile directory (tiles.json);
+        tiles added or changed since it was written are indexed again,
+        and files without a Gaia table are skipped. Stars read for the
+        index are not kept in memory.
+        @param refresh: Check the tile directory again?
+        @type refresh: boolean
+        @return: dict (file: [ra, dec, radius] in degrees)
+        """
+
+        if self.index is not None and not refresh:
+            return(self.index)
+
+        index_file = os.path.join(self.tile_dir, "tiles.json")
+
+        stored = {}
+        if os.path.exists(index_file):
+            with open(index_file) as f_handle:
+                stored = json.load(f_handle)
+
+        # [ra, dec, radius, size, mtime], ra is None for non-tiles
+        entries = {}
+        for tile_file in sorted(glob.glob(os.path.join(self.tile_dir,
+                                                       "*.fits"))):
+            name = os.path.basename(tile_file)
+            stat = os.stat(tile_file)
+            entry = stored.get(name)
+
+            if entry is not None and len(entry) == 5 and \
+                    entry[3:] == [stat.st_size, stat.st_mtime]:
+                entries[name] = entry
+                continue
+
+            self.tiles.pop(tile_file, None)
+            for key in [key for key in self.tile_triangles
+                        if key[0] == tile_file]:
+                del self.tile_triangles[key]
+            try:
+                ra, dec, mag = self.load_tile(tile_file)
+            except (IndexError, KeyError, AttributeError, OSError):
+                entries[name] = [None, None, None,
+                                 stat.st_size, stat.st_mtime]
+                continue
+
+            if len(ra) == 0:
+                entries[name] = [None, None, None,
+                                 stat.st_size, stat.st_mtime]
+                continue
+
+            vectors = self.unit_vectors(ra, dec)
+            center = vectors.mean(axis=0)
+            center /= np.linalg.norm(center)
+            radius = np.degrees(np.arccos(np.clip(
+                np.min(vectors @ center), -1, 1)))
+
+            entries[name] = [
+                math.degrees(math.atan2(center[1], center[0])) % 360.0,
+                math.degrees(math.asin(center[2])),
+                float(radius),
+                stat.st_size,
+                stat.st_mtime]
+
+        if entries != stored:
+            tmp_file = "{0}.{1}.tmp".format(index_file, os.getpid())
+            with open(tmp_file, 'w') as f_handle:
+                json.dump(entries, f_handle)
+            os.replace(tmp_file, index_file)
+
+        self.index = {name: entry[:3] for name, entry in entries.items()
+                      if entry[0] is not None}
+        self.index_files = list(self.index.keys())
+
+        caps = np.array([self.index[name] for name in self.index_files],
+                        dtype=float).reshape(-1, 3)
+        self.index_tree = cKDTree(self.unit_vectors(caps[:, 0],
+                                                    caps[:, 1]))
+        self.index_radii = caps[:, 2]
+
+        return(self.index)
+
+    def load_tile(self, tile_file):
+
+        """
+        Reference stars of a Gaia tile, read from the file.
+        @param tile_file: Gaia tile.
+        @type tile_file: path
+        @return: tuple (ra, dec, mag arrays)
+        """
+
+        data = fits.getdata(tile_file, 1)
+        names = {name.lower(): name for name in data.columns.names}
+
+        ra = np.asarray(data[names.get('ra', 'RA_ICRS')], dtype=float)
+        dec = np.asarray(data[names.get('dec', 'DE_ICRS')], dtype=float)
+        mag = np.asarray(data[names['phot_g_mean_mag']], dtype=float)
+
+        keep = np.isfinite(ra) & np.isfinite(dec) & (mag <= self.max_mag)
+
+        return(ra[keep], dec[keep], mag[keep])
+
+    def tile_stars(self, tile_file):
+
+        """
+        Reference stars of a Gaia tile with their unit vectors. The
+        max_tiles most recently used tiles are kept in memory.
+        @param tile_file: Gaia tile.
+        @type tile_file: path
+        @return: tuple (ra, dec, mag arrays, unit vectors)
+        """
+
+        if tile_file in self.tiles:
+            self.tiles.move_to_end(tile_file)
+        else:
+            ra, dec, mag = self.load_tile(tile_file)
+            self.tiles[tile_file] = (ra, dec, mag,
+                                     self.unit_vectors(ra, dec))
+            while len(self.tiles) > self.max_tiles:
+                self.tiles.popitem(last=False)
+
+        return(self.tiles[tile_file])
+
+    def read_tile(self, tile_file):
+
+        """
+        Reference stars of a Gaia tile (kept in memory).
+        @param tile_file: Gaia tile.
+        @type tile_file: path
+        @return: tuple (ra, dec, mag arrays)
+        """
+
+        return(self.tile_stars(tile_file)[:3])
+
+    def triangle_file(self, tile_file, cell, n_cell):
+
+        """
+        File of the triangles of a tile, <tile root>_tri_<cell>_<n_cell>.npz
+        next to tiles.json.
+        @param tile_file: Gaia tile.
+        @type tile_file: path
+        @param cell: Cell size of the brightest stars (in arcsec).
+        @type cell: float
+        @param n_cell: Number of the stars kept in a cell.
+        @type n_cell: int
+        @return: path
+        """
+
+        root = os.path.splitext(os.path.basename(tile_file))[0]
+
+        return(os.path.join(self.tile_dir, "{0}_tri_{1:.1f}_{2}.npz".format(
+            root, cell, n_cell)))
+
+    def triangle_index(self, tile_file, cell, n_cell):
+
+        """
+        Triangles of the brightest stars of a tile with a KD-tree of
+        their features. They are made on the tangent plane of the tile
+        center once, written next to tiles.json and made again only
+        when the tile changes.
+        @param tile_file: Gaia tile.
+        @type tile_file: path
+        @param cell: Cell size of the brightest stars (in arcsec).
+        @type cell: float
+        @param n_cell: Number of the stars kept in a cell.
+        @type n_cell: int
+        @return: tuple (star indices of the tile [triangle, 3],
+        features [triangle, 3], KD-tree of the weighted features)
+        """
+
+        key = (tile_file, round(cell, 1), n_cell)
+
+        if key in self.tile_triangles:
+            self.tile_triangles.move_to_end(key)
+            return(self.tile_triangles[key])
+
+        stat = os.stat(tile_file)
+        stamp = np.array([stat.st_size, stat.st_mtime, round(cell, 1),
+                          n_cell], dtype=float)
+        index_file = self.triangle_file(tile_file, cell, n_cell)
+
+        vertices = None
+        if os.path.exists(index_file):
+            with np.load(index_file) as stored:
+                if np.array_equal(stored['stamp'], stamp):
+                    vertices = stored['vertices']
+                    features = stored['features']
+
+        if vertices is None:
+            ra, dec, mag = self.read_tile(tile_file)
+            tile_ra, tile_dec = self.index[os.path.basename(tile_file)][:2]
+
+            xx, yy = self.ac.equ2std_array(math.radians(tile_ra),
+                                           math.radians(tile_dec),
+                                           np.radians(ra),
+                                           np.radians(dec))
+            # xi is -xx
+            points = np.column_stack((-xx, yy)) * ARCSEC
+
+            vertices = np.empty((0, 3), dtype=int)
+            features = np.empty((0, 3))
+            if len(points) > 0:
+                kept = self.brightest_per_cell(points, mag, cell, n_cell)
+                vertices, features = self.triangles(points[kept])
+                vertices = kept[vertices]
+
+            try:
+                tmp_file = "{0}.{1}.tmp.npz".format(
+                    os.path.splitext(index_file)[0], os.getpid())
+                np.savez(tmp_file, stamp=stamp, vertices=vertices,
+                         features=features)
+                os.replace(tmp_file, index_file)
+            except OSError:
+                # read-only tile directories are indexed in memory only
+                pass
+
+        tree = None
+        if len(features) > 0:
+            tree = cKDTree(features * self.feature_weights)
+
+        self.tile_triangles[key] = (vertices, features, tree)
+        while len(self.tile_triangles) > self.max_tiles:
+            self.tile_triangles.popitem(last=False)
+
+        return(self.tile_triangles[key])
+
+    def unit_vectors(self, ra, dec):
+
+        """
+        Unit vectors of sky coordinates.
+        @param ra: RA coordinates [deg].
+        @type ra: array
+        @param dec: DEC coordinates [deg].
+        @type dec: array
+        @return: numpy array [object, 3]
+        """
+
+        ra = np.radians(ra)
+        dec = np.radians(dec)
+
+        return(np.column_stack((np.cos(dec) * np.cos(ra),
+                                np.cos(dec) * np.sin(ra),
+                                np.sin(dec))))
+
+    def region_tiles(self, ra0, dec0, radius):
+
+        """
+        Gaia tiles that overlap a sky region.
+        @param ra0: RA of the region center [deg].
+        @type ra0: float
+        @param dec0: DEC of the region center [deg].
+        @type dec0: float
+        @param radius: Radius of the region [deg].
+        @type radius: float
+        @return: list of paths
+        """
+
+        center = self.unit_vectors(ra0, dec0)[0]
+        self.tile_index()
+
+        if len(self.index_files) == 0:
+            return([])
+
+        # tiles whose center is within the region plus the largest tile,
+        # chord length of the angle on the unit sphere
+        reach = min(radius + self.index_radii.max(), 180.0)
+        near = self.index_tree.query_ball_point(
+            center, 2 * math.sin(math.radians(reach) / 2) + 1e-12)
+
+        tiles = []
+        for i in sorted(near):
+            tile_center = self.index_tree.data[i]
+            distance = math.degrees(math.acos(
+                np.clip(center @ tile_center, -1, 1)))
+            if distance <= radius + self.index_radii[i]:
+                tiles.append(os.path.join(self.tile_dir,
+                                          self.index_files[i]))
+
+        return(tiles)
+
+    def region_stars(self, ra0, dec0, radius):
+
+        """
+        Reference stars in a sky region.
+        @param ra0: RA of the region center [deg].
+        @type ra0: float
+        @param dec0: DEC of the region center [deg].
+        @type dec0: float
+        @param radius: Radius of the region [deg].
+        @type radius: float
+        @return: tuple (ra, dec, mag arrays)
+        """
+
+        center = self.unit_vectors(ra0, dec0)[0]
+
+        stars = []
+        for tile_file in self.region_tiles(ra0, dec0, radius):
+            ra, dec, mag, vectors = self.tile_stars(tile_file)
+            inside = vectors @ center >= math.cos(math.radians(radius))
+            stars.append((ra[inside], dec[inside], mag[inside]))
+
+        if len(stars) == 0:
+            return(np.empty(0), np.empty(0), np.empty(0))
+
+        return(tuple(np.concatenate(columns) for columns in zip(*stars)))
+
+    def search_regions(self, field_radius, ra=None, dec=None,
+                       search_radius=2.0):
+
+        """
+        Centers of the sky regions to be searched. Regions overlap so
+        that a field is completely in one of them.
+        @param field_radius: Radius of the field [deg].
+        @type field_radius: float
+        @param ra: RA of the field hint [deg]. If None, all sky.
+        @type ra: float
+        @param dec: DEC of the field hint [deg]. If None, all sky.
+        @type dec: float
+        @param search_radius: Search radius around the hint [deg].
+        @type search_radius: float
+        @return: tuple (region radius, list of (ra, dec))
+        """
+
+        region_radius = max(4 * field_radius, 0.5)
+        spacing = math.sqrt(2) * (region_radius - field_radius)
+
+        if ra is not None and dec is not None:
+            n_steps = int(math.ceil(search_radius / spacing))
+            steps = np.arange(-n_steps, n_steps + 1) * spacing
+            xi, eta = [grid.ravel() for grid in np.meshgrid(steps, steps)]
+            near = np.hypot(xi, eta) <= search_radius + spacing
+            order = np.argsort(np.hypot(xi[near], eta[near]),
+                              kind='stable')
+            c_ra, c_dec = self.ac.std2equ_array(math.radians(ra),
+                                                math.radians(dec),
+                                                -np.radians(xi[near][order]),
+                                                np.radians(eta[near][order]))
+        else:
+            # Fibonacci sphere
+            n_regions = int(math.ceil(4 * math.pi /
+                                      math.radians(spacing) ** 2))
+            i = np.arange(n_regions) + 0.5
+            c_dec = np.arcsin(1 - 2 * i / n_regions)
+            c_ra = np.pi * (1 + 5 ** 0.5) * i
+
+        return(region_radius,
+               list(zip(np.degrees(c_ra) % 360.0, np.degrees(c_dec))))
+
+    def triangles(self, points):
+
+        """
+        Triangles of a star and two of its nearest neighbours.
+        Vertices are ordered by their opposite sides (shortest first).
+        @param points: Plane coordinates of stars.
+        @type points: numpy array [star, 2]
+        @return: tuple (vertex indices [triangle, 3], features
+        [triangle, 3] (a/c, b/c, log c))
+        """
+
+        n_points = len(points)
+        if n_points < 3:
+            return(np.empty((0, 3), dtype=int), np.empty((0, 3)))
+
+        k = min(self.n_neighbours, n_points - 1)
+        neighbours = cKDTree(points).query(points, k=k + 1)[1][:, 1:]
+
+        pairs = np.array([(i, j) for i in range(k) for j in range(i + 1, k)])
+        if len(pairs) == 0:
+            return(np.empty((0, 3), dtype=int), np.empty((0, 3)))
+
+        vertices = np.column_stack((
+            np.repeat(np.arange(n_points), len(pairs)),
+            neighbours[:, pairs[:, 0]].ravel(),
+            neighbours[:, pairs[:, 1]].ravel()))
+        vertices = np.unique(np.sort(vertices, axis=1), axis=0)
+
+        p = points[vertices]
+        # side i is opposite to vertex i
+        sides = np.column_stack((
+            np.hypot(*(p[:, 1] - p[:, 2]).T),
+            np.hypot(*(p[:, 0] - p[:, 2]).T),
+            np.hypot(*(p[:, 0] - p[:, 1]).T)))
+
+        order = np.argsort(sides, axis=1)
+        sides = np.take_along_axis(sides, order, axis=1)
+        vertices = np.take_along_axis(vertices, order, axis=1)
+
+        good = sides[:, 0] > 0
+        sides = sides[good]
+
+        features = np.column_stack((sides[:, 0] / sides[:, 2],
+                                    sides[:, 1] / sides[:, 2],
+                                    np.log(sides[:, 2])))
+
+        return(vertices[good], features)
+
+    def brightest_per_cell(self, points, mag, cell, n_cell):
+
+        """
+        Brightest stars of every cell of a grid, to match the density
+        of the detected sources.
+        @param points: Plane coordinates of stars.
+        @type points: numpy array [star, 2]
+        @param mag: Magnitudes of stars.
+        @type mag: array
+        @param cell: Cell size.
+        @type cell: float
+        @param n_cell: Number of the stars kept in a cell.
+        @type n_cell: int
+        @return: numpy array (indices of the kept stars)
+        """
+
+        cells = np.floor(points / cell).astype(np.int64)
+        codes = (cells[:, 0] - cells[:, 0].min()) * \
+            (cells[:, 1].max() - cells[:, 1].min() + 1) + \
+            (cells[:, 1] - cells[:, 1].min())
+
+        order = np.lexsort((mag, codes))
+        sorted_codes = codes[order]
+        starts = np.searchsorted(sorted_codes, sorted_codes)
+        rank = np.arange(len(order)) - starts
+
+        return(order[rank < n_cell])
+
+    def detect(self, data):
+
+        """
+        Brightest sources of an image.
+        @param data: Image data.
+        @type data: numpy array
+        @return: tuple (x, y arrays, 0-based)
+        """
+
+        data = np.ascontiguousarray(data, dtype=float)
+        bkg = sep.Background(data)
+        objects = sep.extract(data - bkg, 5, err=bkg.globalrms)
+        objects = objects[np.argsort(objects['flux'])[::-1]]
+
+        return(objects['x'], objects['y'])
+
+    def verify(self, x, y, cat_points, cat_tree, pixel_scale,
+               image_tri, cat_tri):
+
+        """
+        Verifies a triangle match. The affine transform of the
+        triangle is checked against the pixel scale, and all sources
+        are projected to be matched with the reference stars.
+        @param x: X coordinates of sources.
+        @type x: array
+        @param y: Y coordinates of sources.
+        @type y: array
+        @param cat_points: Plane coordinates of reference stars (arcsec).
+        @type cat_points: numpy array [star, 2]
+        @param cat_tree: KD-tree of cat_points.
+        @type cat_tree: scipy.spatial.cKDTree
+        @param pixel_scale: Pixel scale (arcsec/pixel).
+        @type pixel_scale: float
+        @param image_tri: Source indices of the triangle.
+        @type image_tri: array
+        @param cat_tri: Reference star indices of the triangle.
+        @type cat_tri: array
+        @return: tuple (source indices, reference star indices) or None
+        """
+
+        design = np.column_stack((x[image_tri], y[image_tri], np.ones(3)))
+
+        try:
+            transform = np.linalg.solve(design, cat_points[cat_tri])
+        except np.linalg.LinAlgError:
+            return(None)
+
+        scales = np.linalg.svd(transform[:2], compute_uv=False)
+        if np.any(np.abs(scales / pixel_scale - 1) > self.scale_tol):
+            return(None)
+
+        projected = np.column_stack((x, y, np.ones(len(x)))) @ transform
+        distance, idx = cat_tree.query(projected,
+                                       distance_upper_bound=self.match_radius)
+        matched = np.isfinite(distance)
+
+        # a reference star is matched once
+        cat_idx, first = np.unique(idx[matched], return_index=True)
+        src_idx = np.flatnonzero(matched)[first]
+
+        if len(src_idx) < self.min_matches:
+            return(None)
+
+        return(src_idx, cat_idx)
+
+    def solve_data(self, data, pixel_scale, ra=None, dec=None,
+                   search_radius=2.0, order=1):
+
+        """
+        Blind plate solution of image data.
+        @param data: Image data.
+        @type data: numpy array
+        @param pixel_scale: Pixel scale (arcsec/pixel).
+        @type pixel_scale: float
+        @param ra: RA of the field hint [deg]. If None, all sky.
+        @type ra: float
+        @param dec: DEC of the field hint [deg]. If None, all sky.
+        @type dec: float
+        @param search_radius: Search radius around the hint [deg].
+        @type search_radius: float
+        @param order: Polynomial order of the plate solution (1-4).
+        @type order: int
+        @return: dict (return of the AstCalc.plate_solve) or False
+        """
+
+        ny, nx = data.shape
+        crpix = ((nx - 1) / 2.0, (ny - 1) / 2.0)
+        field_radius = math.hypot(nx, ny) / 2.0 * pixel_scale / 3600.0
+        field_width = min(nx, ny) * pixel_scale
+
+        all_x, all_y = self.detect(data)
+        x = all_x[:self.max_sources]
+        y = all_y[:self.max_sources]
+
+        if len(x) < self.min_matches:
+            return(False)
+
+        image_vertices, image_features = self.triangles(
+            np.column_stack((x, y)) * pixel_scale)
+        if len(image_vertices) == 0:
+            return(False)
+
+        image_features = image_features * self.feature_weights
+
+        # density of the brightest sources, 4 cells in a field width;
+        # the triangles of the tiles are shared by the fields of a camera
+        cell = field_width / 2
+        n_cell = int(math.ceil(1.5 * self.max_sources * cell ** 2 /
+                               (nx * ny * pixel_scale ** 2)))
+
+        region_radius, regions = self.search_regions(field_radius,
+                                                     ra=ra,
+                                                     dec=dec,
+                                                     search_radius=search_radius)
+
+        # triangle matches of a tile are shared by its regions
+        tile_matches = {}
+
+        for region_ra, region_dec in regions:
+            center = self.unit_vectors(region_ra, region_dec)[0]
+
+            stars = []
+            hypotheses = []
+            n_stars = 0
+            for tile_file in self.region_tiles(region_ra, region_dec,
+                                               region_radius):
+                t_ra, t_dec, t_mag, vectors = self.tile_stars(tile_file)
+                inside = vectors @ center >= \
+                    math.cos(math.radians(region_radius))
+                stars.append((t_ra[inside], t_dec[inside]))
+
+                if tile_file not in tile_matches:
+                    vertices, features, tree = self.triangle_index(
+                        tile_file, cell, n_cell)
+                    if tree is None:
+                        tile_matches[tile_file] = None
+                    else:
+                        distance, idx = tree.query(
+                            image_features,
+                            k=4,
+                            distance_upper_bound=self.hash_tol)
+                        found = np.argwhere(np.isfinite(distance))
+                        tile_matches[tile_file] = (
+                            distance[found[:, 0], found[:, 1]],
+                            found[:, 0],
+                            vertices[idx[found[:, 0], found[:, 1]]])
+
+                if tile_matches[tile_file] is not None:
+                    # tile stars to region stars, -1 outside the region
+                    region_idx = np.full(len(t_ra), -1)
+                    region_idx[inside] = n_stars + np.arange(
+                        np.count_nonzero(inside))
+                    t_distance, image_idx, cat_idx = \
+                        tile_matches[tile_file]
+                    cat_idx = region_idx[cat_idx]
+                    good = np.all(cat_idx >= 0, axis=1)
+                    hypotheses.append((t_distance[good], image_idx[good],
+                                       cat_idx[good]))
+
+                n_stars += np.count_nonzero(inside)
+
+            if n_stars < self.min_matches or len(hypotheses) == 0:
+                continue
+
+            cat_ra, cat_dec = [np.concatenate(columns)
+                               for columns in zip(*stars)]
+            h_distance, h_image, h_cat = [np.concatenate(columns)
+                                          for columns in zip(*hypotheses)]
+            ranked = np.argsort(h_distance,
+                                kind='stable')[:self.max_hypotheses]
+
+            xx, yy = self.ac.equ2std_array(math.radians(region_ra),
+                                           math.radians(region_dec),
+                                           np.radians(cat_ra),
+                                           np.radians(cat_dec))
+            # xi is -xx
+            cat_points = np.column_stack((-xx, yy)) * ARCSEC
+            cat_tree = cKDTree(cat_points)
+
+            for i in ranked:
+                match = self.verify(x, y, cat_points, cat_tree,
+                                    pixel_scale,
+                                    image_vertices[h_image[i]],
+                                    h_cat[i])
+                if match is None:
+                    continue
+
+                src_idx, cat_idx = match
+                solution = self.ac.plate_solve(region_ra,
+                                               region_dec,
+                                               x[src_idx],
+                                               y[src_idx],
+                                               cat_ra[cat_idx],
+                                               cat_dec[cat_idx],
+                                               order=1,
+                                               crpix=crpix,
+                                               origin=0)
+                if solution is False:
+                    continue
+
+                # all sources are matched with the first solution
+                solution = self.refit(solution, all_x, all_y,
+                                      cat_ra, cat_dec, order, crpix)
+                if solution is not False and \
+                        solution['n_used'] >= self.min_matches:
+                    return(solution)
+
+        return(False)
+
+    def refit(self, solution, x, y, cat_ra, cat_dec, order, crpix):
+
+        """
+        Fits the plate again with all sources matched by a solution.
+        @param solution: Return of the AstCalc.plate_solve.
+        @type solution: dict
+        @param x: X coordinates of sources.
+        @type x: array
+        @param y: Y coordinates of sources.
+        @type y: array
+        @param cat_ra: RA coordinates of reference stars [deg].
+        @type cat_ra: array
+        @param cat_dec: DEC coordinates of reference stars [deg].
+        @type cat_dec: array
+        @param order: Polynomial order of the plate solution (1-4).
+        @type order: int
+        @param crpix: Reference pixel (x, y), 0-based.
+        @type crpix: tuple
+        @return: dict (return of the AstCalc.plate_solve) or False
+        """
+
+        s_ra, s_dec = self.ac.plate_pix2world(solution, x, y)
+        center_ra, center_dec = solution['crval']
+
+        xx, yy = self.ac.equ2std_array(math.radians(center_ra),
+                                       math.radians(center_dec),
+                                       np.radians(cat_ra),
+                                       np.radians(cat_dec))
+        cat_tree = cKDTree(np.column_stack((-xx, yy)) * ARCSEC)
+
+        xx, yy = self.ac.equ2std_array(math.radians(center_ra),
+                                       math.radians(center_dec),
+                                       np.radians(s_ra),
+                                       np.radians(s_dec))
+        distance, idx = cat_tree.query(np.column_stack((-xx, yy)) * ARCSEC,
+                                       distance_upper_bound=self.match_radius)
+        matched = np.isfinite(distance)
+        cat_idx, first = np.unique(idx[matched], return_index=True)
+        src_idx = np.flatnonzero(matched)[first]
+
+        return(self.ac.plate_solve(center_ra,
+                                   center_dec,
+                                   x[src_idx],
+                                   y[src_idx],
+                                   cat_ra[cat_idx],
+                                   cat_dec[cat_idx],
+                                   order=order,
+                                   crpix=crpix,
+                                   origin=0))
+
+    def pixel_scale(self, header, telescope=None):
+
+        """
+        Pixel scale of an image from the telescope and the binning.
+        @param header: FITS header.
+        @type header: astropy.io.fits.Header
+        @param telescope: Telescope name (T100 or T60).
+        @type telescope: str
+        @return: float (arcsec/pixel)
+        """
+
+        if telescope not in self.pixel_scales:
+            print("Pixel scale of {0} is unknown!".format(telescope))
+            raise SystemExit
+
+        return(self.pixel_scales[telescope] * header.get('xbinning', 1))
+
+    def solve(self,
+              image_path,
+              pixel_scale=None,
+              telescope=None,
+              ra=None,
+              dec=None,
+              search_radius=2.0,
+              order=1,
+              ra_keyword="objctra",
+              dec_keyword="objctdec",
+              write=True):
+
+        """
+        Blind plate solution of a FITS image. The header coordinates
+        are used as a hint when they exist.
+        @param image_path: FITS image file name with path
+        @type image_path: str
+        @param pixel_scale: Pixel scale (arcsec/pixel). If None, it is
+        found from the telescope.
+        @type pixel_scale: float
+        @param telescope: Telescope name (T100 or T60).
+        @type telescope: str
+        @param ra: RA of field center, format: degrees or hh:mm:ss
+        @type ra: str
+        @param dec: DEC of field center, format: degrees or dd:mm:ss
+        @type dec: str
+        @param search_radius: Search radius around the hint [deg].
+        @type search_radius: float
+        @param order: Polynomial order of the plate solution (1-4).
+        @type order: int
+        @param ra_keyword: RA keyword in the FITS image header
+        @type ra_keyword: str
+        @param dec_keyword: DEC keyword in the FITS image header
+        @type dec_keyword: str
+        @param write: Write the solved image as <root>_new.fits?
+        @type write: boolean
+        @return: dict (image, solved, output, wcs, n_matches, rms,
+        shape, elapsed, error)
+        """
+
+        start = time.time()
+        result = {"image": image_path,
+                  "solved": False,
+                  "output": None,
+                  "wcs": None,
+                  "n_matches": 0,
+                  "rms": None,
+                  "shape": None,
+                  "elapsed": 0.0,
+                  "error": None}
+
+        hdu = fits.open(image_path)
+        data = hdu[0].data
+        header = hdu[0].header
+        hdu.close()
+
+        result["shape"] = data.shape
+
+        if pixel_scale is None:
+            pixel_scale = self.pixel_scale(header, telescope)
+
+        if ra is None and dec is None:
+            ra = header.get(ra_keyword)
+            dec = header.get(dec_keyword)
+
+        if ra is not None and dec is not None:
+            ra = str(ra).strip().replace(" ", ":")
+            dec = str(dec).strip().replace(" ", ":")
+            unit = (u.hourangle, u.deg) if ":" in ra else (u.deg, u.deg)
+            hint = SkyCoord(ra, dec, unit=unit, frame='icrs')
+            ra = hint.ra.degree
+            dec = hint.dec.degree
+
+        solution = self.solve_data(data, pixel_scale,
+                                   ra=ra,
+                                   dec=dec,
+                                   search_radius=search_radius,
+                                   order=order)
+
+        if solution is False:
+            result["error"] = "not solved"
+        else:
+            wcs_header = self.ac.plate_wcs_header(solution)
+            result.update({"solved": True,
+                           "wcs": wcs_header,
+                           "n_matches": solution['n_used'],
+                           "rms": solution['rms_delta']})
+            if write:
+                result["output"] = self.ac.apply_wcs(image_path,
+                                                     wcs_header)
+
+        result["elapsed"] = time.time() - start
+
+        return(result)
+
+    def benchmark(self, image_paths, pixel_scale=None, telescope=None,
+                  timeout=300):
+
+        """
+        Latency and success rate of the blind solver against
+        astrometry.net's solve-field on the same images. Blind
+        solutions are not written; solve-field writes <root>_new.fits
+        as solve_field_job does.
+        @param image_paths: FITS image file names with path, or a
+        glob pattern.
+        @type image_paths: list or str
+        @param pixel_scale: Pixel scale (arcsec/pixel).
+        @type pixel_scale: float
+        @param telescope: Telescope name (T100 or T60).
+        @type telescope: str
+        @param timeout: Time limit of a solve-field job (in seconds).
+        @type timeout: float
+        @return: astropy.table (per image), dict (summary)
+        """
+
+        if isinstance(image_paths, str):
+            image_paths = sorted(glob.glob(image_paths))
+
+        rows = []
+        for image_path in image_paths:
+            blind = self.solve(image_path,
+                               pixel_scale=pixel_scale,
+                               telescope=telescope,
+                               write=False)
+            job = self.ac.solve_field_job(image_path, timeout=timeout)
+
+            # center difference of the two solutions
+            offset = np.nan
+            if blind["solved"] and job["wcs"] is not None:
+                ny, nx = blind["shape"]
+                centers = [WCS(header).celestial.pixel_to_world(
+                    (nx - 1) / 2.0, (ny - 1) / 2.0)
+                    for header in (blind["wcs"], job["wcs"])]
+                offset = centers[0].separation(centers[1]).arcsec
+
+            rows.append((image_path,
+                         blind["solved"],
+                         blind["elapsed"],
+                         blind["n_matches"],
+                         job["solved"],
+                         job["elapsed"],
+                         offset))
+
+        results = Table(rows=rows,
+                        names=('image', 'blind_solved', 'blind_time',
+                               'blind_matches', 'solve_field_solved',
+                               'solve_field_time', 'center_offset'))
+
+        summary = {}
+        for name in ("blind", "solve_field"):
+            solved = np.asarray(results["{0}_solved".format(name)],
+                                dtype=bool)
+            times = np.asarray(results["{0}_time".format(name)],
+                               dtype=float)
+            summary[name] = {
+                "success_rate": float(np.mean(solved)) if len(solved) else
+                np.nan,
+                "median_time": float(np.median(times)) if len(times) else
+                np.nan,
+                "median_time_solved": float(np.median(times[solved]))
+                if np.any(solved) else np.nan}
+
+            print("{0}: {1:.1%} solved, median {2:.3f} s".format(
+                name, summary[name]["success_rate"],
+                summary[name]["median_time"]))
+
+        return(results, summary)
@@ -2,11 +2,22 @@ from astroquery.vizier import Vizier
 import astropy.units as u
 import astropy.coordinates as coord
 from astropy.table import Table
+from astropy.io import fits
+from astropy.nddata import Cutout2D
+from astropy.wcs import WCS
 from .io import FileOps
 from .astronomy import FitsOps
+from .astronomy import AstCalc
 from .astronomy import TimeOps
 import numpy as np
 import sep
+import os
+import json
+import time
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict
 from os import system
 
 
@@ -184,20 +195,24 @@ class Query:
                 to = TimeOps()
                 fo = FileOps()
                 epoch = to.date2jd(odate) + time_travel / 24.0
+                # private result file, so parallel queries do not collide
+                cat_fd, cat_file = tempfile.mkstemp(suffix="_skybot.cat")
+                os.close(cat_fd)
                 bashcmd = ("wget -q \"http://vo.imcce.fr/webservices/skybot/"
                            "skybotconesearch_query.php"
                            "?-ep={0}&-ra={1}&-dec={2}&-rm={3}&-output=object&"
                            "-loc={4}&-filter=120&-objFilter=120&-from="
-                           "SkybotDoc&-mime=text\" -O skybot.cat").format(
+                           "SkybotDoc&-mime=text\" -O {5}").format(
                                epoch,
                                ra,
                                dec,
                                radius,
-                               observatory)
+                               observatory,
+                               cat_file)
 
                 system(bashcmd)
-                skyresult = fo.read_file_as_array("skybot.cat")
-                system('rm -rf skybot.cat')
+                skyresult = fo.read_file_as_array(cat_file)
+                os.remove(cat_file)
                 if "No solar system object was found" not in str(skyresult):
                     tskyresult = Table(skyresult,
                                        names=('num',
@@ -270,24 +285,440 @@ class Query:
     #sorts list of stars (puts the best for being comparise stars in the first place)
     def sort_stars(self, starstable, min_mag):
 
-        starstable = starstable[starstable['Rmag'] > min_mag]
+        """
+        Sorts stars by their color distance to the solar colors
+        (B-V=0.656, V-R=0.4), the best comparison star first.
+        Stars without B, V or R magnitudes are dropped.
+        @param starstable: Return of the query_color.
+        @type starstable: astropy.table
+        @param min_mag: Brightest R magnitude limit.
+        @type min_mag: float
+        @return: astropy.table
+        """
+
+        # scoring of the whole catalogue at once
+        mags = [np.ma.filled(np.ma.asarray(starstable[band], dtype=float),
+                             0.0)
+                for band in ('Bmag', 'Vmag', 'Rmag')]
+        bmag, vmag, rmag = mags
+
+        keep = ((rmag > min_mag) &
+                (bmag != 0) & (vmag != 0) & (rmag != 0))
+
+        if not np.any(keep):
+            print("No proper comparison star(s) found!")
+            raise SystemExit
+
+        starstable = Table(starstable).filled()[keep]
+        for band, mag in zip(('Bmag', 'Vmag', 'Rmag'), mags):
+            starstable[band] = mag[keep]
+
+        b_v = bmag[keep] - vmag[keep]
+        v_r = vmag[keep] - rmag[keep]
+
+        starstable['b-v'] = b_v
+        starstable['v-r'] = v_r
+        starstable['sortby'] = np.abs(b_v - 0.656) + np.abs(v_r - 0.4)
+
+        return(starstable[np.argsort(starstable['sortby'], kind='stable')])
+
+
+class CompCatalog:
+
+    # field catalogues of the session, shared by all instances
+    fields = {}
+
+    # pixel positions of comparison stars for each frame's WCS,
+    # shared by all instances and bounded to max_pixels frames
+    pixel_memo = OrderedDict()
+    pixel_lock = threading.Lock()
+    max_pixels = 256
+
+    def __init__(self, cache_dir=None):
+
+        """
+        Comparison star catalogue of fields. A field is queried and
+        sorted once per night; colors and sort keys are kept with it.
+        @param cache_dir: Directory where field catalogues are kept
+        between sessions. If None, they are only kept in memory.
+        @type cache_dir: path
+        """
+
+        self.cache_dir = cache_dir
+
+    def field_key(self, ra, dec, onight, radius, min_mag, max_mag):
+
+        """
+        Key of a field catalogue.
+        @param ra: RA of field center (in degrees).
+        @type ra: float
+        @param dec: DEC of field center (in degrees).
+        @type dec: float
+        @param onight: Observation night.
+        @type onight: str
+        @param radius: Radius (in degrees).
+        @type radius: float
+        @param min_mag: Brightest R magnitude limit.
+        @type min_mag: float
+        @param max_mag: Faintest R magnitude limit.
+        @type max_mag: float
+        @return: str
+        """
+
+        return("{0}_{1:.4f}_{2:+.4f}_{3:.4f}_{4:.2f}_{5:.2f}".format(
+            str(onight)[:10], float(ra), float(dec), float(radius),
+            float(min_mag), float(max_mag)))
 
-        starstable['Bmag'].fill_value = 0.0
-        starstable['Vmag'].fill_value = 0.0
-        starstable['Rmag'].fill_value = 0.0
+    def get(self, ra, dec, onight,
+            radius=5.0 / 60.0,
+            min_mag=10,
+            max_mag=19.5):
 
-        starstable = starstable.filled()
-        starstable = starstable[starstable['Bmag'] != 0]
-        starstable = starstable[starstable['Vmag'] != 0]
-        starstable = starstable[starstable['Rmag'] != 0]
+        """
+        Sorted comparison stars of a field. NOMAD is only queried
+        for a field that is not in the memory or disk cache.
+        @param ra: RA of field center (in degrees).
+        @type ra: float
+        @param dec: DEC of field center (in degrees).
+        @type dec: float
+        @param onight: Observation night.
+        @type onight: str
+        @param radius: Radius (in degrees).
+        @type radius: float
+        @param min_mag: Brightest R magnitude limit.
+        @type min_mag: float
+        @param max_mag: Faintest R magnitude limit.
+        @type max_mag: float
+        @return: astropy.table (Query.sort_stars columns)
+        """
+
+        key = self.field_key(ra, dec, onight, radius, min_mag, max_mag)
 
-        starstable['b-v'] = starstable['Bmag'] - starstable['Vmag']
-        starstable['v-r'] = starstable['Vmag'] - starstable['Rmag']
-        starstable['sortby'] = abs(starstable['b-v'] -
-                                   0.656) + abs(starstable['v-r'] - 0.4)
+        if key in self.fields:
+            return(self.fields[key])
 
-        if len(starstable) > 0:
-            return(Table(np.sort(starstable, order=['sortby'])))
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir,
+                                      "comp_{0}.ecsv".format(key))
+
+        if cache_file is not None and os.path.exists(cache_file):
+            comptable = Table.read(cache_file, format='ascii.ecsv')
         else:
-            print("No proper comparison star(s) found!")
+            sb = Query()
+            comptable = sb.sort_stars(sb.query_color(ra,
+                                                     dec,
+                                                     radius,
+                                                     min_mag=min_mag,
+                                                     max_mag=max_mag),
+                                      min_mag)
+            if cache_file is not None:
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                comptable.write(cache_file, format='ascii.ecsv',
+                                overwrite=True)
+
+        self.fields[key] = comptable
+
+        return(comptable)
+
+    def pixels(self, comptable, w, naxis1, naxis2, fitsfile=None):
+
+        """
+        Pixel positions of comparison stars on a frame, computed
+        in one call. Positions are memoised for each frame's WCS
+        (keyed by the frame path and modification time, or by the
+        WCS header if no path is given) and the comparison stars,
+        so every asteroid of the frame shares them.
+        @param comptable: Return of the get.
+        @type comptable: astropy.table
+        @param w: WCS of the frame.
+        @type w: astropy.wcs.WCS
+        @param naxis1: NAXIS1 of the frame.
+        @type naxis1: int
+        @param naxis2: NAXIS2 of the frame.
+        @type naxis2: int
+        @param fitsfile: FITS image file name with path.
+        @type fitsfile: str
+        @return: tuple (x, y, on_frame mask)
+        """
+
+        ra = np.asarray(comptable['RAJ2000'], dtype=float)
+        dec = np.asarray(comptable['DEJ2000'], dtype=float)
+
+        stars = hashlib.sha1(ra.tobytes() + dec.tobytes()).hexdigest()
+
+        if fitsfile is not None and os.path.exists(fitsfile):
+            frame = (os.path.abspath(fitsfile),
+                     os.stat(fitsfile).st_mtime_ns)
+        else:
+            frame = hashlib.sha1(
+                w.to_header_string().encode()).hexdigest()
+
+        key = (frame, stars, int(naxis1), int(naxis2))
+
+        with self.pixel_lock:
+            if key in self.pixel_memo:
+                self.pixel_memo.move_to_end(key)
+                return(self.pixel_memo[key])
+
+        pos = AstCalc().sky2pix(w, ra, dec, naxis1, naxis2)
+
+        with self.pixel_lock:
+            self.pixel_memo[key] = pos
+            while len(self.pixel_memo) > self.max_pixels:
+                self.pixel_memo.popitem(last=False)
+
+        return(pos)
+
+
+class CutoutCache:
+
+    def __init__(self, cache_dir=None, max_bytes=1024 ** 3):
+
+        """
+        Disk cache of SkyView survey cutouts. A request is served by any
+        cached cutout of the same survey that covers it; larger cutouts
+        are cut down with Cutout2D. The least recently used cutouts are
+        evicted when the cache grows over max_bytes.
+        @param cache_dir: Cache directory. If None, ~/.astrolib/cutouts
+        is used.
+        @type cache_dir: path
+        @param max_bytes: Maximum size of the cache (in bytes).
+        @type max_bytes: int
+        """
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'),
+                                     '.astrolib', 'cutouts')
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_file = os.path.join(cache_dir, 'index.json')
+
+    def read_index(self):
+
+        """
+        Cached cutouts.
+        @return: list of dicts (file, survey, ra, dec, radius, size,
+        last_used)
+        """
+
+        if not os.path.exists(self.index_file):
+            return([])
+
+        try:
+            with open(self.index_file) as f_handle:
+                entries = json.load(f_handle)
+        except ValueError:
+            return([])
+
+        # files removed by hand are forgotten
+        return([entry for entry in entries if os.path.exists(
+            os.path.join(self.cache_dir, entry['file']))])
+
+    def write_index(self, entries):
+
+        """
+        Writes the cached cutout list.
+        @param entries: Return of the read_index.
+        @type entries: list
+        @return: boolean
+        """
+
+        tmp_file = "{0}.tmp".format(self.index_file)
+        with open(tmp_file, 'w') as f_handle:
+            json.dump(entries, f_handle)
+
+        os.replace(tmp_file, self.index_file)
+
+        return(True)
+
+    def find(self, entries, co, radius, survey):
+
+        """
+        Smallest cached cutout covering a field.
+        @param entries: Return of the read_index.
+        @type entries: list
+        @param co: Center of the field.
+        @type co: astropy.coordinates.SkyCoord
+        @param radius: Radius of the field (in arcmin).
+        @type radius: float
+        @param survey: Survey name.
+        @type survey: str
+        @return: dict or None
+        """
+
+        entries = [entry for entry in entries if entry['survey'] == survey]
+
+        if len(entries) == 0:
+            return(None)
+
+        centers = coord.SkyCoord([entry['ra'] for entry in entries],
+                                 [entry['dec'] for entry in entries],
+                                 unit=(u.deg, u.deg),
+                                 frame='icrs')
+        sep_arcmin = co.separation(centers).arcmin
+        radii = np.array([entry['radius'] for entry in entries])
+
+        # cutouts are squares of half width radius
+        covers = sep_arcmin + radius <= radii + 1e-6
+
+        if not np.any(covers):
+            return(None)
+
+        candidates = np.flatnonzero(covers)
+        return(entries[candidates[np.argmin(radii[candidates])]])
+
+    def get(self, co, radius, survey='DSS'):
+
+        """
+        Survey cutout of a field from the cache, or from SkyView
+        when no cached cutout covers it.
+        @param co: Center of the field.
+        @type co: astropy.coordinates.SkyCoord
+        @param radius: Radius of the field (in arcmin).
+        @type radius: float
+        @param survey: Survey name.
+        @type survey: str
+        @return: astropy.io.fits.PrimaryHDU
+        """
+
+        entries = self.read_index()
+        entry = self.find(entries, co, radius, survey)
+
+        if entry is None:
+            entry = self.download(co, radius, survey)
+            entries = self.read_index()
+        else:
+            for cached in entries:
+                if cached['file'] == entry['file']:
+                    cached['last_used'] = time.time()
+            self.write_index(entries)
+
+        hdu = fits.open(os.path.join(self.cache_dir, entry['file']))[0]
+
+        if entry['radius'] <= radius + 1e-6 and \
+                co.separation(coord.SkyCoord(entry['ra'], entry['dec'],
+                                             unit=(u.deg, u.deg),
+                                             frame='icrs')).arcsec < 1:
+            return(hdu)
+
+        # a larger cutout is cut down to the request
+        cutout = Cutout2D(hdu.data,
+                          position=co,
+                          size=2 * radius * u.arcmin,
+                          wcs=WCS(hdu.header),
+                          mode='trim')
+        header = hdu.header.copy()
+        header.update(cutout.wcs.to_header())
+
+        return(fits.PrimaryHDU(cutout.data, header=header))
+
+    def download(self, co, radius, survey='DSS'):
+
+        """
+        Downloads a cutout from SkyView into the cache.
+        @param co: Center of the field.
+        @type co: astropy.coordinates.SkyCoord
+        @param radius: Radius of the field (in arcmin).
+        @type radius: float
+        @param survey: Survey name.
+        @type survey: str
+        @return: dict (cache entry)
+        """
+
+        from astroquery.skyview import SkyView
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        try:
+            server_img = SkyView.get_images(position=co,
+                                            survey=[survey],
+                                            radius=radius * u.arcmin)
+            hdu = server_img[0][0]
+        except Exception as e:
+            print("SkyView could not get the image from {0} server.".format(
+                survey))
+            print(e)
             raise SystemExit
+
+        file_name = "{0}_{1:.5f}_{2:+.5f}_{3:.2f}.fits".format(
+            survey.replace(' ', '_'), co.ra.degree, co.dec.degree,
+            float(radius))
+        hdu.writeto(os.path.join(self.cache_dir, file_name), overwrite=True)
+
+        entry = {"file": file_name,
+                 "survey": survey,
+                 "ra": co.ra.degree,
+                 "dec": co.dec.degree,
+                 "radius": float(radius),
+                 "size": os.path.getsize(os.path.join(self.cache_dir,
+                                                      file_name)),
+                 "last_used": time.time()}
+
+        entries = [cached for cached in self.read_index()
+                   if cached['file'] != file_name]
+        entries.append(entry)
+        self.write_index(self.evict(entries, keep=file_name))
+
+        return(entry)
+
+    def evict(self, entries, keep=None):
+
+        """
+        Removes the least recently used cutouts until the cache
+        fits in max_bytes.
+        @param entries: Return of the read_index.
+        @type entries: list
+        @param keep: File that is never evicted.
+        @type keep: str
+        @return: list of kept entries
+        """
+
+        entries = sorted(entries, key=lambda entry: entry['last_used'])
+        total = sum(entry['size'] for entry in entries)
+
+        kept = []
+        for entry in entries:
+            if total > self.max_bytes and entry['file'] != keep:
+                os.remove(os.path.join(self.cache_dir, entry['file']))
+                total -= entry['size']
+            else:
+                kept.append(entry)
+
+        return(kept)
+
+    def prefetch(self, targets, radius=6, survey='DSS'):
+
+        """
+        Warms the cache for a target list, e.g. the targets of a night.
+        @param targets: Target coordinates, (ra, dec) pairs in
+        "HH MM SS" and "+DD MM SS" formats, or a file with one
+        "HH MM SS +DD MM SS" target per line.
+        @type targets: list or path
+        @param radius: Radius of the fields (in arcmin).
+        @type radius: float
+        @param survey: Survey name.
+        @type survey: str
+        @return: int, number of downloaded cutouts
+        """
+
+        if isinstance(targets, str):
+            with open(targets) as f_handle:
+                lines = [line.split() for line in f_handle
+                         if line.strip() and not line.startswith('#')]
+            targets = [(' '.join(line[:3]), ' '.join(line[3:6]))
+                       for line in lines]
+
+        n_downloaded = 0
+        for ra, dec in targets:
+            co = coord.SkyCoord('{0} {1}'.format(ra, dec),
+                                unit=(u.hourangle, u.deg),
+                                frame='icrs')
+            if self.find(self.read_index(), co, radius, survey) is None:
+                self.download(co, radius, survey)
+                n_downloaded += 1
+
+        return(n_downloaded)
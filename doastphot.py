@@ -1,6 +1,7 @@
 from astrolib import astronomy
 from astrolib import photometry
 from astrolib import visuals
+from astrolib.io import WCSCache
 import glob
 import sys
 import os
@@ -31,10 +32,16 @@ if filter != "--plot-lc":
     if not "--skip-astrometry" in sys.argv:
         ac = astronomy.AstCalc()
         print("Astrometry başladı!")
-        fitsfiles = glob.glob("./atmp/bf_*.fit?")
-    
-        for fitsfile in fitsfiles:
-            ac.solve_field(fitsfile)
+        fitsfiles = sorted(glob.glob("./atmp/bf_*.fit?"))
+
+        # frames solved before are not solved again
+        wcs_cache = WCSCache()
+
+        if "--sequence" in sys.argv:
+            # refine the WCS of the previous frame, blind solve if fails
+            ac.solve_field_sequence(fitsfiles, wcs_cache=wcs_cache)
+        else:
+            ac.solve_field_batch(fitsfiles, wcs_cache=wcs_cache)
     # photometry
     if not "--skip-photometry" in sys.argv:
         ap = photometry.PhotOps()
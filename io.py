@@ -1,10 +1,22 @@
 # -*- coding: utf-8 -*-
 
+import fcntl
 import glob
+import hashlib
+import json
+import struct
 import numpy as np
 import paramiko
 import os
+import queue
 import sqlite3
+import threading
+import warnings
+import zipfile
+from astropy.io import fits
+from astropy.table import Table
+from astropy.utils.exceptions import AstropyWarning
+from astropy.wcs import WCS
 from .astronomy import FitsOps
 from datetime import datetime
 
@@ -340,3 +352,900 @@ class FileOps:
             print(e)
 
         return (ret)
+
+
+# Column types of the asteroids_phot results
+PHOT_DTYPE = np.dtype([('ast_num', 'U10'),
+                       ('jd', 'f8'),
+                       ('onight', 'U10'),
+                       ('magt_i', 'f8'),
+                       ('magt_i_err', 'f8'),
+                       ('magc_i', 'f8'),
+                       ('magc_i_err', 'f8'),
+                       ('magt', 'f8'),
+                       ('magt_err', 'f8'),
+                       ('ast_mag_cat', 'f8'),
+                       ('nomad1', 'U20'),
+                       ('star_Rmag', 'f8'),
+                       ('magt_avr', 'f8'),
+                       ('magt_std', 'f8'),
+                       ('filter', 'U20'),
+                       ('exposure', 'f8')])
+
+
+class ResultSink:
+
+    def __init__(self, out_dir=None,
+                 batch_size=10000,
+                 ascii_export=True,
+                 key='ast_num',
+                 dtype=PHOT_DTYPE):
+
+        """
+        Buffered writer of photometry results. Rows are kept in typed
+        buffers per target and flushed in batches to <out_dir>/<target>.npz
+        with one array per column (np.savez, uncompressed), so readers
+        can memory-map only the columns they use. A result file is
+        replaced atomically, an interrupted write leaves the previous
+        one intact.
+        @param out_dir: Output directory. If None, cwd is used.
+        @type out_dir: path
+        @param batch_size: Number of buffered rows of a target
+        that triggers a flush. If None, rows are only written by flush.
+        @type batch_size: int
+        @param ascii_export: Export <out_dir>/<target>.txt on close?
+        @type ascii_export: boolean
+        @param key: Column that names the target of a row.
+        @type key: str
+        @param dtype: Column types of the results.
+        @type dtype: numpy.dtype
+        """
+
+        if out_dir is None:
+            out_dir = os.getcwd()
+
+        self.out_dir = out_dir
+        self.batch_size = batch_size
+        self.ascii_export = ascii_export
+        self.key = key
+        self.dtype = np.dtype(dtype)
+        self.buffers = {}
+        self.n_buffered = {}
+        self.touched = set()
+
+    def npz_path(self, target):
+
+        """
+        Columnar result file of a target.
+        @param target: Target name.
+        @type target: str
+        @return: path
+        """
+
+        return(os.path.join(self.out_dir, "{0}.npz".format(target)))
+
+    def txt_path(self, target):
+
+        """
+        ASCII result file of a target.
+        @param target: Target name.
+        @type target: str
+        @return: path
+        """
+
+        return(os.path.join(self.out_dir, "{0}.txt".format(target)))
+
+    def append(self, table):
+
+        """
+        Buffers result rows, flushing the targets whose buffer is full.
+        @param table: Result rows with the columns of dtype.
+        @type table: astropy.table or numpy structured array
+        @return: int, number of buffered rows
+        """
+
+        records = np.empty(len(table), dtype=self.dtype)
+        for name in self.dtype.names:
+            records[name] = table[name]
+
+        for target in np.unique(records[self.key]):
+            target_records = records[records[self.key] == target]
+            target = str(target)
+
+            if target not in self.touched:
+                self._import_ascii(target)
+                self.touched.add(target)
+
+            self.buffers.setdefault(target, []).append(target_records)
+            self.n_buffered[target] = (self.n_buffered.get(target, 0) +
+                                       len(target_records))
+
+            if self.batch_size is not None and \
+                    self.n_buffered[target] >= self.batch_size:
+                self.flush(target)
+
+        return(len(records))
+
+    def flush(self, target=None):
+
+        """
+        Writes buffered rows to the columnar result files.
+        @param target: Target to be flushed. If None, all targets.
+        @type target: str
+        @return: dict, number of rows on disk of flushed targets
+        """
+
+        if target is None:
+            targets = list(self.buffers.keys())
+        else:
+            targets = [target]
+
+        counts = {}
+        for target in targets:
+            chunks = self.buffers.pop(target, [])
+            self.n_buffered.pop(target, None)
+
+            if len(chunks) == 0:
+                counts[target] = self.count(target)
+                continue
+
+            counts[target] = self._append_npz(self.npz_path(target),
+                                              np.concatenate(chunks))
+
+        return(counts)
+
+    def close(self):
+
+        """
+        Flushes all buffers and exports ASCII tables if requested.
+        @return: list of the written targets
+        """
+
+        self.flush()
+
+        targets = sorted(self.touched)
+        if self.ascii_export:
+            for target in targets:
+                self.export_ascii(target)
+
+        return(targets)
+
+    def count(self, target):
+
+        """
+        Number of rows of a target on disk.
+        @param target: Target name.
+        @type target: str
+        @return: int
+        """
+
+        if not os.path.exists(self.npz_path(target)):
+            return(0)
+
+        return(len(self.read_file(self.npz_path(target),
+                                  columns=[self.dtype.names[0]])))
+
+    def read(self, target, mmap=True):
+
+        """
+        Reads results of a target.
+        @param target: Target name.
+        @type target: str
+        @param mmap: Memory-map the columns instead of reading?
+        @type mmap: boolean
+        @return: astropy.table
+        """
+
+        return(self.read_file(self.npz_path(target), mmap=mmap))
+
+    def read_file(self, file_name, columns=None, mmap=True):
+
+        """
+        Reads the columns of a result file (<target>.npz). Columns are
+        memory-mapped from the archive, only the used ones are read.
+        @param file_name: Result file.
+        @type file_name: path
+        @param columns: Columns to be read. If None, all columns.
+        @type columns: list
+        @param mmap: Memory-map the columns instead of reading?
+        @type mmap: boolean
+        @return: astropy.table
+        """
+
+        with zipfile.ZipFile(file_name) as archive:
+            members = {os.path.splitext(info.filename)[0]: info
+                       for info in archive.infolist()}
+
+        if columns is None:
+            columns = list(members.keys())
+
+        arrays = []
+        with open(file_name, 'rb') as f_handle:
+            for name in columns:
+                info = members[name]
+
+                if info.compress_type != zipfile.ZIP_STORED:
+                    with np.load(file_name) as npz:
+                        arrays.append(npz[name])
+                    continue
+
+                # data of a stored member follows its local file header
+                f_handle.seek(info.header_offset + 26)
+                name_len, extra_len = struct.unpack('<HH', f_handle.read(4))
+                f_handle.seek(info.header_offset + 30 + name_len + extra_len)
+
+                version = np.lib.format.read_magic(f_handle)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = \
+                        np.lib.format.read_array_header_1_0(f_handle)
+                else:
+                    shape, fortran_order, dtype = \
+                        np.lib.format.read_array_header_2_0(f_handle)
+
+                if not mmap or int(np.prod(shape)) == 0:
+                    arrays.append(np.fromfile(
+                        f_handle, dtype=dtype,
+                        count=int(np.prod(shape))).reshape(shape))
+                else:
+                    arrays.append(np.memmap(file_name, dtype=dtype,
+                                            mode='r', shape=shape,
+                                            offset=f_handle.tell()))
+
+        return(Table(arrays, names=columns, copy=False))
+
+    def truncate(self, target, n_rows):
+
+        """
+        Drops the rows of a target after the first n_rows. The ASCII
+        table of a truncated target is exported again on close.
+        @param target: Target name.
+        @type target: str
+        @param n_rows: Number of rows to be kept.
+        @type n_rows: int
+        @return: int, number of rows on disk
+        """
+
+        file_name = self.npz_path(target)
+
+        if not os.path.exists(file_name):
+            return(0)
+
+        self.touched.add(target)
+
+        table = self.read(target, mmap=False)
+
+        if n_rows >= len(table):
+            return(len(table))
+
+        self._write_npz(file_name, {name: np.asarray(table[name][:n_rows])
+                                    for name in table.colnames})
+
+        return(n_rows)
+
+    def export_ascii(self, target):
+
+        """
+        Writes all results of a target to <out_dir>/<target>.txt
+        in the ascii.commented_header format.
+        @param target: Target name.
+        @type target: str
+        @return: path
+        """
+
+        table = self.read(target, mmap=False)
+
+        for col in table.colnames:
+            if col.startswith('mag'):
+                table[col].format = '.3f'
+
+        table.write(self.txt_path(target),
+                    format='ascii.commented_header',
+                    overwrite=True)
+
+        return(self.txt_path(target))
+
+    def _import_ascii(self, target):
+
+        # results of the older runs only exist as ASCII tables
+        if os.path.exists(self.npz_path(target)) or \
+                not os.path.exists(self.txt_path(target)):
+            return(0)
+
+        old = Table.read(self.txt_path(target),
+                         format='ascii.commented_header')
+
+        records = np.empty(len(old), dtype=self.dtype)
+        for name in self.dtype.names:
+            records[name] = old[name]
+
+        return(self._append_npz(self.npz_path(target), records))
+
+    def _write_npz(self, file_name, columns):
+
+        tmp_file = "{0}.tmp".format(file_name)
+        with open(tmp_file, 'wb') as f_handle:
+            np.savez(f_handle, **columns)
+            f_handle.flush()
+            os.fsync(f_handle.fileno())
+
+        os.replace(tmp_file, file_name)
+
+    def _append_npz(self, file_name, records):
+
+        records = np.asarray(records, dtype=self.dtype)
+
+        if os.path.exists(file_name):
+            old = self.read_file(file_name, mmap=False)
+            columns = {name: np.concatenate((np.asarray(old[name]),
+                                             records[name]))
+                       for name in self.dtype.names}
+        else:
+            columns = {name: records[name] for name in self.dtype.names}
+
+        self._write_npz(file_name, columns)
+
+        return(len(columns[self.dtype.names[0]]))
+
+
+class DBWriter:
+
+    def __init__(self, sqlite_file="observations",
+                 table_name="asteroids",
+                 columns=None,
+                 unique=('ast_num', 'jd', 'nomad1'),
+                 indexes=(('ast_num',), ('jd',)),
+                 batch_size=5000,
+                 threaded=True):
+
+        """
+        Persistent SQLite3 writer. Rows are inserted with parameterized
+        executemany batches over one WAL mode connection, from a writer
+        thread unless threaded is False. Table and indexes are created
+        on first use. After a failed insert the writer takes no more
+        rows; write, flush and close raise the error.
+        @param sqlite_file: SQLite3 database file.
+        @type sqlite_file: path
+        @param table_name: SQLite3 database table.
+        @type table_name: str
+        @param columns: Column names of the table. If None, the columns
+        of the asteroids_phot results are used.
+        @type columns: list
+        @param unique: Columns of the unique index. Repeated rows are ignored.
+        @type unique: tuple
+        @param indexes: Column groups of the other indexes.
+        @type indexes: tuple
+        @param batch_size: Number of rows in an executemany batch.
+        @type batch_size: int
+        @param threaded: Write from a background thread?
+        @type threaded: boolean
+        """
+
+        if columns is None:
+            columns = list(PHOT_DTYPE.names)
+
+        self.sqlite_file = sqlite_file
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.unique = unique
+        self.indexes = indexes
+        self.batch_size = batch_size
+        self.threaded = threaded
+
+        for name in [table_name] + self.columns:
+            if '"' in name:
+                raise ValueError("Invalid SQL identifier: {0}".format(name))
+
+        self.conn = None
+        self.error = None
+        self.n_dropped = 0
+        self.queue = queue.Queue()
+
+        if threaded:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        else:
+            self.thread = None
+
+    def write(self, table):
+
+        """
+        Queues rows of a table for writing.
+        @param table: Rows with (at least) the columns of the writer.
+        @type table: astropy.table or numpy structured array
+        @return: int, number of queued rows
+        """
+
+        self._raise_error()
+
+        rows = [tuple(row) for row in
+                zip(*[np.asarray(table[col]).tolist()
+                      for col in self.columns])]
+
+        if self.threaded:
+            self.queue.put(rows)
+        else:
+            self._insert(rows)
+
+        return(len(rows))
+
+    def flush(self):
+
+        """
+        Waits until all queued rows are committed.
+        @return: boolean
+        """
+
+        if self.threaded:
+            self.queue.join()
+
+        self._raise_error()
+
+        return(True)
+
+    def close(self):
+
+        """
+        Commits the queued rows and closes the connection.
+        @return: boolean
+        """
+
+        if self.threaded and self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        elif self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+        self._raise_error()
+
+        return(True)
+
+    def _raise_error(self):
+
+        # a failed writer does not accept rows any more
+        if self.error is not None:
+            print("{0} rows were not written to {1}!".format(
+                self.n_dropped, self.sqlite_file))
+            raise self.error
+
+    def _connect(self):
+
+        self.conn = sqlite3.connect(self.sqlite_file)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        types = dict((name, PHOT_DTYPE[name].kind)
+                     for name in PHOT_DTYPE.names)
+
+        col_defs = ', '.join(
+            '"{0}" {1}'.format(col, {'f': 'REAL',
+                                     'i': 'INTEGER'}.get(types.get(col),
+                                                         'TEXT'))
+            for col in self.columns)
+
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "{0}" ({1})'.format(
+            self.table_name, col_defs))
+
+        index_cols = []
+        if self.unique:
+            index_cols.append(('UNIQUE INDEX', self.unique))
+        for cols in self.indexes:
+            index_cols.append(('INDEX', cols))
+
+        for kind, cols in index_cols:
+            try:
+                self.conn.execute(
+                    'CREATE {0} IF NOT EXISTS "{1}_{2}" ON "{1}" ({3})'.format(
+                        kind,
+                        self.table_name,
+                        '_'.join(cols),
+                        ', '.join('"{0}"'.format(col) for col in cols)))
+            except sqlite3.DatabaseError as e:
+                print("{0} could not be created: {1}".format(kind, e))
+
+        self.conn.commit()
+
+        self.insert_sql = 'INSERT OR IGNORE INTO "{0}" ({1}) ' \
+                          'VALUES ({2})'.format(
+                              self.table_name,
+                              ', '.join('"{0}"'.format(col)
+                                        for col in self.columns),
+                              ', '.join('?' for col in self.columns))
+
+    def _insert(self, rows):
+
+        if self.conn is None:
+            self._connect()
+
+        for i in range(0, len(rows), self.batch_size):
+            self.conn.executemany(self.insert_sql,
+                                  rows[i:i + self.batch_size])
+
+        self.conn.commit()
+
+    def _run(self):
+
+        while True:
+            rows = self.queue.get()
+            batch = []
+            done = []
+
+            # merge everything queued into one transaction
+            while True:
+                done.append(rows)
+                if rows is None:
+                    break
+                batch.extend(rows)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    rows = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            try:
+                if len(batch) > 0:
+                    if self.error is None:
+                        self._insert(batch)
+                    else:
+                        self.n_dropped += len(batch)
+            except Exception as e:
+                print("Database could not be written: {0}".format(e))
+                self.error = e
+                self.n_dropped += len(batch)
+            finally:
+                for item in done:
+                    self.queue.task_done()
+
+            if done[-1] is None:
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                return
+
+
+class RunJournal:
+
+    def __init__(self, file_name):
+
+        """
+        Journal of a photometry run. It records the decisions shared by
+        the frames, the completed frames, the number of result rows
+        of every target and the size of the appended files (e.g. saved
+        overlays) at each checkpoint, so an interrupted run can be
+        resumed without duplicating rows.
+        @param file_name: Journal file (JSON).
+        @type file_name: path
+        """
+
+        self.file_name = file_name
+        self.state = None
+
+    def resume(self, params):
+
+        """
+        Loads the journal of an interrupted run with the same parameters.
+        @param params: Parameters of the run (JSON serializable).
+        @type params: dict
+        @return: dict or None
+        """
+
+        if not os.path.exists(self.file_name):
+            return(None)
+
+        try:
+            with open(self.file_name) as f_handle:
+                state = json.load(f_handle)
+        except ValueError as e:
+            print("Journal could not be read: {0}".format(e))
+            return(None)
+
+        if state.get('params') != json.loads(json.dumps(params)):
+            return(None)
+
+        self.state = state
+        return(state)
+
+    def start(self, params, setup, append_files=()):
+
+        """
+        Starts the journal of a new run.
+        @param params: Parameters of the run (JSON serializable).
+        @type params: dict
+        @param setup: Decisions shared by the frames (JSON serializable).
+        @type setup: dict
+        @param append_files: Files the run appends to at checkpoints.
+        They are cut back to their size at the last checkpoint
+        on rollback.
+        @type append_files: list
+        @return: dict
+        """
+
+        self.state = {"params": params,
+                      "setup": setup,
+                      "frames_done": [],
+                      "offsets": {},
+                      "file_sizes": {file_name: self._file_size(file_name)
+                                     for file_name in append_files}}
+        self._write()
+
+        return(self.state)
+
+    def frames_done(self):
+
+        """
+        Completed frames of the run.
+        @return: set
+        """
+
+        if self.state is None:
+            return(set())
+
+        return(set(self.state['frames_done']))
+
+    def rollback(self, sink):
+
+        """
+        Drops the rows (and the appended data) written after
+        the last checkpoint.
+        @param sink: Result writer of the run.
+        @type sink: ResultSink
+        @return: dict, offsets
+        """
+
+        for target, n_rows in self.state['offsets'].items():
+            sink.truncate(target, n_rows)
+
+        for file_name, size in self.state.get('file_sizes', {}).items():
+            if self._file_size(file_name) > size:
+                os.truncate(file_name, size)
+
+        return(self.state['offsets'])
+
+    def checkpoint(self, sink, frames):
+
+        """
+        Writes the buffered rows and marks the frames completed. Data
+        appended to the journaled files before the checkpoint is
+        committed with the frames.
+        @param sink: Result writer of the run.
+        @type sink: ResultSink
+        @param frames: Frames whose rows are in the buffers.
+        @type frames: list
+        @return: dict, offsets
+        """
+
+        offsets = self.state['offsets']
+
+        # rows of new targets are rolled back to their current count
+        new_targets = [target for target in sink.buffers
+                       if target not in offsets]
+        if len(new_targets) > 0:
+            for target in new_targets:
+                offsets[target] = sink.count(target)
+            self._write()
+
+        offsets.update(sink.flush())
+        file_sizes = self.state.setdefault('file_sizes', {})
+        for file_name in file_sizes:
+            file_sizes[file_name] = self._file_size(file_name)
+        self.state['frames_done'].extend(frames)
+        self._write()
+
+        return(offsets)
+
+    def finish(self):
+
+        """
+        Removes the journal of a completed run.
+        @return: boolean
+        """
+
+        if os.path.exists(self.file_name):
+            os.remove(self.file_name)
+
+        self.state = None
+        return(True)
+
+    def _file_size(self, file_name):
+
+        if not os.path.exists(file_name):
+            return(0)
+
+        return(os.path.getsize(file_name))
+
+    def _write(self):
+
+        tmp_file = "{0}.tmp".format(self.file_name)
+        with open(tmp_file, 'w') as f_handle:
+            json.dump(self.state, f_handle)
+            f_handle.flush()
+            os.fsync(f_handle.fileno())
+
+        os.replace(tmp_file, self.file_name)
+
+
+class WCSCache:
+
+    # one writer at a time within a process (e.g. solve_field_batch),
+    # the file is locked against other processes and machines
+    lock = threading.Lock()
+
+    def __init__(self, file_name=None):
+
+        """
+        Persistent cache of solved WCS headers. Entries are keyed by the
+        hash of the image data and the solver parameters, so frames
+        solved before (on any machine sharing the file) are not solved
+        again. The file is only appended to (one JSON object per line)
+        under a lock, and the entries read are kept in memory, so only
+        lines written since the last read are parsed.
+        @param file_name: Cache file (JSON lines). If None,
+        ~/.astrolib/wcs_cache.json is used.
+        @type file_name: path
+        """
+
+        if file_name is None:
+            file_name = os.path.join(os.path.expanduser('~'),
+                                     '.astrolib', 'wcs_cache.json')
+
+        self.file_name = file_name
+        self.lock_file = "{0}.lock".format(file_name)
+        self.entries = {}
+        self.offset = 0
+        self.stamp = None
+
+    def data_hash(self, image_path):
+
+        """
+        Hash of the image data. Header changes (e.g. a written WCS)
+        do not change it.
+        @param image_path: FITS image file name with path
+        @type image_path: path
+        @return: str
+        """
+
+        hdu = fits.open(image_path)
+        data = np.ascontiguousarray(hdu[0].data)
+        hdu.close()
+
+        digest = hashlib.sha256()
+        digest.update("{0} {1}".format(data.dtype.str,
+                                       data.shape).encode())
+        digest.update(data.tobytes())
+
+        return(digest.hexdigest())
+
+    def key(self, image_path, params):
+
+        """
+        Cache key of an image solved with given parameters. The image
+        data is hashed, so the key should be computed once per image
+        and passed to both get and put.
+        @param image_path: FITS image file name with path
+        @type image_path: path
+        @param params: Solver parameters (JSON serializable).
+        @type params: dict
+        @return: str
+        """
+
+        return("{0}:{1}".format(
+            self.data_hash(image_path),
+            hashlib.sha256(json.dumps(params, sort_keys=True,
+                                      default=str).encode()).hexdigest()))
+
+    def read(self):
+
+        """
+        Cached WCS cards. Only the lines appended since the last read
+        are parsed.
+        @return: dict
+        """
+
+        if not os.path.exists(self.file_name):
+            return(self.entries)
+
+        stat = os.stat(self.file_name)
+        stamp = (stat.st_ino, stat.st_dev)
+
+        # the file was replaced or cut, it is read again
+        if stamp != self.stamp or stat.st_size < self.offset:
+            self.entries = {}
+            self.offset = 0
+            self.stamp = stamp
+
+        if stat.st_size == self.offset:
+            return(self.entries)
+
+        with open(self.file_name, 'rb') as f_handle:
+            f_handle.seek(self.offset)
+            chunk = f_handle.read()
+
+        # lines are consumed when complete, an unfinished last line
+        # (being written, or a cache of a single JSON object) is
+        # parsed again on the next read
+        end = chunk.rfind(b'\n') + 1
+
+        for line in chunk[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                self.entries.update(json.loads(line))
+            except ValueError as e:
+                print("WCS cache line could not be read: {0}".format(e))
+
+        self.offset += end
+
+        try:
+            self.entries.update(json.loads(chunk[end:]))
+        except ValueError:
+            pass
+
+        return(self.entries)
+
+    def get(self, key):
+
+        """
+        Cached WCS of an image.
+        @param key: Return of the key.
+        @type key: str
+        @return: astropy.io.fits.Header or None
+        """
+
+        with self.lock:
+            cards = self.entries.get(key)
+            if cards is None:
+                cards = self.read().get(key)
+
+        if cards is None:
+            return(None)
+
+        return(fits.Header([tuple(card) for card in cards]))
+
+    def put(self, key, header):
+
+        """
+        Adds the WCS of a solved image to the cache.
+        @param key: Return of the key.
+        @type key: str
+        @param header: Header with the WCS solution.
+        @type header: astropy.io.fits.Header
+        @return: boolean
+        """
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', AstropyWarning)
+            wcs_header = WCS(header).to_header(relax=True)
+
+        cards = [[card.keyword, card.value, card.comment]
+                 for card in wcs_header.cards]
+
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(self.file_name))
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+            with open(self.lock_file, 'a') as lock_handle:
+                fcntl.flock(lock_handle, fcntl.LOCK_EX)
+                try:
+                    with open(self.file_name, 'ab+') as f_handle:
+                        # a line cut by a crashed writer is closed
+                        f_handle.seek(0, os.SEEK_END)
+                        if f_handle.tell() > 0:
+                            f_handle.seek(-1, os.SEEK_END)
+                            if f_handle.read(1) != b'\n':
+                                f_handle.write(b'\n')
+
+                        f_handle.write(json.dumps({key: cards}).encode() +
+                                       b'\n')
+                        f_handle.flush()
+                        os.fsync(f_handle.fileno())
+                finally:
+                    fcntl.flock(lock_handle, fcntl.LOCK_UN)
+
+            self.read()
+            self.entries[key] = cards
+
+        return(True)
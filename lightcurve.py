@@ -0,0 +1,715 @@
+# -*- coding: utf-8 -*-
+
+from astropy.table import Table, vstack
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import math
+import sqlite3
+import glob
+import os
+from .io import ResultSink
+
+
+class PeriodOps:
+
+    def __init__(self, n_harmonics=4, n_peaks=5, chunk_size=2000000):
+
+        """
+        Rotation period search of asteroid light curves.
+        @param n_harmonics: Order of the Fourier series fitted
+        to the period candidates.
+        @type n_harmonics: int
+        @param n_peaks: Number of Lomb-Scargle peaks tested per object.
+        @type n_peaks: int
+        @param chunk_size: Maximum number of (frequency, observation)
+        elements computed at once.
+        @type chunk_size: int
+        """
+
+        self.n_harmonics = n_harmonics
+        self.n_peaks = n_peaks
+        self.chunk_size = chunk_size
+
+    def curves_from_table(self, table,
+                          ycol='magt_avr',
+                          errcol='magt_i_err',
+                          xcol='jd',
+                          key='ast_num'):
+
+        """
+        Light curves of the objects of a result table, one point per
+        object and frame.
+        @param table: Photometry results (asteroids_phot columns) or
+        EnsembleOps.solve light curves.
+        @type table: astropy.table
+        @param ycol: Magnitude column.
+        @type ycol: str
+        @param errcol: Magnitude error column.
+        @type errcol: str
+        @param xcol: Time column.
+        @type xcol: str
+        @param key: Object column.
+        @type key: str
+        @return: dict (object: (time, mag, mag_err) arrays)
+        """
+
+        names = np.asarray(table[key]).astype(str)
+        times = np.asarray(table[xcol], dtype=float)
+        mags = np.asarray(table[ycol], dtype=float)
+        errs = np.asarray(table[errcol], dtype=float)
+
+        # result rows are repeated for every comparison star
+        rows = np.lexsort((times, names))
+        names, times, mags, errs = (names[rows], times[rows],
+                                    mags[rows], errs[rows])
+        first = np.ones(len(names), dtype=bool)
+        first[1:] = (names[1:] != names[:-1]) | (times[1:] != times[:-1])
+
+        good = first & np.isfinite(times) & np.isfinite(mags)
+        names, times, mags, errs = (names[good], times[good],
+                                    mags[good], errs[good])
+
+        curves = {}
+        uniq, starts = np.unique(names, return_index=True)
+        bounds = np.append(starts, len(names))
+        for i, name in enumerate(uniq):
+            s = slice(bounds[i], bounds[i + 1])
+            curves[str(name)] = (times[s], mags[s], errs[s])
+
+        return(curves)
+
+    def read_curves(self, source,
+                    table_name="asteroids",
+                    ycol='magt_avr',
+                    errcol='magt_i_err'):
+
+        """
+        Light curves of all objects in a results directory
+        (<ast_num>.npz, or <ast_num>.txt when there is no .npz)
+        or in a SQLite3 database written by asteroids_phot.
+        @param source: Results directory or SQLite3 database file.
+        @type source: path
+        @param table_name: SQLite3 database table.
+        @type table_name: str
+        @param ycol: Magnitude column.
+        @type ycol: str
+        @param errcol: Magnitude error column.
+        @type errcol: str
+        @return: dict (object: (time, mag, mag_err) arrays)
+        """
+
+        if os.path.isdir(source):
+            npz_files = sorted(glob.glob(os.path.join(source, '*.npz')))
+            roots = set(os.path.splitext(f)[0] for f in npz_files)
+            txt_files = [f for f in
+                         sorted(glob.glob(os.path.join(source, '*.txt')))
+                         if os.path.splitext(f)[0] not in roots]
+
+            sink = ResultSink(out_dir=source)
+            tables = []
+            for npz_file in npz_files:
+                tables.append(sink.read_file(
+                    npz_file, columns=['ast_num', 'jd', ycol, errcol]))
+            for txt_file in txt_files:
+                try:
+                    data = Table.read(txt_file,
+                                      format='ascii.commented_header')
+                except Exception as e:
+                    print("{0} could not be read: {1}".format(txt_file, e))
+                    continue
+                if set(['ast_num', 'jd', ycol, errcol]) <= \
+                        set(data.colnames):
+                    data['ast_num'] = data['ast_num'].astype(str)
+                    tables.append(data['ast_num', 'jd', ycol, errcol])
+
+            if len(tables) == 0:
+                print("No photometry result found in the {0}".format(source))
+                raise SystemExit
+
+            return(self.curves_from_table(vstack(tables),
+                                          ycol=ycol,
+                                          errcol=errcol))
+
+        elif os.path.isfile(source):
+            conn = sqlite3.connect(source)
+            try:
+                rows = conn.execute(
+                    "SELECT DISTINCT ast_num, jd, {0}, {1} FROM {2}".format(
+                        ycol, errcol, table_name)).fetchall()
+            finally:
+                conn.close()
+
+            if len(rows) == 0:
+                print("No photometry result found in the {0}".format(source))
+                raise SystemExit
+
+            names, jds, mags, errs = zip(*rows)
+            return(self.curves_from_table(
+                Table([np.asarray(names).astype(str), jds, mags, errs],
+                      names=('ast_num', 'jd', ycol, errcol)),
+                ycol=ycol,
+                errcol=errcol))
+
+        print("{0} is neither a directory nor a database!".format(source))
+        raise SystemExit
+
+    def frequency_grid(self, curves,
+                       min_period=1.0,
+                       max_period=48.0,
+                       oversampling=10):
+
+        """
+        Frequency grid shared by all objects. Its step resolves the
+        longest time span of the curves.
+        @param curves: Return of the read_curves.
+        @type curves: dict
+        @param min_period: Shortest period (in hours).
+        @type min_period: float
+        @param max_period: Longest period (in hours).
+        @type max_period: float
+        @param oversampling: Number of grid points per peak width.
+        @type oversampling: int
+        @return: numpy array (frequencies in 1/day)
+        """
+
+        spans = [np.ptp(t) for t, y, dy in curves.values() if len(t) > 1]
+        span = max(spans) if len(spans) > 0 else max_period / 24.0
+        span = max(span, max_period / 24.0)
+
+        f_min = 24.0 / max_period
+        f_max = 24.0 / min_period
+        df = 1.0 / (oversampling * span)
+
+        return(np.arange(f_min, f_max + df, df))
+
+    def lomb_scargle(self, t, y, dy, freqs):
+
+        """
+        Generalised (floating mean, weighted) Lomb-Scargle periodogram,
+        computed for chunks of frequencies at once.
+        @param t: Times (in days).
+        @type t: array
+        @param y: Magnitudes.
+        @type y: array
+        @param dy: Magnitude errors.
+        @type dy: array
+        @param freqs: Frequencies (in 1/day).
+        @type freqs: array
+        @return: numpy array (power, 0..1)
+        """
+
+        t, y, w, w_sum = self._weighted(t, y, dy)
+        freqs = np.asarray(freqs, dtype=float)
+
+        y_mean = np.dot(w, y)
+        yy = np.dot(w, (y - y_mean) ** 2)
+
+        power = np.zeros(len(freqs))
+
+        if yy == 0 or len(t) < 3:
+            return(power)
+
+        step = max(1, self.chunk_size // len(t))
+        for start in range(0, len(freqs), step):
+            f = freqs[start:start + step]
+            arg = 2 * np.pi * f[:, np.newaxis] * t[np.newaxis, :]
+            cos = np.cos(arg)
+            sin = np.sin(arg)
+
+            c = np.dot(cos, w)
+            s = np.dot(sin, w)
+            yc = np.dot(cos, w * y) - y_mean * c
+            ys = np.dot(sin, w * y) - y_mean * s
+            cc = np.dot(cos * cos, w) - c * c
+            ss = np.dot(sin * sin, w) - s * s
+            cs = np.dot(cos * sin, w) - c * s
+            d = cc * ss - cs * cs
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p = (ss * yc * yc + cc * ys * ys - 2 * cs * yc * ys) / \
+                    (yy * d)
+
+            power[start:start + step] = np.where(np.isfinite(p), p, 0)
+
+        return(power)
+
+    def fourier_fit(self, t, y, dy, freqs, n_harmonics=None):
+
+        """
+        Weighted Fourier series fits of a light curve at many
+        frequencies, solved together.
+        @param t: Times (in days).
+        @type t: array
+        @param y: Magnitudes.
+        @type y: array
+        @param dy: Magnitude errors.
+        @type dy: array
+        @param freqs: Fundamental frequencies (in 1/day).
+        @type freqs: array
+        @param n_harmonics: Order of the series. If None, n_harmonics
+        of the instance.
+        @type n_harmonics: int
+        @return: dict (coeffs, chi2_red, amplitude of each frequency)
+        """
+
+        if n_harmonics is None:
+            n_harmonics = self.n_harmonics
+
+        t, y, w, w_sum = self._weighted(t, y, dy)
+        freqs = np.atleast_1d(np.asarray(freqs, dtype=float))
+
+        n_par = 2 * n_harmonics + 1
+        k = np.arange(1, n_harmonics + 1)
+
+        # design matrices [frequency, observation, parameter]
+        arg = (2 * np.pi * freqs[:, np.newaxis, np.newaxis] *
+               t[np.newaxis, :, np.newaxis] * k[np.newaxis, np.newaxis, :])
+        design = np.concatenate((np.ones(arg.shape[:2] + (1, )),
+                                 np.cos(arg),
+                                 np.sin(arg)), axis=2)
+
+        # normal equations of all frequencies, pinv survives
+        # frequencies that alias to the sampling
+        normal = np.einsum('fni,n,fnj->fij', design, w, design)
+        rhs = np.einsum('fni,n,n->fi', design, w, y)
+        coeffs = np.einsum('fij,fj->fi', np.linalg.pinv(normal), rhs)
+
+        model = np.einsum('fnp,fp->fn', design, coeffs)
+
+        # weights are normalised, chi2 is scaled back with their sum
+        chi2 = np.dot((y[np.newaxis, :] - model) ** 2, w) * w_sum
+        dof = max(len(t) - n_par, 1)
+
+        return({"coeffs": coeffs,
+                "chi2_red": chi2 / dof,
+                "amplitude": np.ptp(model, axis=1)})
+
+    def candidates(self, name, curve, freqs):
+
+        """
+        Ranked rotation period candidates of an object. Both the period
+        of a Lomb-Scargle peak and its double (two maxima per rotation)
+        are fitted with a Fourier series and ranked by reduced chi2.
+        Candidates out of the frequency grid are dropped.
+        @param name: Object name.
+        @type name: str
+        @param curve: Light curve (time, mag, mag_err).
+        @type curve: tuple
+        @param freqs: Frequency grid (in 1/day).
+        @type freqs: array
+        @return: astropy.table
+        """
+
+        t, y, dy = curve
+        columns = ('ast_num', 'rank', 'period_h', 'frequency', 'power',
+                   'chi2_red', 'amplitude', 'n_obs')
+        dtypes = ('U20', 'i4', 'f8', 'f8', 'f8', 'f8', 'f8', 'i4')
+
+        if len(t) < 2 * self.n_harmonics + 2:
+            return(Table(names=columns, dtype=dtypes))
+
+        power = self.lomb_scargle(t, y, dy, freqs)
+
+        # local maxima of the periodogram, highest first
+        peaks = np.flatnonzero((power[1:-1] > power[:-2]) &
+                               (power[1:-1] >= power[2:])) + 1
+        peaks = peaks[np.argsort(power[peaks])[::-1]][:self.n_peaks]
+
+        if len(peaks) == 0:
+            return(Table(names=columns, dtype=dtypes))
+
+        f_peaks = freqs[peaks]
+        p_peaks = np.concatenate((power[peaks], power[peaks]))
+
+        # refine the candidates within a grid step of the periodogram
+        df = (freqs[1] - freqs[0]) if len(freqs) > 1 else 0.0
+        offsets = np.linspace(-1, 1, 21) * df
+        f_rot = np.concatenate((f_peaks, f_peaks / 2.0))
+        scale = np.concatenate((np.ones(len(f_peaks)),
+                                np.full(len(f_peaks), 0.5)))
+        local = (f_rot[:, np.newaxis] +
+                 scale[:, np.newaxis] * offsets[np.newaxis, :])
+        local_fit = self.fourier_fit(t, y, dy, local.ravel())
+        best = np.argmin(local_fit['chi2_red'].reshape(local.shape), axis=1)
+        f_rot = local[np.arange(len(f_rot)), best]
+
+        # doubled periods may fall out of the searched period range
+        in_range = (f_rot >= freqs.min()) & (f_rot <= freqs.max())
+        f_rot = f_rot[in_range]
+        p_peaks = p_peaks[in_range]
+
+        if len(f_rot) == 0:
+            return(Table(names=columns, dtype=dtypes))
+
+        fit = self.fourier_fit(t, y, dy, f_rot)
+
+        order = np.argsort(fit['chi2_red'], kind='stable')
+
+        return(Table([np.repeat(str(name), len(order)),
+                      np.arange(1, len(order) + 1),
+                      24.0 / f_rot[order],
+                      f_rot[order],
+                      p_peaks[order],
+                      fit['chi2_red'][order],
+                      fit['amplitude'][order],
+                      np.repeat(len(t), len(order))],
+                     names=columns, dtype=dtypes))
+
+    def search(self, source,
+               table_name="asteroids",
+               ycol='magt_avr',
+               errcol='magt_i_err',
+               min_period=1.0,
+               max_period=48.0,
+               oversampling=10,
+               n_jobs=None):
+
+        """
+        Period search of all objects of a results directory, database
+        or table, fanned out to a process pool with a shared
+        frequency grid.
+        @param source: Results directory, SQLite3 database file or table.
+        @type source: path or astropy.table
+        @param table_name: SQLite3 database table.
+        @type table_name: str
+        @param ycol: Magnitude column.
+        @type ycol: str
+        @param errcol: Magnitude error column.
+        @type errcol: str
+        @param min_period: Shortest period (in hours).
+        @type min_period: float
+        @param max_period: Longest period (in hours).
+        @type max_period: float
+        @param oversampling: Number of grid points per peak width.
+        @type oversampling: int
+        @param n_jobs: Number of processes. 1 runs in this process,
+        None uses all CPUs.
+        @type n_jobs: int
+        @return: astropy.table (ranked candidates of all objects)
+        """
+
+        if isinstance(source, Table):
+            curves = self.curves_from_table(source, ycol=ycol, errcol=errcol)
+        else:
+            curves = self.read_curves(source,
+                                      table_name=table_name,
+                                      ycol=ycol,
+                                      errcol=errcol)
+
+        freqs = self.frequency_grid(curves,
+                                    min_period=min_period,
+                                    max_period=max_period,
+                                    oversampling=oversampling)
+
+        names = sorted(curves)
+        candidates = partial(self.candidates, freqs=freqs)
+
+        if n_jobs == 1:
+            tables = list(map(candidates, names,
+                              [curves[name] for name in names]))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                tables = list(executor.map(candidates, names,
+                                           [curves[name] for name in names]))
+
+        return(vstack(tables))
+
+    def _weighted(self, t, y, dy):
+
+        t = np.asarray(t, dtype=float)
+        y = np.asarray(y, dtype=float)
+        dy = np.asarray(dy, dtype=float)
+
+        # periodograms are shift invariant, JDs lose phase precision
+        if len(t) > 0:
+            t = t - t.min()
+
+        # points without a valid error get the median weight
+        good = np.isfinite(dy) & (dy > 0)
+        if np.any(good):
+            dy = np.where(good, dy, np.median(dy[good]))
+        else:
+            dy = np.ones(len(t))
+
+        w = 1.0 / dy ** 2
+
+        return(t, y, w / w.sum(), w.sum())
+
+
+class GroupOps:
+
+    def __init__(self, keys):
+
+        """
+        Segment operations on the groups of a table column. Rows are
+        sorted by key once; every statistic is then computed for all
+        groups at once.
+        @param keys: Group key of every row (e.g. jd or nomad1).
+        @type keys: array
+        """
+
+        keys = np.asarray(keys)
+
+        # stable, so rows of a group keep the table order
+        self.order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[self.order]
+
+        new_group = np.ones(len(keys), dtype=bool)
+        new_group[1:] = sorted_keys[1:] != sorted_keys[:-1]
+
+        self.starts = np.flatnonzero(new_group)
+        self.counts = np.diff(np.append(self.starts, len(keys)))
+        self.keys = sorted_keys[self.starts]
+        self.n_groups = len(self.starts)
+
+        # group number of every row, in table order
+        self.labels = np.empty(len(keys), dtype=int)
+        self.labels[self.order] = np.cumsum(new_group) - 1
+
+    def rows(self, group):
+
+        """
+        Table rows of a group, in table order.
+        @param group: Group number.
+        @type group: int
+        @return: numpy array
+        """
+
+        start = self.starts[group]
+        return(self.order[start:start + self.counts[group]])
+
+    def first(self, values):
+
+        """
+        First value of every group (in table order).
+        @param values: Values of the rows.
+        @type values: array
+        @return: numpy array
+        """
+
+        return(np.asarray(values)[self.order[self.starts]])
+
+    def count(self, mask=None):
+
+        """
+        Number of (unmasked) rows of every group.
+        @param mask: True for the rows to be counted.
+        @type mask: array
+        @return: numpy array
+        """
+
+        if mask is None:
+            return(self.counts.copy())
+
+        return(np.bincount(self.labels, weights=mask,
+                           minlength=self.n_groups).astype(int))
+
+    def sum(self, values, mask=None):
+
+        """
+        Sum of the (unmasked) values of every group.
+        @param values: Values of the rows.
+        @type values: array
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array
+        """
+
+        values = np.asarray(values, dtype=float)
+        if mask is not None:
+            values = np.where(mask, values, 0.0)
+
+        return(np.bincount(self.labels, weights=values,
+                           minlength=self.n_groups))
+
+    def mean(self, values, mask=None):
+
+        """
+        Mean of the (unmasked) values of every group.
+        @param values: Values of the rows.
+        @type values: array
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array (NaN for empty groups)
+        """
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return(self.sum(values, mask) / self.count(mask))
+
+    def std(self, values, mask=None):
+
+        """
+        Standard deviation (ddof=0) of the (unmasked) values
+        of every group.
+        @param values: Values of the rows.
+        @type values: array
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array (NaN for empty groups)
+        """
+
+        values = np.asarray(values, dtype=float)
+        dev = values - self.mean(values, mask)[self.labels]
+
+        return(np.sqrt(self.mean(dev * dev, mask)))
+
+    def median(self, values, mask=None):
+
+        """
+        Median of the (unmasked) values of every group.
+        @param values: Values of the rows.
+        @type values: array
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array (NaN for empty groups)
+        """
+
+        values = np.asarray(values, dtype=float)
+        if mask is None:
+            mask = np.ones(len(values), dtype=bool)
+
+        # masked values are sorted to the end of their group
+        sort_values = np.where(mask, values, np.inf)
+        order = np.lexsort((sort_values, self.labels))
+        sorted_values = values[order]
+
+        n = self.count(mask)
+        lower = self.starts + np.maximum(n - 1, 0) // 2
+        upper = self.starts + n // 2
+
+        median = 0.5 * (sorted_values[lower] + sorted_values[upper])
+        median[n == 0] = np.nan
+
+        return(median)
+
+    def mad_std(self, values, mask=None):
+
+        """
+        Median absolute deviation of the (unmasked) values of every
+        group, scaled to the standard deviation of a Gaussian.
+        @param values: Values of the rows.
+        @type values: array
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array
+        """
+
+        values = np.asarray(values, dtype=float)
+        dev = np.abs(values - self.median(values, mask)[self.labels])
+
+        return(1.482602218505602 * self.median(dev, mask))
+
+    def sigma_clip(self, values, sigma=3, iters=10, mask=None):
+
+        """
+        Sigma clipping of every group around its median with the
+        MAD standard deviation (astropy.stats.sigma_clip with
+        stdfunc=mad_std and the iters keyword, so rejections
+        accumulate), iterated until no more rows are rejected.
+        @param values: Values of the rows.
+        @type values: array
+        @param sigma: Clipping limit (in standard deviations).
+        @type sigma: float
+        @param iters: Maximum number of iterations.
+        @type iters: int
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array (True for the kept rows)
+        """
+
+        values = np.asarray(values, dtype=float)
+        keep = np.isfinite(values)
+        if mask is not None:
+            keep &= np.asarray(mask, dtype=bool)
+
+        for i in range(iters):
+            center = self.median(values, keep)[self.labels]
+            std = self.mad_std(values, keep)[self.labels]
+
+            new_keep = keep & (values >= center - sigma * std) & \
+                (values <= center + sigma * std)
+
+            if np.array_equal(new_keep, keep):
+                break
+
+            keep = new_keep
+
+        return(keep)
+
+    def polyfit(self, x, y, deg=1, mask=None):
+
+        """
+        Least squares polynomial of every group, all solved at once.
+        @param x: X values of the rows.
+        @type x: array
+        @param y: Y values of the rows.
+        @type y: array
+        @param deg: Degree of the polynomials.
+        @type deg: int
+        @param mask: True for the rows to be used.
+        @type mask: array
+        @return: numpy array (coefficients of every group, highest
+        power first as numpy.polyfit; NaN for groups with too few rows
+        or too few distinct x values)
+        """
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if mask is None:
+            mask = np.ones(len(x), dtype=bool)
+
+        # fitted around the group means, for conditioning
+        center = self.mean(x, mask)
+        center[~np.isfinite(center)] = 0.0
+        xc = x - center[self.labels]
+
+        powers = np.arange(2 * deg + 1)
+        moments = np.stack([self.sum(xc ** p, mask) for p in powers], axis=1)
+        rhs = np.stack([self.sum(y * xc ** p, mask)
+                        for p in range(deg + 1)], axis=1)
+
+        idx = np.arange(deg + 1)
+        normal = moments[:, idx[:, np.newaxis] + idx[np.newaxis, :]]
+
+        coeffs = np.full((self.n_groups, deg + 1), np.nan)
+        solvable = self.count(mask) > deg
+        if np.any(solvable):
+            # groups without enough distinct x values (singular or
+            # badly conditioned normal matrix) are left NaN
+            with np.errstate(invalid='ignore'):
+                cond = np.linalg.cond(normal[solvable])
+            solvable[solvable] = cond < 1.0 / np.finfo(float).eps
+        if np.any(solvable):
+            coeffs[solvable] = np.linalg.solve(
+                normal[solvable], rhs[solvable][..., np.newaxis])[..., 0]
+
+        # back to the powers of x, highest first
+        out = np.zeros((self.n_groups, deg + 1))
+        for k in range(deg + 1):
+            for j in range(k + 1):
+                out[:, j] += (coeffs[:, k] * math.comb(k, j) *
+                              (-center) ** (k - j))
+
+        return(out[:, ::-1])
+
+    def polyval(self, coeffs, x):
+
+        """
+        Evaluates the polynomial of its group at every row.
+        @param coeffs: Return of the polyfit.
+        @type coeffs: numpy array
+        @param x: X values of the rows.
+        @type x: array
+        @return: numpy array
+        """
+
+        x = np.asarray(x, dtype=float)
+        row_coeffs = coeffs[self.labels]
+
+        value = np.zeros(len(x))
+        for k in range(coeffs.shape[1]):
+            value = value * x + row_coeffs[:, k]
+
+        return(value)
+
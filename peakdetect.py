@@ -1,20 +1,20 @@
-import sys
-from numpy import NaN, Inf, arange, isscalar, asarray, array
+from numpy import inf, arange, isscalar, asarray, array, \
+    full, zeros, ones, concatenate, column_stack, argsort, searchsorted
 
 
 def peakdet(v, delta, x = None):
     """
     Converted from MATLAB script at http://billauer.co.il/peakdet.html
-    
+
     Returns two arrays
-    
+
     function [maxtab, mintab]=peakdet(v, delta, x)
     %PEAKDET Detect peaks in a vector
     %        [MAXTAB, MINTAB] = PEAKDET(V, DELTA) finds the local
     %        maxima and minima ("peaks") in the vector V.
     %        MAXTAB and MINTAB consists of two columns. Column 1
     %        contains indices in V, and column 2 the found values.
-    %      
+    %
     %        With [MAXTAB, MINTAB] = PEAKDET(V, DELTA, X) the indices
     %        in MAXTAB and MINTAB are replaced with the corresponding
     %        X-values.
@@ -22,53 +22,116 @@ def peakdet(v, delta, x = None):
     %        A point is considered a maximum peak if it has the maximal
     %        value, and was preceded (to the left) by a value lower by
     %        DELTA.
-    
+
     % Eli Billauer, 3.4.05 (Explicitly not copyrighted).
     % This function is released to the public domain; Any use is allowed.
-    
+
+    If V is 2-D, every row is a curve and all curves are scanned
+    at once. X is then shared by the rows or has the shape of V,
+    and lists of MAXTAB and MINTAB (one per row) are returned.
+    Bad input raises ValueError.
     """
-    maxtab = []
-    mintab = []
-       
-    if x is None:
-        x = arange(len(v))
-    
+
     v = asarray(v)
-    
-    if len(v) != len(x):
-        sys.exit('Input vectors v and x must have same length')
-    
+
+    if v.ndim not in (1, 2):
+        raise ValueError('Input vector v must be 1-D or 2-D')
+
+    curves = v.reshape(1, -1) if v.ndim == 1 else v
+    n_curves, n_points = curves.shape
+
+    if x is None:
+        x = arange(n_points)
+
+    x = asarray(x)
+
+    if x.shape[-1:] != (n_points, ) or \
+            x.ndim not in (1, v.ndim) or \
+            (x.ndim == 2 and x.shape != v.shape):
+        raise ValueError('Input vectors v and x must have same length')
+
     if not isscalar(delta):
-        sys.exit('Input argument delta must be a scalar')
-    
+        raise ValueError('Input argument delta must be a scalar')
+
     if delta <= 0:
-        sys.exit('Input argument delta must be positive')
-    
-    mn, mx = Inf, -Inf
-    mnpos, mxpos = NaN, NaN
-    
-    lookformax = True
-    
-    for i in arange(len(v)):
-        this = v[i]
-        if this > mx:
-            mx = this
-            mxpos = x[i]
-        if this < mn:
-            mn = this
-            mnpos = x[i]
-        
-        if lookformax:
-            if this < mx-delta:
-                maxtab.append((mxpos, mx))
-                mn = this
-                mnpos = x[i]
-                lookformax = False
-        else:
-            if this > mn+delta:
-                mintab.append((mnpos, mn))
-                mx = this
-                mxpos = x[i]
-                lookformax = True
-
-    return array(maxtab), array(mintab)
+        raise ValueError('Input argument delta must be positive')
+
+    rows = arange(n_curves)
+
+    mn = full(n_curves, inf)
+    mx = full(n_curves, -inf)
+    # positions of mn and mx, a peak is never recorded before they are set
+    mnpos = zeros(n_curves, dtype=int)
+    mxpos = zeros(n_curves, dtype=int)
+
+    lookformax = ones(n_curves, dtype=bool)
+
+    max_rows, max_pos = [rows[:0]], [rows[:0]]
+    min_rows, min_pos = [rows[:0]], [rows[:0]]
+
+    # scan along the curves, all curves at each step
+    for i in arange(n_points):
+        this = curves[:, i].astype(float)
+
+        higher = this > mx
+        mx[higher] = this[higher]
+        mxpos[higher] = i
+
+        lower = this < mn
+        mn[lower] = this[lower]
+        mnpos[lower] = i
+
+        found_max = lookformax & (this < mx - delta)
+        found_min = ~lookformax & (this > mn + delta)
+
+        max_rows.append(rows[found_max])
+        max_pos.append(mxpos[found_max])
+        mn[found_max] = this[found_max]
+        mnpos[found_max] = i
+        lookformax[found_max] = False
+
+        min_rows.append(rows[found_min])
+        min_pos.append(mnpos[found_min])
+        mx[found_min] = this[found_min]
+        mxpos[found_min] = i
+        lookformax[found_min] = True
+
+    maxtabs = _peak_tables(curves, x, max_rows, max_pos)
+    mintabs = _peak_tables(curves, x, min_rows, min_pos)
+
+    if v.ndim == 1:
+        return maxtabs[0], mintabs[0]
+
+    return maxtabs, mintabs
+
+
+def _peak_tables(curves, x, peak_rows, peak_pos):
+    """
+    Splits the peaks found by the scan into one [position, value]
+    table per curve, in the order they were found.
+    """
+
+    n_curves = curves.shape[0]
+
+    peak_rows = concatenate(peak_rows)
+    peak_pos = concatenate(peak_pos)
+
+    # stable sort keeps the scan order of a curve
+    order = argsort(peak_rows, kind='stable')
+    peak_rows = peak_rows[order]
+    peak_pos = peak_pos[order]
+
+    bounds = searchsorted(peak_rows, arange(n_curves + 1))
+
+    tables = []
+    for row in range(n_curves):
+        pos = peak_pos[bounds[row]:bounds[row + 1]]
+
+        if len(pos) == 0:
+            tables.append(array([]))
+            continue
+
+        xs = x[pos] if x.ndim == 1 else x[row, pos]
+        tables.append(column_stack((xs, curves[row, pos])))
+
+    return tables
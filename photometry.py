@@ -6,8 +6,9 @@ from astropy import coordinates
 from astropy import units as u
 from astropy.time import TimeDelta
 from astropy.time import Time
-from astropy.table import Table
+from astropy.table import Table, vstack
 from .catalog import Query
+from .catalog import CompCatalog
 from .astronomy import FitsOps
 from .astronomy import AstCalc
 from .astronomy import TimeOps
@@ -16,17 +17,20 @@ import math
 import numpy as np
 import os
 import glob
-import time
+import warnings
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 from .peakdetect import peakdet
+from .aperture import ApertureOps
+from .quicklook import QuickLook
+from .io import ResultSink
+from .io import DBWriter
+from .io import RunJournal
+from io import StringIO
 import sqlite3
-
-
-try:
-    import f2n
-except ImportError:
-    print('Python cannot import f2n. Make sure f2n is installed.')
-    raise SystemExit
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
 
 
 class PhotOps:
@@ -151,7 +155,604 @@ class PhotOps:
             return({"flag": flag,
                     "flux": flux,
                     "fluxerr": fluxerr})
-    
+
+    def batch_phot(self, data_sub, x, y,
+                   aper_radius=3.0,
+                   err=None,
+                   gain=0.57):
+
+        """
+        Aperture photometry of many positions with one sep call.
+        @param data_sub: Background subtracted image data.
+        @type data_sub: numpy array
+        @param x: X coordinates of objects.
+        @type x: array
+        @param y: Y coordinates of objects.
+        @type y: array
+        @param aper_radius: Aperture radius (scalar or one per object).
+        @type aper_radius: float or array
+        @param err: Global background RMS.
+        @type err: float
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @return: dict
+        """
+
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+
+        if np.ndim(aper_radius) > 0:
+            aper_radius = np.asarray(aper_radius, dtype=float)
+        else:
+            aper_radius = float(aper_radius)
+
+        flux, fluxerr, flag = sep.sum_circle(data_sub,
+                                             x,
+                                             y,
+                                             aper_radius,
+                                             err=err,
+                                             gain=gain)
+
+        return({"flag": flag,
+                "flux": flux,
+                "fluxerr": fluxerr})
+
+    def comp_phot(self, data_sub, w, comptable,
+                  naxis1, naxis2,
+                  aper_radius,
+                  exptime,
+                  err=None,
+                  gain=0.57,
+                  comp_snr=50,
+                  fitsfile=None):
+
+        """
+        Photometry of all comparison stars of a frame at once.
+        @param data_sub: Background subtracted image data.
+        @type data_sub: numpy array
+        @param w: WCS of the frame.
+        @type w: astropy.wcs.WCS
+        @param comptable: Return of the CompCatalog.get.
+        @type comptable: astropy.table
+        @param naxis1: NAXIS1 of the frame.
+        @type naxis1: int
+        @param naxis2: NAXIS2 of the frame.
+        @type naxis2: int
+        @param aper_radius: Aperture radius
+        @type aper_radius: float
+        @param exptime: Exposure time of the frame.
+        @type exptime: float
+        @param err: Global background RMS.
+        @type err: float
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @param comp_snr: Minimum SNR of detected comparison star.
+        @type comp_snr: float
+        @param fitsfile: FITS image file name with path (pixel memo key).
+        @type fitsfile: str
+        @return: astropy.table
+        """
+
+        ac = AstCalc()
+
+        # stars' X and Y coor
+        s_x, s_y, on_frame = CompCatalog().pixels(comptable,
+                                                  w,
+                                                  naxis1,
+                                                  naxis2,
+                                                  fitsfile=fitsfile)
+
+        res = self.batch_phot(data_sub,
+                              s_x[on_frame],
+                              s_y[on_frame],
+                              aper_radius,
+                              err=err,
+                              gain=gain)
+
+        flux = res['flux']
+        fluxerr = res['fluxerr']
+
+        if np.any((flux == 0.0) | (fluxerr == 0.0)):
+            print("Bad star selected!")
+            raise SystemExit
+
+        good = (flux / fluxerr) > comp_snr
+
+        flux = flux[good]
+        fluxerr = fluxerr[good]
+
+        comps = Table(comptable[on_frame][good])
+        comps['x'] = s_x[on_frame][good]
+        comps['y'] = s_y[on_frame][good]
+        comps['flux'] = flux
+        comps['fluxerr'] = fluxerr
+        comps['magc_i'] = ac.flux2mag(flux, exptime)
+        comps['magc_i_err'] = fluxerr / flux * 2.5 / math.log(10)
+
+        return(comps)
+
+    def phot_fitslist(self, image_path, exposure=None):
+
+        """
+        Lists FITS images of a photometry run in JD order.
+        @param image_path: Path of FITS file(s) or directory.
+        @type image_path: path
+        @param exposure: Exposure keyword of phot images.
+        @type exposure: float
+        @return: list
+        """
+
+        if ".fit" in os.path.basename(image_path):
+            fitslist = glob.glob(image_path)
+        else:
+            fitslist = glob.glob(image_path + '/*.fit?')
+
+        if len(fitslist) == 0:
+            print('No image FITS found in the {0}'.format(image_path))
+            raise SystemExit
+
+        to = TimeOps()
+        frames = []
+
+        for fitsfile in sorted(fitslist):
+            header = fits.getheader(fitsfile)
+            exptime = header.get('exptime')
+
+            if exptime is not None and exposure is not None:
+                if float(exptime) != exposure:
+                    continue
+
+            frames.append([to.date2jd(header['date-obs']), fitsfile])
+
+        return([fitsfile for jd, fitsfile in sorted(frames)])
+
+    def load_frame(self, fitsfile,
+                   multi_object=True,
+                   target=None,
+                   radius=11,
+                   max_mag=20):
+
+        """
+        Reads a frame, subtracts its background and finds
+        the asteroids on it.
+        @param fitsfile: Path of FITS file.
+        @type fitsfile: path
+        @param multi_object: Apply photometry for other asteroids in the frame?
+        @type multi_object: boolean
+        @param target: Target object that photometry applied. If None,
+        will be taken form FITS header.
+        @type target: str
+        @param radius: SkyBoT search radius.
+        @type radius: float
+        @param max_mag: Faintest object limit.
+        @type max_mag: float
+        @return: dict
+        """
+
+        if fitsfile:
+            hdu = fits.open(fitsfile)[0]
+        else:
+            print("FITS image has not been provided by the user!")
+            raise SystemExit
+
+        sb = Query()
+        ac = AstCalc()
+        to = TimeOps()
+        fo = FitsOps(fitsfile)
+        header = hdu.header
+        w = WCS(header)
+
+        naxis1 = fo.get_header('naxis1')
+        naxis2 = fo.get_header('naxis2')
+        odate = fo.get_header('date-obs')
+        t1 = Time("{0}".format(odate),
+                  out_subfmt="date")
+        dt = TimeDelta(12 * 3600, format='sec')
+        onight = t1 - dt
+        exptime = fo.get_header('exptime')
+
+        if target is None:
+            objct = fo.get_header('object')
+        else:
+            objct = str(target)
+        filter = fo.get_header('filter').replace(" ", "_")
+        # t1 = Time(odate.replace('T', ' '))
+        # exptime = fo.get_header('exptime')
+        # dt = TimeDelta(exptime / 2.0, format='sec')
+        # odate_middle = t1 + dt
+        # jd = to.date2jd(odate_middle.value)
+        jd = to.date2jd(odate)
+        ra_dec = ac.center_finder(fitsfile, wcs_ref=True)
+
+        request = sb.find_skybot_objects(odate,
+                                         ra_dec[0].degree,
+                                         ra_dec[1].degree,
+                                         radius=radius)
+
+        if request[0]:
+            if multi_object:
+                asteroids = Table(np.sort(request[1][::-1],
+                                          order=['m_v']))
+            else:
+                asteroids = Table(np.sort(request[1],
+                                          order=['num']))
+                mask = asteroids['num'] == str(objct).upper()
+                asteroids = asteroids[mask]
+        elif request[0] is False:
+            print(request[1])
+            raise SystemExit
+
+        data = hdu.data.astype(float)
+
+        bkg = sep.Background(data)
+        data_sub = data - bkg
+
+        asteroids = asteroids[asteroids['m_v'].astype(float) <= max_mag]
+
+        # asteroids' X and Y coor in one call
+        ast_coors = coordinates.SkyCoord(asteroids['ra(h)'],
+                                         asteroids['dec(deg)'],
+                                         unit=(u.hourangle, u.deg),
+                                         frame='icrs')
+        a_xs, a_ys, a_on = AstCalc().sky2pix(w,
+                                             ast_coors.ra.degree,
+                                             ast_coors.dec.degree,
+                                             naxis1,
+                                             naxis2)
+
+        return({"fitsfile": fitsfile,
+                "wcs": w,
+                "naxis1": naxis1,
+                "naxis2": naxis2,
+                "odate": odate,
+                "onight": onight.iso,
+                "jd": jd,
+                "exptime": exptime,
+                "filter": filter,
+                "data_sub": data_sub,
+                "rms": bkg.globalrms,
+                "asteroids": asteroids[a_on],
+                "ast_coors": ast_coors[a_on],
+                "x": a_xs[a_on],
+                "y": a_ys[a_on]})
+
+    def phot_setup(self, fitsfile,
+                   aper_radius=None,
+                   plot_aper_test=False,
+                   multi_object=True,
+                   target=None,
+                   radius=11,
+                   gain=0.57,
+                   max_mag=20,
+                   comp_cache_dir=None):
+
+        """
+        Makes the decisions shared by all frames of a photometry run
+        on its first frame: the aperture radius and the comparison stars.
+        The aperture optimizer of the run, with its cache, is returned too.
+        @param fitsfile: Path of the first FITS file of the run.
+        @type fitsfile: path
+        @param aper_radius: Aperture radius. If None, calculated from
+        the aperture test of the brightest asteroid.
+        @type aper_radius: float
+        @param plot_aper_test: Plot aperture test graph
+        @type plot_aper_test: bloean
+        @param multi_object: Apply photometry for other asteroids in the frame?
+        @type multi_object: boolean
+        @param target: Target object that photometry applied. If None,
+        will be taken form FITS header.
+        @type target: str
+        @param radius: SkyBoT search radius.
+        @type radius: float
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @param max_mag: Faintest object limit.
+        @type max_mag: float
+        @param comp_cache_dir: Directory of the CompCatalog field
+        catalogues. If None, they are only kept in memory.
+        @type comp_cache_dir: path
+        @return: dict
+        """
+
+        frame = self.load_frame(fitsfile,
+                                multi_object=multi_object,
+                                target=target,
+                                radius=radius,
+                                max_mag=max_mag)
+
+        asteroids = frame['asteroids']
+
+        if len(asteroids) == 0:
+            print("No asteroid found in the {0}!".format(fitsfile))
+            raise SystemExit
+
+        # optimum apertures are cached for the run
+        aper_ops = ApertureOps()
+
+        if aper_radius is None:
+            # curves of growth of all asteroids at once, the first
+            # asteroid with a SNR maximum decides
+            apers, snr = aper_ops.growth_curves(frame['data_sub'],
+                                                frame['x'],
+                                                frame['y'],
+                                                err=frame['rms'],
+                                                gain=gain)
+            best = aper_ops.best_apertures(apers, snr)
+            found = np.flatnonzero(np.isfinite(best))
+
+            if len(found) > 0:
+                i = found[0]
+                aper_radius = best[i]
+                print("Aperture calculated: {0} px".format(aper_radius))
+
+                if plot_aper_test:
+                    maxtab, mintab = peakdet(snr[i], aper_ops.delta, apers)
+                    plt.title(asteroids['num'][i])
+                    plt.xlabel('Aperture (px)')
+                    plt.ylabel('SNR')
+
+                    plt.scatter(apers,
+                                snr[i])
+                    plt.scatter(maxtab[:, 0], maxtab[:, 1],
+                                color='red')
+                    if len(mintab) > 0:
+                        plt.scatter(mintab[:, 0], mintab[:, 1],
+                                    color='yellow')
+                    plt.show()
+
+        if aper_radius is None:
+            print("Aperture could not be calculated!")
+            raise SystemExit
+
+        min_mag_ast = float(asteroids['m_v'][0]) - 2
+
+        # queried once per field and night
+        s_comptable = CompCatalog(cache_dir=comp_cache_dir).get(
+            frame['ast_coors'].ra.degree[0],
+            frame['ast_coors'].dec.degree[0],
+            frame['onight'],
+            radius=5.0 / 60.0,
+            min_mag=min_mag_ast,
+            max_mag=19.5)
+
+        return({"aper_radius": float(aper_radius),
+                "comptable": s_comptable,
+                "aper_ops": aper_ops})
+
+    def frame_phot(self, fitsfile, setup,
+                   multi_object=True,
+                   target=None,
+                   radius=11,
+                   gain=0.57,
+                   max_mag=20,
+                   comp_snr=50,
+                   adaptive_aper=False):
+
+        """
+        Photometry of the asteroids in a frame with the aperture radius
+        and comparison stars shared by the run.
+        @param fitsfile: Path of FITS file.
+        @type fitsfile: path
+        @param setup: Return of the phot_setup.
+        @type setup: dict
+        @param multi_object: Apply photometry for other asteroids in the frame?
+        @type multi_object: boolean
+        @param target: Target object that photometry applied. If None,
+        will be taken form FITS header.
+        @type target: str
+        @param radius: SkyBoT search radius.
+        @type radius: float
+        @param gain: gain value for the image expressed in electrons per adu.
+        @type gain: float
+        @param max_mag: Faintest object limit.
+        @type max_mag: float
+        @param comp_snr: Minimum SNR of detected comparison star.
+        @type comp_snr: float
+        @param adaptive_aper: Optimize the aperture radius again when
+        the FWHM of the frame drifts to another seeing bin?
+        @type adaptive_aper: boolean
+        @return: dict
+        """
+
+        ac = AstCalc()
+        ql = QuickLook()
+        frame = self.load_frame(fitsfile,
+                                multi_object=multi_object,
+                                target=target,
+                                radius=radius,
+                                max_mag=max_mag)
+
+        aper_radius = setup['aper_radius']
+        asteroids = frame['asteroids']
+
+        if adaptive_aper and len(asteroids) > 0:
+            # cached per (asteroid, night, seeing bin)
+            best = setup['aper_ops'].apertures(frame['data_sub'],
+                                               frame['x'],
+                                               frame['y'],
+                                               asteroids['num'],
+                                               frame['onight'],
+                                               err=frame['rms'],
+                                               gain=gain)
+            found = np.flatnonzero(np.isfinite(best))
+            if len(found) > 0:
+                aper_radius = float(best[found[0]])
+        exptime = float(frame['exptime'])
+
+        # quicklook is only described here, rendered by QuickLook
+        overlay = ql.overlay(fitsfile, info=[frame['odate']])
+
+        # phot asteroids
+        ast_phot = self.batch_phot(frame['data_sub'],
+                                   frame['x'],
+                                   frame['y'],
+                                   6,
+                                   err=frame['rms'],
+                                   gain=gain)
+
+        # phot comp. stars
+        comps = self.comp_phot(frame['data_sub'],
+                               frame['wcs'],
+                               setup['comptable'],
+                               frame['naxis1'],
+                               frame['naxis2'],
+                               aper_radius,
+                               exptime,
+                               err=frame['rms'],
+                               gain=gain,
+                               comp_snr=comp_snr,
+                               fitsfile=fitsfile)
+
+        for comp in comps:
+            label = '{0}'.format(comp['NOMAD1'])
+            ql.add_circle(overlay, comp['x'], comp['y'], aper_radius,
+                          colour=(0, 255, 0), label=label)
+
+        tables = []
+
+        for i in range(len(asteroids)):
+            flux = ast_phot['flux'][i]
+            fluxerr = ast_phot['fluxerr'][i]
+
+            if flux == 0.0 or fluxerr == 0.0:
+                print("Bad asteroid selected (out of frame!)!")
+                raise SystemExit
+
+            label = '{0}'.format(asteroids['num'][i])
+            ql.add_circle(overlay, frame['x'][i], frame['y'][i], aper_radius,
+                          colour=(255, 0, 0), label=label)
+
+            if len(comps) == 0:
+                print("{0}: no comparison star, {1} skipped!".format(
+                    fitsfile, asteroids['num'][i]))
+                continue
+
+            if flux < 0:
+                print("{0}: negative flux, {1} skipped!".format(
+                    fitsfile, asteroids['num'][i]))
+                continue
+
+            magt_i = ac.flux2mag(flux, exptime)
+            magt_i_err = fluxerr / flux * 2.5 / math.log(10)
+
+            tables.append(self.phot_table(asteroids['num'][i],
+                                          frame['jd'],
+                                          frame['onight'],
+                                          magt_i,
+                                          magt_i_err,
+                                          asteroids['m_v'][i],
+                                          comps,
+                                          frame['filter'],
+                                          exptime))
+
+        return({"fitsfile": fitsfile,
+                "jd": frame['jd'],
+                "tables": tables,
+                "overlay": overlay})
+
+    def phot_table(self, ast_num, jd, onight,
+                   magt_i, magt_i_err,
+                   ast_mag_cat,
+                   comps,
+                   filter,
+                   exptime):
+
+        """
+        Result table of an asteroid in a frame, one row per
+        comparison star.
+        @param ast_num: Asteroid's number.
+        @type ast_num: str
+        @param jd: JD of the frame.
+        @type jd: float
+        @param onight: Observation night.
+        @type onight: str
+        @param magt_i: Instrumental magnitude of the asteroid.
+        @type magt_i: float
+        @param magt_i_err: Error of the instrumental magnitude.
+        @type magt_i_err: float
+        @param ast_mag_cat: Catalogue magnitude of the asteroid.
+        @type ast_mag_cat: float
+        @param comps: Return of the comp_phot.
+        @type comps: astropy.table
+        @param filter: Filter of the frame.
+        @type filter: str
+        @param exptime: Exposure time of the frame.
+        @type exptime: float
+        @return: astropy.table
+        """
+
+        n_comps = len(comps)
+
+        magt = (magt_i - comps['magc_i']) + comps['Rmag']
+        magt_err = np.sqrt(np.power(magt_i_err, 2) +
+                           np.power(comps['magc_i_err'], 2))
+
+        # inverse variance weighted magnitude average
+        magt_avr = np.average(magt, weights=1.0 / np.power(magt_err, 2))
+
+        # magt_std calc.
+        magt_std = np.std(magt)
+
+        phot_res_table = Table([np.repeat(ast_num, n_comps),
+                                np.repeat(jd, n_comps),
+                                np.repeat(onight, n_comps),
+                                np.repeat(magt_i, n_comps),
+                                np.repeat(magt_i_err, n_comps),
+                                comps['magc_i'],
+                                comps['magc_i_err'],
+                                magt,
+                                magt_err,
+                                np.repeat(ast_mag_cat, n_comps),
+                                comps['NOMAD1'],
+                                comps['Rmag'],
+                                np.repeat(magt_avr, n_comps),
+                                np.repeat(magt_std, n_comps),
+                                np.repeat(filter, n_comps),
+                                np.repeat(exptime, n_comps)],
+                               names=('ast_num',
+                                      'jd',
+                                      'onight',
+                                      'magt_i',
+                                      'magt_i_err',
+                                      'magc_i',
+                                      'magc_i_err',
+                                      'magt',
+                                      'magt_err',
+                                      'ast_mag_cat',
+                                      'nomad1',
+                                      'star_Rmag',
+                                      'magt_avr',
+                                      'magt_std',
+                                      'filter',
+                                      'exposure'),
+                               dtype=('U10',
+                                      'f8',
+                                      'U10',
+                                      'f8',
+                                      'f8',
+                                      'f8',
+                                      'f8',
+                                      'f8',
+                                      'f8',
+                                      'f8',
+                                      'U20',
+                                      'f8',
+                                      'f8',
+                                      'f8',
+                                      'U20',
+                                      'f8'))
+
+        phot_res_table['magt_i'].format = '.3f'
+        phot_res_table['magt_i_err'].format = '.3f'
+        phot_res_table['magc_i'].format = '.3f'
+        phot_res_table['magc_i_err'].format = '.3f'
+        phot_res_table['magt'].format = '.3f'
+        phot_res_table['magt_err'].format = '.3f'
+        phot_res_table['magt_avr'].format = '.3f'
+        phot_res_table['magt_std'].format = '.3f'
+
+        return(phot_res_table)
+
     def asteroids_phot(self, image_path,
                        multi_object=True,
                        target=None,
@@ -163,7 +764,16 @@ class PhotOps:
                        table_name="asteroids",
                        gain=0.57,
                        max_mag=20,
-                       comp_snr=50):
+                       comp_snr=50,
+                       n_jobs=1,
+                       quicklook="background",
+                       quicklook_jobs=2,
+                       ascii_export=True,
+                       resume=True,
+                       checkpoint_every=20,
+                       comp_cache_dir=None,
+                       adaptive_aper=False,
+                       ensemble=True):
 
         """
         Photometry of asteroids.
@@ -174,351 +784,210 @@ class PhotOps:
         @param target: Target object that photometry applied. If None,
         will be taken form FITS header.
         @type target: float
+        @param aper_radius: Aperture radius. If None, calculated once
+        on the first frame and used for all frames.
+        @type aper_radius: float
         @param radius: Aperture radius
         @type radius: float
         @param exposure: Exposure keyword of phot images.
         @type exposure: float
         @param plot_aper_test: Plot aperture test graph
         @type plot_aper_test: bloean
-        @param exportdb: Export results SQLite3 database
-        @type exportdb: path
-        @param db_table: SQLite3 database table
-        @type db_table: path
+        @param sqlite_file: Export results SQLite3 database
+        @type sqlite_file: path
+        @param table_name: SQLite3 database table
+        @type table_name: str
         @param gain: gain value for the image expressed in electrons per adu.
         @type gain: float
         @param max_mag: Faintest object limit.
         @type max_mag: float
         @param comp_snr: Minimum SNR of detected comparison star.
         @type comp_snr: float
+        @param n_jobs: Number of processes that frames are fanned out to.
+        1 runs in this process, None uses all CPUs.
+        @type n_jobs: int
+        @param quicklook: PNG quicklooks of frames. "background" renders
+        them in a separate worker pool while photometry goes on, "deferred"
+        only writes their overlays to <cwd>/quicklook.json to be rendered
+        later with QuickLook.render_file, None skips them.
+        @type quicklook: str
+        @param quicklook_jobs: Number of background rendering processes.
+        @type quicklook_jobs: int
+        @param ascii_export: Results are written to <cwd>/<asteroid>.npz.
+        Also export them as <cwd>/<asteroid>.txt tables?
+        @type ascii_export: boolean
+        @param resume: Progress of the run is journaled in
+        <cwd>/.phot_journal.json. If an interrupted run with the same
+        parameters is found, skip its completed frames?
+        @type resume: boolean
+        @param checkpoint_every: Number of frames between checkpoints.
+        Results of the frames after the last checkpoint are computed
+        again on resume.
+        @type checkpoint_every: int
+        @param comp_cache_dir: Directory where comparison star catalogues
+        are kept, so runs on the same field and night query NOMAD once.
+        If None, they are only kept in memory.
+        @type comp_cache_dir: path
+        @param adaptive_aper: Optimize the aperture radius of a frame
+        again when its FWHM drifts to another seeing bin? If False, the
+        aperture radius of the first frame is used for all frames.
+        @type adaptive_aper: boolean
+        @param ensemble: Also write the ensemble light curves of all
+        asteroids (EnsembleOps) to <cwd>/ensemble_lc.ecsv?
+        @type ensemble: boolean
         @return: bolean and file
         """
-        
-        if ".fit" in os.path.basename(image_path):
-            fitslist = sorted(glob.glob(image_path))
-            if fitslist == 0:
-                print('No image FITS found in the {0}'.format(image_path))
-                raise SystemExit
-        else:
-            fitslist = sorted(glob.glob(image_path + '/*.fit?'))
-            if fitslist == 0:
-                print('No image FITS found in the {0}'.format(image_path))
-                raise SystemExit
 
-        # aper_trigger check count
-        aper_count = 0
-        
-        for id, fitsfile in enumerate(fitslist):
-            if fitsfile:
-                hdu = fits.open(fitsfile)[0]
-            else:
-                print("FITS image has not been provided by the user!")
-                raise SystemExit
+        fitslist = self.phot_fitslist(image_path, exposure=exposure)
 
-            sb = Query()
-            ac = AstCalc()
-            to = TimeOps()
-            fo = FitsOps(fitsfile)
-            header = hdu.header
-            w = WCS(header)
-
-            naxis1 = fo.get_header('naxis1')
-            naxis2 = fo.get_header('naxis2')
-            odate = fo.get_header('date-obs')
-            t1 = Time("{0}".format(odate),
-                      out_subfmt="date")
-            dt = TimeDelta(12 * 3600, format='sec')
-            onight = t1 - dt
-            exptime = fo.get_header('exptime')
-
-            if exptime is not None and exposure is not None:
-                if float(exptime) != exposure:
-                    continue
-
-            if aper_count == 0:
-                aper_trigger = id
-                aper_count += 1
+        if len(fitslist) == 0:
+            print('No image FITS found in the {0}'.format(image_path))
+            raise SystemExit
 
-            if target is None:
-                objct = fo.get_header('object')
-            else:
-                objct = str(target)
-            filter = fo.get_header('filter').replace(" ", "_")
-            # t1 = Time(odate.replace('T', ' '))
-            # exptime = fo.get_header('exptime')
-            # dt = TimeDelta(exptime / 2.0, format='sec')
-            # odate_middle = t1 + dt
-            # jd = to.date2jd(odate_middle.value)
-            jd = to.date2jd(odate)
-            ra_dec = ac.center_finder(fitsfile, wcs_ref=True)
-
-            image = f2n.fromfits(fitsfile, verbose=False)
-            image.setzscale('auto', 'auto')
-            image.makepilimage('log', negative=False)
-
-            request = sb.find_skybot_objects(odate,
-                                             ra_dec[0].degree,
-                                             ra_dec[1].degree,
-                                             radius=radius)
-
-            if request[0]:
-                if multi_object:
-                    asteroids = Table(np.sort(request[1][::-1],
-                                              order=['m_v']))
-                else:
-                    asteroids = Table(np.sort(request[1],
-                                              order=['num']))
-                    mask = asteroids['num'] == str(objct).upper()
-                    asteroids = asteroids[mask]
-            elif request[0] is False:
-                print(request[1])
-                raise SystemExit
+        journal = RunJournal('{0}/.phot_journal.json'.format(os.getcwd()))
+        params = {"fitslist": fitslist,
+                  "multi_object": multi_object,
+                  "target": target,
+                  "aper_radius": aper_radius,
+                  "radius": radius,
+                  "gain": gain,
+                  "max_mag": max_mag,
+                  "comp_snr": comp_snr,
+                  "adaptive_aper": adaptive_aper}
+
+        # rows are only written at checkpoints
+        sink = ResultSink(out_dir=os.getcwd(),
+                          batch_size=None,
+                          ascii_export=ascii_export)
+
+        # deferred overlays are appended to it at checkpoints
+        quicklook_file = '{0}/quicklook.json'.format(os.getcwd())
+
+        state = journal.resume(params) if resume else None
+
+        if state is not None:
+            setup = {"aper_radius": state['setup']['aper_radius'],
+                     "comptable": Table.read(state['setup']['comptable'],
+                                             format='ascii.ecsv'),
+                     "aper_ops": ApertureOps()}
+            journal.rollback(sink)
+            frames_done = journal.frames_done()
+            print("Resuming the run, {0} of {1} frames are done.".format(
+                len(frames_done), len(fitslist)))
+        else:
+            # aperture radius and comp. stars are decided once
+            setup = self.phot_setup(fitslist[0],
+                                    aper_radius=aper_radius,
+                                    plot_aper_test=plot_aper_test,
+                                    multi_object=multi_object,
+                                    target=target,
+                                    radius=radius,
+                                    gain=gain,
+                                    max_mag=max_mag,
+                                    comp_cache_dir=comp_cache_dir)
+            comptable_ecsv = StringIO()
+            setup['comptable'].write(comptable_ecsv, format='ascii.ecsv')
+            journal.start(params,
+                          {"aper_radius": setup['aper_radius'],
+                           "comptable": comptable_ecsv.getvalue()},
+                          append_files=[quicklook_file])
+            frames_done = set()
+
+        n_frames = len(fitslist)
+        fitslist = [fitsfile for fitsfile in fitslist
+                    if fitsfile not in frames_done]
+
+        frame_phot = partial(self.frame_phot,
+                             setup=setup,
+                             multi_object=multi_object,
+                             target=target,
+                             radius=radius,
+                             gain=gain,
+                             max_mag=max_mag,
+                             comp_snr=comp_snr,
+                             adaptive_aper=adaptive_aper)
+
+        if n_jobs == 1:
+            executor = None
+            results = map(frame_phot, fitslist)
+        else:
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+            results = executor.map(frame_phot, fitslist)
 
-            data = hdu.data.astype(float)
+        ql = QuickLook(n_jobs=quicklook_jobs)
 
-            bkg = sep.Background(data)
-            data_sub = data - bkg
+        if sqlite_file is not None:
+            db_writer = DBWriter(sqlite_file=sqlite_file,
+                                 table_name=table_name)
+        else:
+            db_writer = None
+
+        pending_frames = []
+        pending_overlays = []
+        completed = False
+
+        try:
+            # results come in JD order
+            for id, result in enumerate(results):
+                for phot_res_table in result['tables']:
+                    sink.append(phot_res_table)
+                    if db_writer is not None:
+                        self.table_to_database(phot_res_table,
+                                               writer=db_writer)
+
+                if quicklook == "background":
+                    ql.submit(result['overlay'])
+                elif quicklook == "deferred":
+                    pending_overlays.append(result['overlay'])
+
+                pending_frames.append(result['fitsfile'])
+
+                if len(pending_frames) >= checkpoint_every:
+                    if len(pending_overlays) > 0:
+                        ql.save(pending_overlays, quicklook_file)
+                    journal.checkpoint(sink, pending_frames)
+                    pending_frames = []
+                    pending_overlays = []
+
+                self.update_progress(
+                    "Photometry is done for: {0}".format(result['fitsfile']),
+                    (n_frames - len(fitslist) + id + 1) / n_frames)
+
+            if len(pending_overlays) > 0:
+                ql.save(pending_overlays, quicklook_file)
+            journal.checkpoint(sink, pending_frames)
+            completed = True
+        finally:
+            if executor is not None:
+                # on errors (or Ctrl-C) queued frames are not run
+                executor.shutdown(wait=completed,
+                                  cancel_futures=not completed)
+            if completed:
+                # ASCII tables are exported before the journal is removed
+                sink.close()
+                journal.finish()
+            # otherwise rows after the last checkpoint are dropped
+            # and computed again on resume
+            try:
+                if db_writer is not None:
+                    db_writer.close()
+            except Exception as e:
+                # the error of the run is not hidden
+                if completed:
+                    raise
+                print("Database writer could not be closed: {0}".format(e))
+            finally:
+                ql.wait()
+
+        if ensemble and len(sink.touched) > 0:
+            # light curves of all asteroids against all comparison stars
+            eo = EnsembleOps()
+            solution = eo.solve(eo.read_results(
+                [sink.npz_path(target) for target in sorted(sink.touched)]))
+            solution['light_curves'].write(
+                '{0}/ensemble_lc.ecsv'.format(os.getcwd()),
+                format='ascii.ecsv', overwrite=True)
 
-            for i in range(len(asteroids)):
-                if float(asteroids['m_v'][i]) <= max_mag:
-                    c = coordinates.SkyCoord('{0} {1}'.format(
-                        asteroids['ra(h)'][i],
-                        asteroids['dec(deg)'][i]),
-                                             unit=(u.hourangle, u.deg),
-                                             frame='icrs')
-
-                    # asteroid's X and Y coor
-                    a_x, a_y = w.wcs_world2pix(c.ra.degree, c.dec.degree, 1)
-
-                    if naxis1 < a_x or naxis2 < a_y or a_x < 0 or a_y < 0:
-                        continue
-
-                    # phot asteroids
-                    flux, fluxerr, flag = sep.sum_circle(
-                        data_sub,
-                        a_x,
-                        a_y,
-                        6,
-                        err=bkg.globalrms,
-                        gain=gain)
-
-                    if flux == 0.0 or fluxerr == 0.0:
-                        print("Bad asteroid selected (out of frame!)!")
-                        raise SystemExit
-
-                    if id == aper_trigger:
-                        snr = []
-                        for aper in range(30):
-                            # phot asteroids
-                            flux_test, fluxerr_test, flag_test = sep.sum_circle(
-                                data_sub,
-                                a_x,
-                                a_y,
-                                aper,
-                                err=bkg.globalrms,
-                                gain=gain)
-
-                            snr.append([aper, (flux_test/fluxerr_test)])
-
-                        npsnr = np.array(snr)
-                        maxtab, mintab = peakdet(npsnr[:, 1], 0.1)
-                        try:
-                            aper_radius = maxtab[:, 0][0]
-                            print("Aperture calculated: {0} px".format(
-                                aper_radius))
-                        except IndexError:
-                            continue
-                        
-                        if plot_aper_test:
-                            plt.title(asteroids['num'][i])
-                            plt.xlabel('Aperture (px)')
-                            plt.ylabel('SNR')
-                            
-                            plt.scatter(npsnr[:, 0],
-                                        npsnr[:, 1])
-                            plt.scatter(maxtab[:, 0], maxtab[:, 1],
-                                        color='red')
-                            plt.scatter(mintab[:, 0], mintab[:, 1],
-                                        color='yellow')
-                            plt.show()
-
-                    magt_i = ac.flux2mag(flux, float(exptime))
-                    magt_i_err = fluxerr / flux * 2.5 / math.log(10)
-
-                    min_mag_ast = float(asteroids['m_v'][i]) - 2
-
-                    label = '{0}'.format(asteroids['num'][i])
-                    image.drawcircle(a_x, a_y, r=aper_radius,
-                                     colour=(255, 0, 0), label=label)
-
-                    if i == 0 and id == aper_trigger:
-                        comptable = sb.query_color(c.ra.degree,
-                                                   c.dec.degree,
-                                                   5.0 / 60.0,
-                                                   min_mag=min_mag_ast,
-                                                   max_mag=19.5)
-
-                        s_comptable = sb.sort_stars(comptable, min_mag_ast)
-
-                        if len(s_comptable) == 0:
-                            continue
-
-                    phot_res_list = []
-
-                    # phot comp. stars
-                    for j in range(len(s_comptable)):
-                        # star's X and Y coor
-                        s_x, s_y = w.wcs_world2pix(s_comptable['RAJ2000'][j],
-                                                   s_comptable['DEJ2000'][j],
-                                                   1)
-
-                        if naxis1 < s_x or naxis2 < s_y or s_x < 0 or s_y < 0:
-                            continue
-
-                        # print('Circle', s_x, s_y, 10)
-
-                        flux, fluxerr, flag = sep.sum_circle(
-                            data_sub,
-                            s_x,
-                            s_y,
-                            aper_radius,
-                            err=bkg.globalrms,
-                            gain=gain)
-
-                        if flux == 0.0 or fluxerr == 0.0:
-                            print("Bad star selected!")
-                            raise SystemExit
-
-                        if (flux / fluxerr) <= comp_snr:
-                            continue
-                    
-                        magc_i = ac.flux2mag(flux, float(exptime))
-                        magc_i_err = fluxerr / flux * 2.5 / math.log(10)
-
-                        try:
-                            magt = (float(magt_i) -
-                                    float(magc_i)) + s_comptable['Rmag'][j]
-                            magt_err = math.sqrt(
-                                math.pow(float(magt_i_err), 2) +
-                                math.pow(float(magc_i_err), 2))
-                        except:
-                            continue
-
-                        label = '{0}'.format(s_comptable['NOMAD1'][j])
-                        image.drawcircle(s_x, s_y, r=aper_radius,
-                                         colour=(0, 255, 0), label=label)
-
-                        phot_res_list.append([asteroids['num'][i],
-                                              jd,
-                                              onight.iso,
-                                              float(magt_i),
-                                              float(magt_i_err),
-                                              float(magc_i),
-                                              float(magc_i_err),
-                                              float(magt),
-                                              float(magt_err),
-                                              asteroids['m_v'][i],
-                                              s_comptable['NOMAD1'][j],
-                                              s_comptable['Rmag'][j]])
-
-                    np_phot_res = np.array(phot_res_list)
-
-                    if len(np_phot_res) == 0:
-                        continue
-
-                    # magnitude average
-                    magt_avr = np.average(np_phot_res[:, 7].astype(float),
-                                          weights=np_phot_res[:, 8].astype(
-                                               float))
-
-                    # magt_std calc.
-                    magt_std = np.std(np_phot_res[:, 7].astype(float))
-                    
-                    np_magt_avr_std = [[magt_avr,
-                                        magt_std,
-                                        filter,
-                                        exptime] for i in range(
-                        len(np_phot_res))]
-                    
-                    k = np.array(np_magt_avr_std).reshape(
-                        len(np_magt_avr_std), 4)
-
-                    # numpy array with magt_avr
-                    np_phot_res_avg_std = np.concatenate(
-                        (np_phot_res,
-                         k),
-                        axis=1)
-
-                    phot_res_table = Table(np_phot_res_avg_std,
-                                           names=('ast_num',
-                                                  'jd',
-                                                  'onight',
-                                                  'magt_i',
-                                                  'magt_i_err',
-                                                  'magc_i',
-                                                  'magc_i_err',
-                                                  'magt',
-                                                  'magt_err',
-                                                  'ast_mag_cat',
-                                                  'nomad1',
-                                                  'star_Rmag',
-                                                  'magt_avr',
-                                                  'magt_std',
-                                                  'filter',
-                                                  'exposure'),
-                                           dtype=('U10',
-                                                  'S25',
-                                                  'U10',
-                                                  'f8',
-                                                  'f8',
-                                                  'f8',
-                                                  'f8',
-                                                  'f8',
-                                                  'f8',
-                                                  'f8',
-                                                  'U20',
-                                                  'f8',
-                                                  'f8',
-                                                  'f8',
-                                                  'U20',
-                                                  'f8'))
-
-                    phot_res_table['magt_i'].format = '.3f'
-                    phot_res_table['magt_i_err'].format = '.3f'
-                    phot_res_table['magc_i'].format = '.3f'
-                    phot_res_table['magc_i_err'].format = '.3f'
-                    phot_res_table['magt'].format = '.3f'
-                    phot_res_table['magt_err'].format = '.3f'
-                    phot_res_table['magt_avr'].format = '.3f'
-                    phot_res_table['magt_std'].format = '.3f'
-
-                    with open('{0}/{1}.txt'.format(
-                            os.getcwd(),
-                            asteroids['num'][i]), 'a') as f_handle:
-                        f_handle.seek(0, os.SEEK_END)
-
-                        if not os.path.isfile(str(f_handle)):
-                            phot_res_table.write(
-                                f_handle,
-                                format='ascii.commented_header')
-                        else:
-                            phot_res_table.write(f_handle,
-                                                 format='ascii.no_header')
-                        if sqlite_file is not None:
-                            self.table_to_database(phot_res_table,
-                                                   sqlite_file=sqlite_file,
-                                                   table_name=table_name)
-
-
-            # Test
-            time.sleep(0.2)
-            self.update_progress(
-                "Photometry is done for: {0}".format(fitsfile),
-                id / len(fitslist))
-            image.writetitle(os.path.basename(fitsfile))
-
-            fitshead, fitsextension = os.path.splitext(fitsfile)
-            image.writeinfo([odate], colour=(255, 100, 0))
-            image.tonet('{0}.png'.format(fitshead))
         self.update_progress("Photometry done!", 1)
         return(True)
 
@@ -526,41 +995,266 @@ class PhotOps:
                           table,
                           sqlite_file="observations",
                           table_name="asteroids",
-                          keywords=None):
-
-        if keywords is None:
-            keywords = ['ast_num',
-                        'jd',
-                        'onight',
-                        'magt_i',
-                        'magt_i_err',
-                        'magc_i',
-                        'magc_i_err',
-                        'magt',
-                        'magt_err',
-                        'ast_mag_cat',
-                        'nomad1',
-                        'star_Rmag',
-                        'magt_avr',
-                        'magt_std',
-                        'filter',
-                        'exposure']
-
-        # Connecting to the database file
-        conn = sqlite3.connect(sqlite_file)
-        c = conn.cursor()
-
-        for row in table:
-            c.execute("INSERT OR IGNORE INTO {tn} {cn} VALUES {vls}".format(
-                tn=table_name,
-                cn=tuple(keywords),
-                vls=tuple(row)))
-
-        conn.commit()
-        conn.close()
+                          keywords=None,
+                          writer=None):
+
+        """
+        Writes photometry results to SQLite3 database.
+        @param table: Result table.
+        @type table: astropy.table
+        @param sqlite_file: SQLite3 database file.
+        @type sqlite_file: path
+        @param table_name: SQLite3 database table.
+        @type table_name: str
+        @param keywords: Columns to be written. If None, all columns
+        of the asteroids_phot results.
+        @type keywords: list
+        @param writer: Persistent writer to be used instead of
+        opening the database for this call.
+        @type writer: io.DBWriter
+        @return: boolean
+        """
+
+        if writer is not None:
+            writer.write(table)
+            return(True)
+
+        writer = DBWriter(sqlite_file=sqlite_file,
+                          table_name=table_name,
+                          columns=keywords,
+                          threaded=False)
+        writer.write(table)
+        writer.close()
 
         return (True)
 
     def find_best_comparison(self, result_table):
 
         return(True)
+
+
+class EnsembleOps:
+
+    def read_results(self, result_files):
+
+        """
+        Reads and stacks photometry results of many asteroids.
+        @param result_files: Result files (<ast_num>.npz or <ast_num>.txt).
+        @type result_files: list
+        @return: astropy.table
+        """
+
+        tables = []
+        for result_file in result_files:
+            if result_file.endswith('.npz'):
+                tables.append(ResultSink().read_file(result_file,
+                                                     mmap=False))
+            else:
+                tables.append(Table.read(result_file,
+                                         format='ascii.commented_header'))
+
+        return(vstack(tables, metadata_conflicts='silent'))
+
+    def star_matrix(self, results):
+
+        """
+        Frame x star matrices of comparison star measurements.
+        @param results: Photometry results (asteroids_phot columns).
+        @type results: astropy.table
+        @return: dict
+        """
+
+        jds, frame_idx = np.unique(np.asarray(results['jd'], dtype=float),
+                                   return_inverse=True)
+        stars, star_idx = np.unique(np.asarray(results['nomad1']).astype(str),
+                                    return_inverse=True)
+
+        n_frames = len(jds)
+        n_stars = len(stars)
+
+        mag = np.full((n_frames, n_stars), np.nan)
+        err = np.full((n_frames, n_stars), np.nan)
+        rmag = np.full(n_stars, np.nan)
+
+        # a star is repeated for every asteroid of the frame
+        mag[frame_idx, star_idx] = results['magc_i']
+        err[frame_idx, star_idx] = results['magc_i_err']
+        rmag[star_idx] = results['star_Rmag']
+
+        return({"jd": jds,
+                "nomad1": stars,
+                "mag": mag,
+                "err": err,
+                "Rmag": rmag})
+
+    def solve(self, results,
+              sigma=3.0,
+              clip_iters=10,
+              min_err=0.001):
+
+        """
+        Ensemble differential photometry. Per-frame zero points and
+        per-star magnitudes (m_inst[frame, star] = zp[frame] + m[star])
+        are solved as one sparse weighted least squares system with a
+        gauge constraint (mean star magnitude is zero), with sigma
+        clipping of the residuals. All asteroids' instrumental
+        magnitudes are then calibrated with the zero points at once.
+        @param results: Photometry results (asteroids_phot columns)
+        of one or more asteroids.
+        @type results: astropy.table
+        @param sigma: Rejection limit of residuals (in robust sigmas).
+        @type sigma: float
+        @param clip_iters: Maximum number of rejection iterations.
+        @type clip_iters: int
+        @param min_err: Error floor of measurements (in mag).
+        @type min_err: float
+        @return: dict of astropy.tables (frames, stars, light_curves)
+        """
+
+        sm = self.star_matrix(results)
+        n_frames, n_stars = sm['mag'].shape
+
+        # measurements as a sparse list of (frame, star)
+        frame_idx, star_idx = np.nonzero(np.isfinite(sm['mag']) &
+                                         np.isfinite(sm['err']))
+        obs = sm['mag'][frame_idx, star_idx]
+        obs_weight = 1.0 / np.power(
+            np.maximum(sm['err'][frame_idx, star_idx], min_err), 2)
+        used = np.ones(len(obs), dtype=bool)
+
+        for clip_iter in range(clip_iters + 1):
+            zp, star_mag = self._lsq(frame_idx, star_idx, obs,
+                                     np.where(used, obs_weight, 0.0),
+                                     n_frames, n_stars)
+
+            if clip_iter == clip_iters or used.sum() < 3:
+                break
+
+            # robust sigma of the residuals
+            resid = obs - zp[frame_idx] - star_mag[star_idx]
+            r_med = np.median(resid[used])
+            r_std = 1.4826 * np.median(np.abs(resid[used] - r_med))
+
+            # quantised residuals, nothing can be rejected
+            if r_std == 0:
+                break
+
+            reject = used & (np.abs(resid - r_med) > sigma * r_std)
+            if not reject.any():
+                break
+
+            used &= ~reject
+
+        weight = np.where(used, obs_weight, 0.0)
+        sum_w_frame = np.bincount(frame_idx, weight, minlength=n_frames)
+        n_frame = np.bincount(frame_idx[used], minlength=n_frames)
+        n_star = np.bincount(star_idx[used], minlength=n_stars)
+
+        # zero points are relative to the catalogue magnitudes
+        has_cat = np.isfinite(sm['Rmag']) & (n_star > 0)
+        if has_cat.any():
+            offset = np.median(star_mag[has_cat] - sm['Rmag'][has_cat])
+            zp = zp + offset
+            star_mag = star_mag - offset
+
+        resid2 = np.where(used,
+                          np.power(obs - zp[frame_idx] - star_mag[star_idx],
+                                   2), 0.0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zp_err = 1.0 / np.sqrt(sum_w_frame)
+            star_rms = np.sqrt(np.bincount(star_idx, resid2,
+                                           minlength=n_stars) / n_star)
+
+        zp[n_frame == 0] = np.nan
+        star_mag[n_star == 0] = np.nan
+
+        frames = Table([sm['jd'], zp, zp_err, n_frame],
+                       names=('jd', 'zp', 'zp_err', 'n_stars'))
+
+        stars = Table([sm['nomad1'],
+                       sm['Rmag'],
+                       star_mag,
+                       star_mag - sm['Rmag'],
+                       star_rms,
+                       n_star],
+                      names=('nomad1', 'star_Rmag', 'mag',
+                             'offset', 'rms', 'n_frames'))
+
+        # one row per asteroid and frame
+        keys = np.char.add(np.asarray(results['ast_num']).astype(str),
+                           np.char.mod('%.8f', np.asarray(results['jd'],
+                                                          dtype=float)))
+        keys, first = np.unique(keys, return_index=True)
+        targets = results[np.sort(first)]
+
+        target_frame = np.searchsorted(sm['jd'],
+                                       np.asarray(targets['jd'], dtype=float))
+
+        lc_mag = targets['magt_i'] - zp[target_frame]
+        lc_err = np.sqrt(np.power(targets['magt_i_err'], 2) +
+                         np.power(zp_err[target_frame], 2))
+
+        light_curves = Table([targets['ast_num'],
+                              targets['jd'],
+                              lc_mag,
+                              lc_err,
+                              targets['magt_i'],
+                              zp[target_frame]],
+                             names=('ast_num', 'jd', 'mag', 'mag_err',
+                                    'magt_i', 'zp'))
+        light_curves.sort(['ast_num', 'jd'])
+
+        return({"frames": frames,
+                "stars": stars,
+                "light_curves": light_curves})
+
+    def _lsq(self, frame_idx, star_idx, obs, weight, n_frames, n_stars):
+
+        # normal equations of obs = zp[frame] + m[star], bordered with
+        # the gauge sum(m) = 0 (Lagrange multiplier), one factorisation
+        sum_w_frame = np.bincount(frame_idx, weight, minlength=n_frames)
+        sum_w_star = np.bincount(star_idx, weight, minlength=n_stars)
+        active_star = sum_w_star > 0
+
+        # unknowns without measurements are pinned to zero, a tiny ridge
+        # keeps frame groups that share no star solvable
+        diag = np.concatenate((sum_w_frame, sum_w_star))
+        ridge = 1e-12 * max(diag.max(initial=0.0), 1.0)
+        diag = np.where(diag > 0, diag + ridge, 1.0)
+
+        n_par = n_frames + n_stars
+        gauge = np.flatnonzero(active_star) + n_frames
+        cross = weight > 0
+
+        rows = np.concatenate((np.arange(n_par),
+                               frame_idx[cross],
+                               star_idx[cross] + n_frames,
+                               gauge,
+                               np.full(len(gauge), n_par)))
+        cols = np.concatenate((np.arange(n_par),
+                               star_idx[cross] + n_frames,
+                               frame_idx[cross],
+                               np.full(len(gauge), n_par),
+                               gauge))
+        values = np.concatenate((diag,
+                                 weight[cross],
+                                 weight[cross],
+                                 np.ones(2 * len(gauge))))
+
+        if len(gauge) == 0:
+            # no measurement at all, the gauge row would be empty
+            rows = np.append(rows, n_par)
+            cols = np.append(cols, n_par)
+            values = np.append(values, 1.0)
+
+        normal = sparse.csc_matrix((values, (rows, cols)),
+                                   shape=(n_par + 1, n_par + 1))
+        rhs = np.concatenate((
+            np.bincount(frame_idx, weight * obs, minlength=n_frames),
+            np.bincount(star_idx, weight * obs, minlength=n_stars),
+            [0.0]))
+
+        solution = spsolve(normal, rhs)
+
+        return(solution[:n_frames], solution[n_frames:n_par])
@@ -0,0 +1,20 @@
+from astrolib import catalog
+import sys
+
+print("""
+Fills the DSS cutout cache with the targets of a night, so finder
+charts can be drawn without a network connection.
+
+targets.txt: one "HH MM SS +DD MM SS" target per line
+
+Example: python3 prefetchdss.py targets.txt [radius_arcmin] [cache_dir]
+
+""")
+
+targets = sys.argv[1]
+radius = float(sys.argv[2]) if len(sys.argv) > 2 else 6
+cache_dir = sys.argv[3] if len(sys.argv) > 3 else None
+
+cc = catalog.CutoutCache(cache_dir)
+n_downloaded = cc.prefetch(targets, radius=radius)
+print("{0} cutouts downloaded into {1}.".format(n_downloaded, cc.cache_dir))
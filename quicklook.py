@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+
+from astropy.io import fits
+from astropy.visualization import ZScaleInterval
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import EllipseCollection
+from matplotlib.image import imsave
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import json
+import os
+import shutil
+
+
+def render_overlay(overlay):
+
+    """
+    Renders an overlay description in a worker process.
+    @param overlay: Return of the QuickLook.overlay.
+    @type overlay: dict
+    @return: path
+    """
+
+    return(QuickLook().render(overlay))
+
+
+class QuickLook:
+
+    def __init__(self, n_jobs=None):
+
+        """
+        PNG quicklook renderer of photometry overlays.
+        @param n_jobs: Number of rendering processes. None uses all CPUs.
+        @type n_jobs: int
+        """
+
+        self.n_jobs = n_jobs
+        self.executor = None
+        self.futures = []
+
+    def overlay(self, fitsfile, title=None, info=None, png_file=None):
+
+        """
+        Creates an empty overlay description of a frame.
+        @param fitsfile: Path of FITS file.
+        @type fitsfile: path
+        @param title: Title of the quicklook. If None, file name is used.
+        @type title: str
+        @param info: Info lines written on the quicklook.
+        @type info: list
+        @param png_file: Output PNG. If None, <fitsfile root>.png is used.
+        @type png_file: path
+        @return: dict
+        """
+
+        if title is None:
+            title = os.path.basename(fitsfile)
+
+        if png_file is None:
+            fitshead, fitsextension = os.path.splitext(fitsfile)
+            png_file = '{0}.png'.format(fitshead)
+
+        if info is None:
+            info = []
+
+        return({"fitsfile": fitsfile,
+                "png_file": png_file,
+                "title": title,
+                "info": [str(line) for line in info],
+                "circles": []})
+
+    def add_circle(self, overlay, x, y, r, colour=(255, 0, 0), label=None):
+
+        """
+        Adds a labeled circle to an overlay description.
+        @param overlay: Return of the overlay.
+        @type overlay: dict
+        @param x: X coordinate of the circle.
+        @type x: float
+        @param y: Y coordinate of the circle.
+        @type y: float
+        @param r: Radius of the circle.
+        @type r: float
+        @param colour: RGB colour of the circle.
+        @type colour: tuple
+        @param label: Label of the circle.
+        @type label: str
+        @return: dict
+        """
+
+        overlay['circles'].append([float(x),
+                                   float(y),
+                                   float(r),
+                                   [int(c) for c in colour],
+                                   None if label is None else str(label)])
+
+        return(overlay)
+
+    def render(self, overlay):
+
+        """
+        Renders an overlay description into a PNG file with f2n.
+        @param overlay: Return of the overlay.
+        @type overlay: dict
+        @return: path
+        """
+
+        try:
+            import f2n
+        except ImportError:
+            print('Python cannot import f2n. Make sure f2n is installed.')
+            raise SystemExit
+
+        image = f2n.fromfits(overlay['fitsfile'], verbose=False)
+        image.setzscale('auto', 'auto')
+        image.makepilimage('log', negative=False)
+
+        for x, y, r, colour, label in overlay['circles']:
+            image.drawcircle(x, y, r=r, colour=tuple(colour), label=label)
+
+        image.writetitle(overlay['title'])
+        image.writeinfo(overlay['info'], colour=(255, 100, 0))
+        image.tonet(overlay['png_file'])
+
+        return(overlay['png_file'])
+
+    def submit(self, overlay):
+
+        """
+        Renders an overlay in the background worker pool.
+        @param overlay: Return of the overlay.
+        @type overlay: dict
+        @return: concurrent.futures.Future
+        """
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.n_jobs)
+
+        future = self.executor.submit(render_overlay, overlay)
+        self.futures.append(future)
+
+        return(future)
+
+    def wait(self):
+
+        """
+        Waits for the background renders and stops the worker pool.
+        @return: list of rendered PNG files
+        """
+
+        png_files = []
+
+        for future in self.futures:
+            try:
+                png_files.append(future.result())
+            except (Exception, SystemExit) as e:
+                print(e)
+
+        if self.executor is not None:
+            self.executor.shutdown()
+
+        self.executor = None
+        self.futures = []
+
+        return(png_files)
+
+    def render_batch(self, overlays):
+
+        """
+        Renders many overlays with the worker pool.
+        @param overlays: List of overlay descriptions.
+        @type overlays: list
+        @return: list of rendered PNG files
+        """
+
+        for overlay in overlays:
+            self.submit(overlay)
+
+        return(self.wait())
+
+    def save(self, overlays, file_name):
+
+        """
+        Appends overlay descriptions to a JSON lines file
+        for rendering later.
+        @param overlays: List of overlay descriptions.
+        @type overlays: list
+        @param file_name: JSON lines file.
+        @type file_name: path
+        @return: boolean
+        """
+
+        with open(file_name, 'a') as f_handle:
+            for overlay in overlays:
+                f_handle.write(json.dumps(overlay) + '\n')
+
+        return(True)
+
+    def load(self, file_name):
+
+        """
+        Reads overlay descriptions from a JSON lines file.
+        @param file_name: JSON lines file.
+        @type file_name: path
+        @return: list
+        """
+
+        with open(file_name) as f_handle:
+            return([json.loads(line) for line in f_handle if line.strip()])
+
+    def render_file(self, file_name, fitsfile=None):
+
+        """
+        Renders saved overlays on demand.
+        @param file_name: JSON lines file written by the save.
+        @type file_name: path
+        @param fitsfile: Render only the overlay of this FITS file.
+        @type fitsfile: path
+        @return: list of rendered PNG files
+        """
+
+        overlays = self.load(file_name)
+
+        if fitsfile is not None:
+            overlays = [overlay for overlay in overlays
+                        if overlay['fitsfile'] == fitsfile]
+
+        return(self.render_batch(overlays))
+
+
+class TilePyramid:
+
+    def __init__(self, fitsfile, pyramid_dir=None, tile_size=256):
+
+        """
+        Multi-resolution tile pyramid of a frame. Level 0 is the full
+        resolution frame; every next level is the 2x2 block mean of the
+        previous one, until a level fits in a tile. Levels are kept as
+        memory-mapped .npy files, so views only read the pixels they show.
+        @param fitsfile: Path of FITS file.
+        @type fitsfile: path
+        @param pyramid_dir: Directory of the pyramid. If None,
+        <fitsfile root>_tiles is used.
+        @type pyramid_dir: path
+        @param tile_size: Size of the square tiles (in pixels).
+        @type tile_size: int
+        """
+
+        if pyramid_dir is None:
+            fitshead, fitsextension = os.path.splitext(fitsfile)
+            pyramid_dir = '{0}_tiles'.format(fitshead)
+
+        self.fitsfile = fitsfile
+        self.pyramid_dir = pyramid_dir
+        self.tile_size = tile_size
+        self.meta = None
+
+    def level_path(self, level):
+
+        """
+        File of a pyramid level.
+        @param level: Zoom level (0 is full resolution).
+        @type level: int
+        @return: path
+        """
+
+        return(os.path.join(self.pyramid_dir, 'level_{0}.npy'.format(level)))
+
+    def tile_path(self, level, ix, iy):
+
+        """
+        PNG file of a tile, <pyramid_dir>/<level>/<iy>_<ix>.png.
+        @param level: Zoom level.
+        @type level: int
+        @param ix: Tile column.
+        @type ix: int
+        @param iy: Tile row.
+        @type iy: int
+        @return: path
+        """
+
+        return(os.path.join(self.pyramid_dir, str(level),
+                            '{0}_{1}.png'.format(iy, ix)))
+
+    def build(self, overwrite=False, chunk_rows=512):
+
+        """
+        Builds the pyramid of the frame once. Nothing is computed again
+        while the frame is unchanged; otherwise the levels are rewritten
+        and the PNG tiles and surplus levels of the old pyramid are
+        removed.
+        @param overwrite: Build again even if the frame is unchanged?
+        @type overwrite: boolean
+        @param chunk_rows: Number of rows reduced at once.
+        @type chunk_rows: int
+        @return: dict (pyramid description)
+        """
+
+        meta_file = os.path.join(self.pyramid_dir, 'pyramid.json')
+        stat = os.stat(self.fitsfile)
+        source = {"fitsfile": os.path.abspath(self.fitsfile),
+                  "size": stat.st_size,
+                  "mtime": stat.st_mtime}
+
+        if not overwrite and os.path.exists(meta_file):
+            with open(meta_file) as f_handle:
+                meta = json.load(f_handle)
+            if meta.get('source') == source and \
+                    meta.get('tile_size') == self.tile_size:
+                self.meta = meta
+                return(meta)
+
+        if not os.path.exists(self.pyramid_dir):
+            os.makedirs(self.pyramid_dir)
+
+        # tiles of the old levels are stale, the description is written
+        # again once the new levels are complete
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        for name in os.listdir(self.pyramid_dir):
+            tile_dir = os.path.join(self.pyramid_dir, name)
+            if name.isdigit() and os.path.isdir(tile_dir):
+                shutil.rmtree(tile_dir)
+
+        hdu = fits.open(self.fitsfile)[0]
+        data = np.asarray(hdu.data, dtype=np.float32)
+
+        level_0 = np.lib.format.open_memmap(self.level_path(0), mode='w+',
+                                           dtype=np.float32,
+                                           shape=data.shape)
+        level_0[:] = data
+        level_0.flush()
+
+        vmin, vmax = ZScaleInterval().get_limits(data)
+        shapes = [list(data.shape)]
+        del data, level_0
+
+        level = 0
+        while max(shapes[-1]) > self.tile_size:
+            previous = np.load(self.level_path(level), mmap_mode='r')
+            height, width = previous.shape
+            shape = ((height + 1) // 2, (width + 1) // 2)
+
+            current = np.lib.format.open_memmap(
+                self.level_path(level + 1), mode='w+',
+                dtype=np.float32, shape=shape)
+
+            # 2x2 block means, odd edges are padded with their last pixels
+            step = 2 * max(1, chunk_rows // 2)
+            for row in range(0, height, step):
+                block = np.asarray(previous[row:row + step], dtype=np.float32)
+                pad_rows = block.shape[0] % 2
+                pad_cols = width % 2
+                if pad_rows or pad_cols:
+                    block = np.pad(block, ((0, pad_rows), (0, pad_cols)),
+                                   mode='edge')
+                rows = block.shape[0] // 2
+                current[row // 2:row // 2 + rows] = block.reshape(
+                    rows, 2, block.shape[1] // 2, 2).mean(axis=(1, 3))
+
+            current.flush()
+            del previous, current
+
+            shapes.append(list(shape))
+            level += 1
+
+        # levels of an older, deeper pyramid are stale
+        for name in os.listdir(self.pyramid_dir):
+            number = name[len('level_'):-len('.npy')]
+            if name.startswith('level_') and name.endswith('.npy') and \
+                    number.isdigit() and int(number) >= len(shapes):
+                os.remove(os.path.join(self.pyramid_dir, name))
+
+        self.meta = {"source": source,
+                     "tile_size": self.tile_size,
+                     "shapes": shapes,
+                     "vmin": float(vmin),
+                     "vmax": float(vmax)}
+
+        with open(meta_file, 'w') as f_handle:
+            json.dump(self.meta, f_handle)
+
+        return(self.meta)
+
+    def level(self, level):
+
+        """
+        Memory-mapped pixels of a level.
+        @param level: Zoom level.
+        @type level: int
+        @return: numpy memmap
+        """
+
+        if self.meta is None:
+            self.build()
+
+        return(np.load(self.level_path(level), mmap_mode='r'))
+
+    def view(self, x0, y0, x1, y1, max_size=1024):
+
+        """
+        Pixels of a window of the frame at the finest level that
+        fits in max_size.
+        @param x0: First column of the window (full resolution, 0-based).
+        @type x0: int
+        @param y0: First row of the window.
+        @type y0: int
+        @param x1: End column of the window (exclusive).
+        @type x1: int
+        @param y1: End row of the window (exclusive).
+        @type y1: int
+        @param max_size: Maximum size of the view (in pixels).
+        @type max_size: int
+        @return: tuple (pixels, level, scale)
+        """
+
+        if self.meta is None:
+            self.build()
+
+        n_levels = len(self.meta['shapes'])
+        size = max(x1 - x0, y1 - y0, 1)
+
+        level = 0
+        while level < n_levels - 1 and size / 2 ** level > max_size:
+            level += 1
+
+        scale = 2 ** level
+        pixels = self.level(level)[y0 // scale:-(-y1 // scale),
+                                   x0 // scale:-(-x1 // scale)]
+
+        return(pixels, level, scale)
+
+    def tile(self, level, ix, iy):
+
+        """
+        Pixels of a tile.
+        @param level: Zoom level.
+        @type level: int
+        @param ix: Tile column.
+        @type ix: int
+        @param iy: Tile row.
+        @type iy: int
+        @return: numpy array
+        """
+
+        size = self.tile_size
+        return(self.level(level)[iy * size:(iy + 1) * size,
+                                 ix * size:(ix + 1) * size])
+
+    def tile_png(self, level, ix, iy):
+
+        """
+        PNG of a tile, written once and served from the disk.
+        @param level: Zoom level.
+        @type level: int
+        @param ix: Tile column.
+        @type ix: int
+        @param iy: Tile row.
+        @type iy: int
+        @return: path
+        """
+
+        png_file = self.tile_path(level, ix, iy)
+
+        if os.path.exists(png_file):
+            return(png_file)
+
+        tile_dir = os.path.dirname(png_file)
+        if not os.path.exists(tile_dir):
+            os.makedirs(tile_dir)
+
+        imsave(png_file, self.tile(level, ix, iy), cmap='gray',
+               vmin=self.meta['vmin'], vmax=self.meta['vmax'],
+               origin='lower')
+
+        return(png_file)
+
+    def export_tiles(self, levels=None):
+
+        """
+        Writes the PNG tiles of the pyramid.
+        @param levels: Levels to be exported. If None, all levels.
+        @type levels: list
+        @return: list of PNG files
+        """
+
+        if self.meta is None:
+            self.build()
+
+        if levels is None:
+            levels = range(len(self.meta['shapes']))
+
+        png_files = []
+        for level in levels:
+            height, width = self.meta['shapes'][level]
+            for iy in range(-(-height // self.tile_size)):
+                for ix in range(-(-width // self.tile_size)):
+                    png_files.append(self.tile_png(level, ix, iy))
+
+        return(png_files)
+
+    def render_view(self, png_file, x0=0, y0=0, x1=None, y1=None,
+                    overlay=None, max_size=1024):
+
+        """
+        Renders a window of the frame, with the circles of a QuickLook
+        overlay, into a PNG file.
+        @param png_file: Output PNG.
+        @type png_file: path
+        @param x0: First column of the window (full resolution, 0-based).
+        @type x0: int
+        @param y0: First row of the window.
+        @type y0: int
+        @param x1: End column of the window. If None, the frame width.
+        @type x1: int
+        @param y1: End row of the window. If None, the frame height.
+        @type y1: int
+        @param overlay: Return of the QuickLook.overlay (FITS pixel
+        coordinates).
+        @type overlay: dict
+        @param max_size: Maximum size of the view (in pixels).
+        @type max_size: int
+        @return: path
+        """
+
+        if self.meta is None:
+            self.build()
+
+        height, width = self.meta['shapes'][0]
+        x1 = width if x1 is None else x1
+        y1 = height if y1 is None else y1
+
+        pixels, level, scale = self.view(x0, y0, x1, y1, max_size=max_size)
+
+        fig = Figure(figsize=(pixels.shape[1] / 100.0,
+                              pixels.shape[0] / 100.0), dpi=100)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        ax.set_axis_off()
+
+        # axes in full resolution pixels
+        x_start = (x0 // scale) * scale
+        y_start = (y0 // scale) * scale
+        ax.imshow(pixels, cmap='gray', origin='lower',
+                  vmin=self.meta['vmin'], vmax=self.meta['vmax'],
+                  interpolation='nearest',
+                  extent=(x_start - 0.5,
+                          x_start + pixels.shape[1] * scale - 0.5,
+                          y_start - 0.5,
+                          y_start + pixels.shape[0] * scale - 0.5))
+
+        if overlay is not None and len(overlay['circles']) > 0:
+            x, y, r, colours, labels = zip(*overlay['circles'])
+            circles = EllipseCollection(
+                2 * np.asarray(r), 2 * np.asarray(r), np.zeros(len(r)),
+                units='xy',
+                offsets=np.column_stack((np.asarray(x) - 1,
+                                         np.asarray(y) - 1)),
+                offset_transform=ax.transData,
+                facecolors='none',
+                edgecolors=[np.asarray(c) / 255.0 for c in colours])
+            ax.add_collection(circles, autolim=False)
+
+        ax.set_xlim(x0 - 0.5, x1 - 0.5)
+        ax.set_ylim(y0 - 0.5, y1 - 0.5)
+
+        fig.savefig(png_file)
+
+        return(png_file)
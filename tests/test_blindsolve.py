@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from astrolib.blindsolve import BlindSolver
+
+
+PIXEL_SCALE = 1.0
+SIZE = 512
+
+
+def make_tiles(tile_dir):
+
+    # 2 tiles of a 2x2 deg patch, 3000 stars / deg2
+    rs = np.random.RandomState(7)
+    n_stars = 12000
+    dec = 20.0 + rs.uniform(-1, 1, n_stars)
+    ra = 150.0 + rs.uniform(-1, 1, n_stars) / np.cos(np.radians(dec))
+    mag = 18 - rs.exponential(1.5, n_stars).clip(0, 8)
+
+    os.makedirs(tile_dir)
+    for i, tile in enumerate([ra < 150.0, ra >= 150.0]):
+        Table([ra[tile], dec[tile], mag[tile]],
+              names=('ra', 'dec', 'phot_g_mean_mag')).write(
+            os.path.join(tile_dir, 'gaia-hp{0:02d}.fits'.format(i)))
+
+    return(ra, dec, mag)
+
+
+def make_frame(file_name, stars, c_ra, c_dec, rotation):
+
+    ra, dec, mag = stars
+    theta = np.radians(rotation)
+    scale = PIXEL_SCALE / 3600.0
+
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = c_ra
+    header['CRVAL2'] = c_dec
+    header['CRPIX1'] = SIZE / 2 + 0.5
+    header['CRPIX2'] = SIZE / 2 + 0.5
+    header['CD1_1'] = -scale * np.cos(theta)
+    header['CD1_2'] = scale * np.sin(theta)
+    header['CD2_1'] = scale * np.sin(theta)
+    header['CD2_2'] = scale * np.cos(theta)
+    wcs = WCS(header)
+
+    x, y = wcs.all_world2pix(ra, dec, 0)
+    on_frame = (x > 5) & (x < SIZE - 5) & (y > 5) & (y < SIZE - 5)
+
+    rs = np.random.RandomState(1)
+    data = rs.normal(100, 3, (SIZE, SIZE))
+    for s_x, s_y, s_mag in zip(x[on_frame], y[on_frame], mag[on_frame]):
+        y_grid, x_grid = np.mgrid[int(s_y) - 5:int(s_y) + 6,
+                                  int(s_x) - 5:int(s_x) + 6]
+        data[y_grid, x_grid] += np.power(10, -0.4 * (s_mag - 22)) * \
+            np.exp(-(np.power(x_grid - s_x, 2) +
+                     np.power(y_grid - s_y, 2)) / 4.5)
+
+    # pointing of the telescope is the hint
+    hint = fits.Header()
+    hint['OBJCTRA'] = str(c_ra + 0.2)
+    hint['OBJCTDEC'] = str(c_dec - 0.2)
+    fits.writeto(file_name, data.astype(np.float32), hint, overwrite=True)
+
+    return(wcs)
+
+
+@pytest.fixture(scope='module')
+def sky(tmp_path_factory):
+
+    root = tmp_path_factory.mktemp('blindsolve')
+    tile_dir = os.path.join(str(root), 'tiles')
+    stars = make_tiles(tile_dir)
+
+    frames = []
+    for i, (c_ra, c_dec, rotation) in enumerate([(149.9, 20.1, 30),
+                                                 (150.2, 19.8, -75)]):
+        file_name = os.path.join(str(root), 'frame_{0}.fits'.format(i))
+        frames.append((file_name,
+                       make_frame(file_name, stars, c_ra, c_dec, rotation)))
+
+    return(tile_dir, frames)
+
+
+def center_offset(header, wcs):
+
+    fitted = WCS(header).celestial.pixel_to_world((SIZE - 1) / 2.0,
+                                                  (SIZE - 1) / 2.0)
+    true = wcs.pixel_to_world((SIZE - 1) / 2.0, (SIZE - 1) / 2.0)
+
+    return(fitted.separation(true).arcsec)
+
+
+def test_solve(sky):
+
+    tile_dir, frames = sky
+    bs = BlindSolver(tile_dir)
+
+    for file_name, wcs in frames:
+        result = bs.solve(file_name, pixel_scale=PIXEL_SCALE, write=False)
+
+        assert result['solved']
+        assert result['n_matches'] >= bs.min_matches
+        assert center_offset(result['wcs'], wcs) < 0.5
+
+
+def test_triangle_index_is_stored(sky, monkeypatch):
+
+    tile_dir, frames = sky
+    file_name, wcs = frames[0]
+
+    BlindSolver(tile_dir).solve(file_name, pixel_scale=PIXEL_SCALE,
+                                write=False)
+
+    index_files = sorted(name for name in os.listdir(tile_dir)
+                         if name.endswith('.npz'))
+    assert 'tiles.json' in os.listdir(tile_dir)
+    assert len(index_files) == 2
+
+    # catalogue triangles are read back, not made again
+    bs = BlindSolver(tile_dir)
+    image_triangles = bs.triangles
+    calls = []
+
+    def triangles(points):
+        calls.append(len(points))
+        return(image_triangles(points))
+
+    monkeypatch.setattr(bs, 'triangles', triangles)
+    result = bs.solve(file_name, pixel_scale=PIXEL_SCALE, write=False)
+
+    assert result['solved']
+    assert len(calls) == 1
+
+
+def test_tiles_are_bounded(sky):
+
+    tile_dir, frames = sky
+    bs = BlindSolver(tile_dir, max_tiles=1)
+
+    bs.tile_index(refresh=True)
+    assert len(bs.index) == 2
+    assert len(bs.tiles) == 0
+
+    ra, dec, mag = bs.region_stars(150.0, 20.0, 0.5)
+    assert len(ra) > 0
+    assert len(bs.tiles) == 1
+
+
+def test_benchmark(sky, monkeypatch):
+
+    tile_dir, frames = sky
+    bs = BlindSolver(tile_dir)
+    file_names = [file_name for file_name, wcs in frames]
+    mtimes = [os.stat(file_name).st_mtime for file_name in file_names]
+
+    # solve-field of astrometry.net is replaced by the true WCS
+    true_headers = {file_name: wcs.to_header()
+                    for file_name, wcs in frames}
+
+    def solve_field_job(image_path, timeout=300):
+        return({"solved": True,
+                "elapsed": 1.0,
+                "wcs": true_headers[image_path]})
+
+    monkeypatch.setattr(bs.ac, 'solve_field_job', solve_field_job)
+
+    results, summary = bs.benchmark(file_names, pixel_scale=PIXEL_SCALE)
+
+    assert results.colnames == ['image', 'blind_solved', 'blind_time',
+                                'blind_matches', 'solve_field_solved',
+                                'solve_field_time', 'center_offset']
+    assert list(results['image']) == file_names
+    assert np.all(results['blind_solved'])
+    assert np.all(results['center_offset'] < 0.5)
+    assert summary['blind']['success_rate'] == 1.0
+    assert summary['solve_field']['median_time'] == 1.0
+    # blind solutions are not written
+    assert [os.stat(file_name).st_mtime
+            for file_name in file_names] == mtimes
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import CartesianRepresentation
+from astropy.table import Table
+from astropy.time import Time
+
+from astrolib import astronomy
+from astrolib.astronomy import AstCalc
+
+
+def baseline_std2equ(ra0, dec0, xx, yy):
+
+    ra = ra0 + math.atan(-xx /
+                         (math.cos(dec0) -
+                          (yy * math.sin(dec0))))
+
+    dec = math.asin((math.sin(dec0) + (yy * math.cos(dec0))) /
+                    math.sqrt(1 + math.pow(xx, 2) +
+                              math.pow(yy, 2)))
+
+    return(ra, dec)
+
+
+def baseline_equ2std(ra0, dec0, ra, dec):
+
+    xx = (-(math.cos(dec) * math.sin(ra - ra0)) /
+          (math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0) +
+           math.sin(dec0) * math.sin(dec)))
+
+    yy = (-(math.sin(dec0) * math.cos(dec) * math.cos(ra - ra0) -
+            math.cos(dec0) * math.sin(dec)) /
+          (math.cos(dec0) * math.cos(dec) * math.cos(ra - ra0) +
+           math.sin(dec0) * math.sin(dec)))
+
+    return(xx, yy)
+
+
+def baseline_ppm_cor(ra, dec, pmRA, pmDE, odate):
+
+    ra = math.radians(ra)
+    dec = math.radians(dec)
+
+    mu_ra = math.radians(pmRA / 3600000) / math.cos(dec)
+
+    t0 = Time("2015-01-01T00:00:00.000000", format='isot', scale='utc').mjd
+    t = Time(odate.replace(" ", "T"), format='isot', scale='utc').mjd
+
+    cra = ra + ((t - t0) / 365.2568983) * mu_ra
+    cdec = dec + ((t - t0) / 365.2568983) * math.radians(pmDE / 3600000)
+
+    return(math.degrees(cra),
+           math.degrees(cdec))
+
+
+def baseline_stellar_parallax_cor(parallax, ra, dec, odate):
+
+    ra = math.radians(ra)
+    dec = math.radians(dec)
+
+    xyz = astronomy.get_body_barycentric('earth', Time(odate),
+                                         ephemeris='de432s')
+
+    x = xyz.x.to(u.au)
+    y = xyz.y.to(u.au)
+    z = xyz.z.to(u.au)
+
+    delta_ra = (parallax * (x * math.sin(ra) -
+                            y * math.cos(ra))) / math.cos(dec)
+
+    delta_dec = parallax * ((x * math.cos(ra) + y * math.sin(ra)) *
+                            math.sin(dec) - z * math.cos(dec))
+
+    return(delta_ra.value,
+           delta_dec.value)
+
+
+@pytest.fixture
+def earth(monkeypatch):
+
+    # circular orbit instead of the JPL ephemeris
+    def get_body_barycentric(body, time, ephemeris=None):
+        phase = 2 * np.pi * (time.jd - 2451545.0) / 365.25
+        return(CartesianRepresentation(np.cos(phase) * u.au,
+                                       0.917 * np.sin(phase) * u.au,
+                                       0.398 * np.sin(phase) * u.au))
+
+    monkeypatch.setattr(astronomy, 'get_body_barycentric',
+                        get_body_barycentric)
+    astronomy.earth_barycentric.cache_clear()
+    yield
+    astronomy.earth_barycentric.cache_clear()
+
+
+def sky(n_stars=500, seed=0):
+
+    rs = np.random.RandomState(seed)
+    ra = rs.uniform(0, 360, n_stars)
+    dec = np.degrees(np.arcsin(rs.uniform(-0.99, 0.99, n_stars)))
+
+    return(ra, dec)
+
+
+def test_std_equ_arrays_match_scalar_baseline():
+
+    ac = AstCalc()
+    rs = np.random.RandomState(1)
+    ra0, dec0 = math.radians(201.3), math.radians(-33.7)
+    ra = ra0 + rs.uniform(-0.02, 0.02, 300)
+    dec = dec0 + rs.uniform(-0.02, 0.02, 300)
+
+    xx, yy = ac.equ2std_array(ra0, dec0, ra, dec)
+    c_ra, c_dec = ac.std2equ_array(ra0, dec0, xx, yy)
+
+    for i in range(len(ra)):
+        b_xx, b_yy = baseline_equ2std(ra0, dec0, ra[i], dec[i])
+        assert xx[i] == pytest.approx(b_xx, rel=1e-12, abs=1e-18)
+        assert yy[i] == pytest.approx(b_yy, rel=1e-12, abs=1e-18)
+
+        b_ra, b_dec = baseline_std2equ(ra0, dec0, b_xx, b_yy)
+        assert c_ra[i] == pytest.approx(b_ra, rel=1e-12)
+        assert c_dec[i] == pytest.approx(b_dec, rel=1e-12)
+
+    np.testing.assert_allclose(c_ra, ra, rtol=1e-12)
+    np.testing.assert_allclose(c_dec, dec, rtol=1e-12)
+
+
+def test_scalar_wrappers():
+
+    ac = AstCalc()
+    ra0, dec0 = math.radians(10.0), math.radians(45.0)
+
+    xx, yy = ac.equ2std(ra0, dec0, math.radians(10.1), math.radians(45.2))
+    assert isinstance(xx, float) and isinstance(yy, float)
+    assert (xx, yy) == pytest.approx(
+        baseline_equ2std(ra0, dec0, math.radians(10.1), math.radians(45.2)),
+        rel=1e-12)
+
+    ra, dec = ac.std2equ(ra0, dec0, xx, yy)
+    assert (ra, dec) == pytest.approx(
+        (math.radians(10.1), math.radians(45.2)), rel=1e-12)
+
+
+def test_ppm_cor_matches_scalar_baseline():
+
+    ac = AstCalc()
+    ra, dec = sky(200)
+    rs = np.random.RandomState(2)
+    pmra = rs.normal(0, 50, len(ra))
+    pmdec = rs.normal(0, 50, len(ra))
+    odate = "2019-06-21 23:10:01.890000"
+
+    c_ra, c_dec = ac.ppm_cor(ra, dec, pmra, pmdec, odate)
+
+    for i in range(len(ra)):
+        b_ra, b_dec = baseline_ppm_cor(ra[i], dec[i], pmra[i], pmdec[i],
+                                       odate)
+        assert c_ra[i] == pytest.approx(b_ra, rel=1e-13)
+        assert c_dec[i] == pytest.approx(b_dec, rel=1e-13, abs=1e-13)
+
+
+def test_parallax_matches_scalar_baseline(earth):
+
+    ac = AstCalc()
+    ra, dec = sky(200, 3)
+    plx = np.random.RandomState(3).uniform(0, 0.1, len(ra))
+    odate = "2019-09-01T02:00:00.000"
+
+    d_ra, d_dec = ac.stellar_parallax_cor(plx, ra, dec, odate)
+
+    for i in range(len(ra)):
+        b_ra, b_dec = baseline_stellar_parallax_cor(plx[i], ra[i], dec[i],
+                                                    odate)
+        assert d_ra[i] == pytest.approx(b_ra, rel=1e-12, abs=1e-15)
+        assert d_dec[i] == pytest.approx(b_dec, rel=1e-12, abs=1e-15)
+
+
+def test_table_correction_matches_star_loop(earth):
+
+    ac = AstCalc()
+    ra, dec = sky(300, 4)
+    rs = np.random.RandomState(4)
+    table = Table({"ra": ra,
+                   "dec": dec,
+                   "pmra": rs.normal(0, 20, len(ra)),
+                   "pmdec": rs.normal(0, 20, len(ra)),
+                   "plx": rs.uniform(0, 5, len(ra))},
+                  masked=True)
+    # stars without astrometric solution
+    table['pmra'].mask[:10] = True
+    table['plx'].mask[5:15] = True
+    odate = "2020-02-11 19:45:00.000000"
+
+    corrected = ac.ppm_parallax_cor_table(table, odate)
+
+    # per star loop of the original ccmap with masked values as zero
+    filled = table.filled(0.0)
+    for i in range(len(table)):
+        ra_plx, dec_plx = baseline_stellar_parallax_cor(
+            filled['plx'][i] / 1000, filled['ra'][i], filled['dec'][i],
+            odate)
+        cra_ppm, cdec_ppm = baseline_ppm_cor(filled['ra'][i],
+                                             filled['dec'][i],
+                                             filled['pmra'][i],
+                                             filled['pmdec'][i],
+                                             odate)
+
+        assert corrected['cra'][i] == pytest.approx(
+            cra_ppm + ra_plx / 3600, rel=1e-13)
+        assert corrected['cdec'][i] == pytest.approx(
+            cdec_ppm + dec_plx / 3600, rel=1e-13, abs=1e-13)
+
+
+def test_earth_position_is_computed_once_per_epoch(earth, monkeypatch):
+
+    calls = []
+    get_body_barycentric = astronomy.get_body_barycentric
+
+    def counted(body, time, ephemeris=None):
+        calls.append(time)
+        return(get_body_barycentric(body, time, ephemeris=ephemeris))
+
+    monkeypatch.setattr(astronomy, 'get_body_barycentric', counted)
+
+    ac = AstCalc()
+    ra, dec = sky(1000, 5)
+    for i in range(3):
+        ac.ppm_parallax_cor(ra, dec, np.zeros(len(ra)), np.zeros(len(ra)),
+                            np.ones(len(ra)), "2021-01-01 00:00:00.000000")
+
+    assert len(calls) == 1
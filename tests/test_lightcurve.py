@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+from astropy.stats import mad_std
+from astropy.table import Table, unique
+from astropy.timeseries import LombScargle
+
+from astrolib.lightcurve import GroupOps, PeriodOps
+
+
+def light_curve(seed=0, n_obs=120, period_h=5.3):
+
+    rs = np.random.RandomState(seed)
+    t = 2458000.0 + np.sort(rs.uniform(0, 6, n_obs))
+    phase = 2 * np.pi * t * 24.0 / period_h
+    dy = rs.uniform(0.01, 0.03, n_obs)
+    y = (15.0 + 0.2 * np.cos(2 * phase) + 0.05 * np.sin(phase) +
+         rs.normal(0, 1, n_obs) * dy)
+
+    return(t, y, dy)
+
+
+def baseline_fourier_chi2(t, y, dy, freq, n_harmonics):
+
+    # one weighted least squares fit per frequency
+    t = t - t.min()
+    k = np.arange(1, n_harmonics + 1)
+    arg = 2 * np.pi * freq * t[:, np.newaxis] * k
+    design = np.column_stack((np.ones(len(t)), np.cos(arg), np.sin(arg)))
+    coeffs = np.linalg.lstsq(design / dy[:, np.newaxis], y / dy,
+                             rcond=None)[0]
+    model = design @ coeffs
+
+    return(np.sum(((y - model) / dy) ** 2) / (len(t) - len(coeffs)),
+           np.ptp(model))
+
+
+def test_lomb_scargle_matches_astropy():
+
+    t, y, dy = light_curve()
+    po = PeriodOps()
+    freqs = np.linspace(0.5, 24, 3000)
+
+    power = po.lomb_scargle(t, y, dy, freqs)
+    expected = LombScargle(t, y, dy, fit_mean=True,
+                           center_data=True).power(freqs)
+
+    np.testing.assert_allclose(power, expected, rtol=1e-7, atol=1e-10)
+
+
+def test_lomb_scargle_in_chunks():
+
+    t, y, dy = light_curve(1)
+    freqs = np.linspace(0.5, 24, 1000)
+
+    whole = PeriodOps().lomb_scargle(t, y, dy, freqs)
+    chunked = PeriodOps(chunk_size=1000).lomb_scargle(t, y, dy, freqs)
+
+    np.testing.assert_allclose(chunked, whole, rtol=1e-12, atol=1e-15)
+
+
+def test_fourier_fit_matches_single_fits():
+
+    t, y, dy = light_curve(2)
+    po = PeriodOps(n_harmonics=3)
+    freqs = np.linspace(2, 12, 40)
+
+    fit = po.fourier_fit(t, y, dy, freqs)
+
+    for i, freq in enumerate(freqs):
+        chi2_red, amplitude = baseline_fourier_chi2(t, y, dy, freq, 3)
+        assert fit['chi2_red'][i] == pytest.approx(chi2_red, rel=1e-6)
+        assert fit['amplitude'][i] == pytest.approx(amplitude, rel=1e-6)
+
+
+def test_period_is_found():
+
+    t, y, dy = light_curve(3, period_h=5.3)
+    po = PeriodOps()
+    freqs = po.frequency_grid({"1": (t, y, dy)})
+
+    candidates = po.candidates("1", (t, y, dy), freqs)
+
+    assert candidates['rank'][0] == 1
+    assert candidates['period_h'][0] == pytest.approx(5.3, rel=1e-3)
+    assert np.all(candidates['frequency'] >= freqs.min())
+    assert np.all(candidates['frequency'] <= freqs.max())
+
+
+def baseline_sigma_clip(values, sigma=3, iters=10):
+
+    # astropy.stats.sigma_clip(iters=iters, stdfunc=mad_std) of the
+    # astropy versions with the iters keyword: rejections accumulate
+    values = np.asarray(values, dtype=float)
+    rejected = ~np.isfinite(values)
+
+    for i in range(iters):
+        kept = values[~rejected]
+        deviation = values - np.median(kept)
+        std = mad_std(kept)
+        new_rejected = rejected | (deviation < -sigma * std) | \
+            (deviation > sigma * std)
+
+        if np.count_nonzero(new_rejected) == np.count_nonzero(rejected):
+            break
+
+        rejected = new_rejected
+
+    return(~rejected)
+
+
+def grouped_rows(seed=0, n_groups=40):
+
+    rs = np.random.RandomState(seed)
+    keys = rs.randint(0, n_groups, 800).astype(float)
+    x = rs.normal(12, 1, len(keys))
+    y = 0.98 * x + 0.3 + rs.normal(0, 0.02, len(keys))
+    # outliers
+    y[rs.rand(len(keys)) < 0.05] += 2.0
+
+    return(keys, x, y)
+
+
+def test_group_statistics_match_loops():
+
+    keys, x, y = grouped_rows()
+    groups = GroupOps(keys)
+    mask = np.random.RandomState(1).rand(len(keys)) > 0.2
+
+    mean = groups.mean(y, mask)
+    std = groups.std(y, mask)
+    median = groups.median(y, mask)
+    mad = groups.mad_std(y, mask)
+
+    for i, key in enumerate(groups.keys):
+        values = y[(keys == key) & mask]
+        assert mean[i] == pytest.approx(np.mean(values), rel=1e-12)
+        assert std[i] == pytest.approx(np.std(values), rel=1e-9)
+        assert median[i] == pytest.approx(np.median(values), rel=1e-12)
+        assert mad[i] == pytest.approx(mad_std(values), rel=1e-12)
+
+
+def test_group_sigma_clip_and_polyfit_match_loops():
+
+    keys, x, y = grouped_rows(2)
+    groups = GroupOps(keys)
+
+    keep = groups.sigma_clip(y, sigma=3, iters=10)
+    fit = groups.polyfit(x, y, 1, mask=keep)
+
+    for i, key in enumerate(groups.keys):
+        rows = np.flatnonzero(keys == key)
+        np.testing.assert_array_equal(keep[rows],
+                                      baseline_sigma_clip(y[rows]))
+
+        expected = np.polyfit(x[rows][keep[rows]], y[rows][keep[rows]], 1)
+        np.testing.assert_allclose(fit[i], expected, rtol=1e-8)
+
+
+def test_group_polyfit_leaves_degenerate_groups_nan():
+
+    keys = np.array([0, 0, 0, 1, 1, 1, 2])
+    x = np.array([1.0, 2.0, 3.0, 5.0, 5.0, 5.0, 1.0])
+    y = np.array([1.0, 2.0, 3.0, 1.0, 2.0, 3.0, 1.0])
+
+    fit = GroupOps(keys).polyfit(x, y, 1)
+
+    np.testing.assert_allclose(fit[0], [1.0, 0.0], atol=1e-12)
+    assert np.all(np.isnan(fit[1:]))
+
+
+def baseline_std_mag(result_file):
+
+    # per-frame loop of the original StarPlot.lc_plot_std_mag
+    magt_std_list = []
+    for jd in unique(result_file, keys='jd')['jd']:
+        frame_results = result_file[(result_file['jd'] == jd)]
+        umask = baseline_sigma_clip(frame_results['magt_i'])
+
+        fit = np.polyfit(frame_results['magc_i'][umask],
+                         frame_results['star_Rmag'][umask], 1)
+        magt_to_std = np.poly1d(fit)(frame_results['magt_i'][umask])
+        magt_std_list.append([jd, magt_to_std[0],
+                              frame_results['magt_i_err'][0]])
+
+    jd_vs_magt = np.asanyarray(magt_std_list)
+
+    return(jd_vs_magt, baseline_sigma_clip(jd_vs_magt[:, 1]))
+
+
+def test_std_mag_curve_matches_baseline():
+
+    from astrolib.visuals import StarPlot
+
+    rs = np.random.RandomState(4)
+    n_frames, n_stars = 30, 12
+    jd = np.repeat(2458000.0 + np.arange(n_frames) * 0.01, n_stars)
+    magc_i = np.tile(rs.uniform(-12, -8, n_stars), n_frames)
+    star_rmag = magc_i + 25.0 + rs.normal(0, 0.02, len(jd))
+    magt_i = np.repeat(rs.normal(-10, 0.1, n_frames), n_stars)
+    magt_i[rs.rand(len(jd)) < 0.05] += 1.0
+
+    result_file = Table({"jd": jd,
+                         "magc_i": magc_i,
+                         "magc_i_err": rs.uniform(0.01, 0.02, len(jd)),
+                         "star_Rmag": star_rmag,
+                         "magt_i": magt_i,
+                         "magt_i_err": rs.uniform(0.01, 0.02, len(jd))})
+
+    curve = StarPlot().std_mag_curve(result_file)
+    expected, expected_keep = baseline_std_mag(result_file)
+
+    np.testing.assert_allclose(curve['jd'], expected[:, 0], rtol=0)
+    np.testing.assert_allclose(curve['magt_std'], expected[:, 1],
+                               rtol=1e-9)
+    np.testing.assert_allclose(curve['magt_err'], expected[:, 2], rtol=0)
+    np.testing.assert_array_equal(curve['curve_keep'], expected_keep)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import pytest
+
+from astrolib.peakdetect import peakdet
+
+
+def baseline_peakdet(v, delta, x=None):
+
+    # scalar loop of the original peakdet
+    maxtab = []
+    mintab = []
+
+    if x is None:
+        x = np.arange(len(v))
+
+    v = np.asarray(v)
+
+    mn, mx = np.inf, -np.inf
+    mnpos, mxpos = np.nan, np.nan
+
+    lookformax = True
+
+    for i in np.arange(len(v)):
+        this = v[i]
+        if this > mx:
+            mx = this
+            mxpos = x[i]
+        if this < mn:
+            mn = this
+            mnpos = x[i]
+
+        if lookformax:
+            if this < mx - delta:
+                maxtab.append((mxpos, mx))
+                mn = this
+                mnpos = x[i]
+                lookformax = False
+        else:
+            if this > mn + delta:
+                mintab.append((mnpos, mn))
+                mx = this
+                mxpos = x[i]
+                lookformax = True
+
+    return(np.array(maxtab), np.array(mintab))
+
+
+def assert_tabs_equal(tab, expected):
+
+    assert len(tab) == len(expected)
+    if len(expected) > 0:
+        np.testing.assert_array_equal(tab, expected)
+
+
+@pytest.mark.parametrize("delta", [0.05, 0.5, 2.0])
+def test_single_curves(delta):
+
+    rs = np.random.RandomState(0)
+    for n_points in (1, 2, 5, 30, 200):
+        v = np.cumsum(rs.normal(0, 0.5, n_points))
+        maxtab, mintab = peakdet(v, delta)
+        b_maxtab, b_mintab = baseline_peakdet(v, delta)
+        assert_tabs_equal(maxtab, b_maxtab)
+        assert_tabs_equal(mintab, b_mintab)
+
+
+def test_curves_with_x_and_ties():
+
+    rs = np.random.RandomState(1)
+    x = np.arange(30, dtype=float) * 0.5
+    for i in range(50):
+        # rounded values have plateaus and equal peaks
+        v = np.round(rs.normal(0, 1, 30), 1)
+        maxtab, mintab = peakdet(v, 0.3, x)
+        b_maxtab, b_mintab = baseline_peakdet(v, 0.3, x)
+        assert_tabs_equal(maxtab, b_maxtab)
+        assert_tabs_equal(mintab, b_mintab)
+
+
+def test_many_curves_at_once():
+
+    rs = np.random.RandomState(2)
+    curves = np.cumsum(rs.normal(0, 1, (100, 30)), axis=1)
+    x = np.arange(30, dtype=float)
+
+    maxtabs, mintabs = peakdet(curves, 1.0, x)
+
+    assert len(maxtabs) == len(mintabs) == len(curves)
+    for curve, maxtab, mintab in zip(curves, maxtabs, mintabs):
+        b_maxtab, b_mintab = baseline_peakdet(curve, 1.0, x)
+        assert_tabs_equal(maxtab, b_maxtab)
+        assert_tabs_equal(mintab, b_mintab)
+
+
+def test_snr_curves_with_nan():
+
+    # curves of growth start with 0/0 SNR at zero aperture
+    rs = np.random.RandomState(3)
+    snr = np.cumsum(rs.normal(1, 2, (20, 30)), axis=1)
+    snr[:, 0] = np.nan
+
+    maxtabs, mintabs = peakdet(snr, 0.1)
+
+    for curve, maxtab, mintab in zip(snr, maxtabs, mintabs):
+        b_maxtab, b_mintab = baseline_peakdet(curve, 0.1)
+        assert_tabs_equal(maxtab, b_maxtab)
+        assert_tabs_equal(mintab, b_mintab)
+
+
+@pytest.mark.parametrize("args", [
+    (np.zeros(5), 0.0),
+    (np.zeros(5), np.ones(2)),
+    (np.zeros(5), 0.1, np.arange(4)),
+    (np.zeros((2, 2, 2)), 0.1)])
+def test_bad_input_raises(args):
+
+    with pytest.raises(ValueError):
+        peakdet(*args)
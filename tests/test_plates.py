@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+import math
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from astrolib.astronomy import AstCalc
+
+
+def sip_wcs(order):
+
+    header = fits.Header()
+    header['CTYPE1'] = "RA---TAN-SIP" if order > 1 else "RA---TAN"
+    header['CTYPE2'] = "DEC--TAN-SIP" if order > 1 else "DEC--TAN"
+    header['CRVAL1'] = 150.25
+    header['CRVAL2'] = 32.5
+    header['CRPIX1'] = 1024.5
+    header['CRPIX2'] = 1000.0
+    header['CD1_1'] = -2.8e-4
+    header['CD1_2'] = 1.5e-6
+    header['CD2_1'] = 2.0e-6
+    header['CD2_2'] = 2.8e-4
+
+    if order > 1:
+        header['A_ORDER'] = order
+        header['B_ORDER'] = order
+        for degree in range(2, order + 1):
+            scale = 1e-3 * np.power(1e-3, degree - 1)
+            for q in range(degree + 1):
+                header['A_{0}_{1}'.format(degree - q, q)] = 2 * scale
+                header['B_{0}_{1}'.format(degree - q, q)] = -scale
+
+    return(WCS(header))
+
+
+@pytest.mark.parametrize("order", [1, 2, 3, 4])
+def test_tan_sip_round_trip(order):
+
+    ac = AstCalc()
+    true_wcs = sip_wcs(order)
+    rs = np.random.RandomState(order)
+    x = rs.uniform(1, 2048, 300)
+    y = rs.uniform(1, 2048, 300)
+    ra, dec = true_wcs.all_pix2world(x, y, 1)
+
+    solution = ac.plate_solve(150.2, 32.55, x, y, ra, dec,
+                              order=order,
+                              sigma=None,
+                              crpix=(1024.5, 1000.0))
+    header = ac.plate_wcs_header(solution)
+    fitted_wcs = WCS(header)
+
+    assert (fitted_wcs.sip is not None) == (order > 1)
+    np.testing.assert_allclose(solution['crval'], (150.25, 32.5),
+                               atol=1e-9)
+
+    grid_x, grid_y = np.meshgrid(np.linspace(1, 2048, 20),
+                                 np.linspace(1, 2048, 20))
+    t_ra, t_dec = true_wcs.all_pix2world(grid_x, grid_y, 1)
+    f_ra, f_dec = fitted_wcs.all_pix2world(grid_x, grid_y, 1)
+    np.testing.assert_allclose(f_ra, t_ra, rtol=0, atol=1e-8)
+    np.testing.assert_allclose(f_dec, t_dec, rtol=0, atol=1e-8)
+
+    p_ra, p_dec = ac.plate_pix2world(solution, grid_x.ravel(),
+                                     grid_y.ravel())
+    np.testing.assert_allclose(p_ra, t_ra.ravel(), rtol=0, atol=1e-8)
+    np.testing.assert_allclose(p_dec, t_dec.ravel(), rtol=0, atol=1e-8)
+
+
+def test_wcs_header_needs_centered_solution():
+
+    ac = AstCalc()
+    true_wcs = sip_wcs(1)
+    x, y = np.meshgrid(np.linspace(1, 2048, 5), np.linspace(1, 2048, 5))
+    ra, dec = true_wcs.all_pix2world(x.ravel(), y.ravel(), 1)
+
+    solution = ac.plate_solve(150.3, 32.4, x.ravel(), y.ravel(), ra, dec,
+                              sigma=None,
+                              crpix=(1024.5, 1000.0),
+                              recenter=False)
+
+    with pytest.raises(ValueError):
+        ac.plate_wcs_header(solution)
+
+
+def test_covariance():
+
+    ac = AstCalc()
+    rs = np.random.RandomState(0)
+    terms = ac.plate_terms(2)
+    design = ac.plate_design(rs.uniform(-1, 1, 50), rs.uniform(-1, 1, 50),
+                             terms)
+    std_coords = (design @ rs.normal(0, 1e-3, (len(terms), 2)) +
+                  rs.normal(0, 1e-6, (50, 2)))
+
+    coeffs, cov, used = ac.plate_fit(design, std_coords, sigma=None)
+
+    expected, residuals = np.linalg.lstsq(design, std_coords,
+                                          rcond=None)[:2]
+    variance = residuals / (len(design) - len(terms))
+    normal_inv = np.linalg.inv(design.T @ design)
+
+    assert used.all()
+    assert cov.shape == (2, len(terms), len(terms))
+    np.testing.assert_allclose(coeffs, expected, rtol=1e-10, atol=1e-18)
+    np.testing.assert_allclose(cov[0], variance[0] * normal_inv,
+                               rtol=1e-8)
+    np.testing.assert_allclose(cov[1], variance[1] * normal_inv,
+                               rtol=1e-8)
+
+
+def test_covariance_matches_scatter():
+
+    # errors of coefficients from the covariance agree with the
+    # scatter of fits of noisy copies
+    ac = AstCalc()
+    rs = np.random.RandomState(1)
+    terms = ac.plate_terms(1)
+    design = ac.plate_design(rs.uniform(-1, 1, 40), rs.uniform(-1, 1, 40),
+                             terms)
+    truth = design @ np.array([[0.0, 0.0], [1e-3, 0.0], [0.0, 1e-3]])
+
+    noisy = truth + rs.normal(0, 1e-6, (500, 40, 2))
+    coeffs, cov, used = ac.plate_fit(np.repeat(design[None], 500, axis=0),
+                                     noisy,
+                                     sigma=None)
+
+    assert cov.shape == (500, 2, len(terms), len(terms))
+    errors = np.sqrt(np.mean(np.diagonal(cov, axis1=2, axis2=3), axis=0))
+    np.testing.assert_allclose(errors, np.std(coeffs, axis=0).T, rtol=0.1)
+
+
+def test_batch_matches_single_frames():
+
+    ac = AstCalc()
+    true_wcs = sip_wcs(2)
+    rs = np.random.RandomState(2)
+    frames = []
+    for n_stars in (4, 30, 80, 150):
+        x = rs.uniform(1, 2048, n_stars)
+        y = rs.uniform(1, 2048, n_stars)
+        ra, dec = true_wcs.all_pix2world(x, y, 1)
+        # outliers are clipped
+        ra[:2] += 0.002
+        frames.append({"ra_center": 150.2,
+                       "dec_center": 32.6,
+                       "x": x,
+                       "y": y,
+                       "ra": ra,
+                       "dec": dec})
+
+    solutions = ac.plate_solve_batch(frames, order=2)
+
+    assert solutions[0] is False
+    for frame, solution in zip(frames[1:], solutions[1:]):
+        single = ac.plate_solve(frame['ra_center'], frame['dec_center'],
+                                frame['x'], frame['y'],
+                                frame['ra'], frame['dec'],
+                                order=2)
+        assert not solution['used'][:2].any()
+        np.testing.assert_array_equal(solution['used'], single['used'])
+        np.testing.assert_allclose(solution['coeffs'], single['coeffs'],
+                                   rtol=1e-9, atol=1e-16)
+        np.testing.assert_allclose(solution['crval'], single['crval'],
+                                   rtol=0, atol=1e-10)
+        np.testing.assert_allclose(solution['cov'], single['cov'],
+                                   rtol=1e-6)
+
+
+def baseline_plate_constants(ra_center, dec_center, objects_matrix,
+                             target_xy):
+
+    # scalar loops of the original plate_constants, with d of the
+    # y-model where f was used and the error in arcsec (the original
+    # missed math.degrees)
+    ac = AstCalc()
+    x_xy = []
+    b_xx = []
+    b_yy = []
+
+    for m_object in objects_matrix:
+        ra = math.radians(m_object[3])
+        dec = math.radians(m_object[4])
+        x_xy.append([m_object[1], m_object[2], 1])
+        b_xx.append(ac.equ2std(ra_center, dec_center, ra, dec)[0])
+        b_yy.append(ac.equ2std(ra_center, dec_center, ra, dec)[1])
+
+    a, b, c = np.linalg.lstsq(np.array(x_xy), np.asarray(b_xx),
+                              rcond=None)[0]
+    d, e, f = np.linalg.lstsq(np.array(x_xy), np.asarray(b_yy),
+                              rcond=None)[0]
+
+    coor_list = []
+    for s_object in objects_matrix:
+        xx = a * s_object[1] + b * s_object[2] + c
+        yy = d * s_object[1] + e * s_object[2] + f
+
+        ra, dec = ac.std2equ(ra_center, dec_center, xx, yy)
+
+        d_ra = ((ra - math.radians(s_object[3])) *
+                math.cos(math.radians(s_object[4])))
+        d_dec = (dec - math.radians(s_object[4]))
+
+        delta = 3600.0 * math.degrees(math.sqrt(math.pow(d_ra, 2) +
+                                                math.pow(d_dec, 2)))
+
+        coor_list.append([s_object[0],
+                          s_object[1],
+                          s_object[2],
+                          s_object[3],
+                          s_object[4],
+                          math.degrees(ra),
+                          math.degrees(dec),
+                          math.degrees(d_ra) * 3600.0,
+                          math.degrees(d_dec) * 3600.0,
+                          delta,
+                          (s_object[3] - math.degrees(ra)),
+                          (s_object[4] - math.degrees(dec))])
+
+    for i, xy in enumerate(target_xy):
+        xx = a * xy[0] + b * xy[1] + c
+        yy = d * xy[0] + e * xy[1] + f
+
+        ra, dec = ac.std2equ(ra_center, dec_center, xx, yy)
+        coor_list.append([i, xy[0], xy[1]] + [np.nan] * 2 +
+                         [math.degrees(ra), math.degrees(dec)] +
+                         [np.nan] * 5)
+
+    results = np.array(coor_list, dtype=float)
+    refs = results[:len(objects_matrix)]
+
+    return(results,
+           np.sqrt(np.mean(np.power(refs[:, 7], 2))),
+           np.sqrt(np.mean(np.power(refs[:, 8], 2))),
+           np.sqrt(np.mean(np.power(refs[:, 9], 2))))
+
+
+def test_plate_constants_match_scalar_baseline():
+
+    ac = AstCalc()
+    true_wcs = sip_wcs(1)
+    rs = np.random.RandomState(5)
+    x = rs.uniform(1, 2048, 60)
+    y = rs.uniform(1, 2048, 60)
+    ra, dec = true_wcs.all_pix2world(x, y, 1)
+    # measurement errors of 0.1 arcsec
+    ra = ra + rs.normal(0, 0.1 / 3600, len(ra))
+    dec = dec + rs.normal(0, 0.1 / 3600, len(dec))
+
+    objects = Table([np.arange(len(x)), x, y, ra, dec],
+                    names=('id', 'x', 'y', 'ra', 'dec'))
+    target_xy = [[100.0, 200.0], [1500.0, 1700.0]]
+    ra_center = math.radians(150.2)
+    dec_center = math.radians(32.55)
+
+    table, rms_ra, rms_dec, rms_delta = ac.plate_constants(
+        ra_center, dec_center, objects, target_xy)
+    expected, b_rms_ra, b_rms_dec, b_rms_delta = baseline_plate_constants(
+        ra_center, dec_center, objects, target_xy)
+
+    results = np.column_stack([table[col] for col in table.colnames])
+    np.testing.assert_array_equal(np.isnan(results), np.isnan(expected))
+
+    # positions to 1e-6 arcsec, residuals to 1e-6 of themselves
+    good = ~np.isnan(expected)
+    np.testing.assert_allclose(results[:, 5:7][good[:, 5:7]],
+                               expected[:, 5:7][good[:, 5:7]],
+                               rtol=0, atol=3e-10)
+    np.testing.assert_allclose(results[:, 7:10][good[:, 7:10]],
+                               expected[:, 7:10][good[:, 7:10]],
+                               rtol=1e-6, atol=1e-6)
+    assert rms_ra == pytest.approx(b_rms_ra, rel=1e-6)
+    assert rms_dec == pytest.approx(b_rms_dec, rel=1e-6)
+    assert rms_delta == pytest.approx(b_rms_delta, rel=1e-6)
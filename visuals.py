@@ -1,23 +1,32 @@
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
-from matplotlib.patches import FancyArrowPatch
-from matplotlib.patches import Ellipse
 from matplotlib.patches import Circle
+from matplotlib.collections import LineCollection
+from matplotlib.collections import EllipseCollection
+from matplotlib.collections import PathCollection
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import matplotlib.gridspec as gridspec
 
 from .astronomy import AstCalc
 from .astronomy import FitsOps
+from .lightcurve import GroupOps
+from .io import ResultSink
+from .photometry import EnsembleOps
 from astropy.io import fits
 from astropy.table import Table
-from astropy import table
 from astropy import coordinates
 from astropy import units as u
 from astropy.wcs import WCS
-from astropy.stats import sigma_clip, mad_std
-from astroquery.skyview import SkyView
+from astropy.wcs.utils import proj_plane_pixel_scales
+from astropy.visualization import ZScaleInterval
 
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import sep
+import glob
 import os
 
 
@@ -96,6 +105,96 @@ class StarPlot:
         plt.show()
         return True
 
+    def zscale(self, image_data, n_samples=1000):
+
+        """
+        Display limits of an image with zscale, estimated on a
+        subsample of its pixels.
+        @param image_data: Image data.
+        @type image_data: numpy array
+        @param n_samples: Number of sampled pixels.
+        @type n_samples: int
+        @return: tuple (vmin, vmax)
+        """
+
+        return(ZScaleInterval(n_samples=n_samples).get_limits(image_data))
+
+    def text_collection(self, ax, x, y, labels,
+                        size=12,
+                        color='black'):
+
+        """
+        Draws many centered text labels as one artist.
+        @param ax: Axes to be drawn.
+        @type ax: matplotlib.axes.Axes
+        @param x: X coordinates of labels (data units).
+        @type x: array
+        @param y: Y coordinates of labels (data units).
+        @type y: array
+        @param labels: Labels.
+        @type labels: list
+        @param size: Font size (in points).
+        @type size: float
+        @param color: Color of labels.
+        @type color: str
+        @return: matplotlib.collections.PathCollection
+        """
+
+        paths = []
+        for label in labels:
+            path = TextPath((0, 0), str(label), size=size)
+            extents = path.get_extents()
+            # centered on the position, as ha/va='center'
+            paths.append(path.transformed(Affine2D().translate(
+                -0.5 * (extents.x0 + extents.x1),
+                -0.5 * (extents.y0 + extents.y1))))
+
+        # glyphs are in points, positions in data units
+        texts = PathCollection(
+            paths,
+            offsets=np.column_stack((x, y)),
+            offset_transform=ax.transData,
+            transform=Affine2D().scale(1 / 72.) + ax.figure.dpi_scale_trans,
+            facecolors=color,
+            edgecolors='none')
+        ax.add_collection(texts, autolim=False)
+
+        return(texts)
+
+    def draw_stars(self, ax, image_data, objects, mark_color="red"):
+
+        """
+        Draws an image and the ellipses of its sources into an axes.
+        @param ax: Axes to be drawn.
+        @type ax: matplotlib.axes.Axes
+        @param image_data: data part of the FITS image
+        @type image_data: numpy array
+        @param objects: Return of the detect_sources.
+        @type objects: astropy.table
+        @param mark_color: Color of the plot marks
+        @type mark_color: str
+        @return: matplotlib.collections.EllipseCollection
+        """
+
+        vmin, vmax = self.zscale(image_data)
+        ax.imshow(image_data, interpolation='nearest',
+                  cmap='gray', vmin=vmin, vmax=vmax, origin='lower')
+
+        # all ellipses in one artist
+        objects = Table(objects)
+        ellipses = EllipseCollection(
+            6 * np.asarray(objects['a'], dtype=float),
+            6 * np.asarray(objects['b'], dtype=float),
+            np.degrees(np.asarray(objects['theta'], dtype=float)),
+            units='xy',
+            offsets=np.column_stack((objects['x'], objects['y'])),
+            offset_transform=ax.transData,
+            facecolors='none',
+            edgecolors=mark_color)
+        ax.add_collection(ellipses, autolim=False)
+
+        return(ellipses)
+
     def star_plot(self, image_data, objects, mark_color="red"):
 
         """
@@ -110,34 +209,17 @@ class StarPlot:
         @returns: boolean
         """
 
-        rcParams['figure.figsize'] = [15., 12.]
-
         # plot background-subtracted image
-        fig, ax = plt.subplots()
-
-        m, s = np.mean(image_data), np.std(image_data)
-        ax.imshow(image_data, interpolation='nearest',
-                  cmap='gray', vmin=m - s, vmax=m + s, origin='lower')
+        fig, ax = plt.subplots(figsize=[15., 12.])
 
         # plot an ellipse for each object
-
-        objects = Table(objects)
-
-        for i in range(len(objects)):
-            e = Ellipse(xy=(objects['x'][i], objects['y'][i]),
-                        width=6 * objects['a'][i],
-                        height=6 * objects['b'][i],
-                        angle=objects['theta'][i] * 180. / np.pi)
-
-            e.set_facecolor('none')
-            e.set_edgecolor(mark_color)
-            ax.add_artist(e)
+        self.draw_stars(ax, image_data, objects, mark_color=mark_color)
 
         plt.show()
 
         return True
 
-    def asteroids_plot(self,
+    def asteroids_data(self,
                        image_path=None,
                        ra=None,
                        dec=None,
@@ -145,37 +227,34 @@ class StarPlot:
                        time_travel=1,
                        radi=6,
                        max_mag=20.0,
-                       circle_color='yellow',
-                       arrow_color='red'):
+                       cache_dir=None):
 
         """
-        Source plot module.
-        @param image_path: data part of the FITS image
-        @type image_path: numpy array
+        Image and SkyBoT asteroids (now and after time_travel) of a
+        finder chart.
+        @param image_path: Path of FITS file. If None, the DSS image
+        of ra, dec is used.
+        @type image_path: path
         @param ra: RA coordinate of target area.
         @type ra: str in "HH MM SS"
         @param dec: DEC coordinate of target area
         @type dec: str in "+DD MM SS"
-        @param radi: Radius in arcmin.
-        @type radi: float
         @param odate: Ephemeris date of observation in date
         @type odate: "2017-08-15T19:50:00.95" format in str
         @param time_travel: Jump into time after given date (in hour).
         @type time_travel: float
+        @param radi: Radius in arcmin.
+        @type radi: float
         @param max_mag: Limit magnitude to be queried object(s)
         @type max_mag: float
-        @param circle_color: Color of the asteroids marks
-        @type circle_color: str
-        @param arrow_color: Color of the asteroids direction marks
-        @type arrow_color: str
-        @returns: boolean
+        @param cache_dir: DSS cutout cache directory. If None,
+        ~/.astrolib/cutouts is used.
+        @type cache_dir: path
+        @return: dict
         """
 
         from .catalog import Query
-
-        # filename = get_pkg_data_filename(image_path)
-        rcParams['figure.figsize'] = [15., 12.]
-        # rcParams.update({'font.size': 10})
+        from .catalog import CutoutCache
 
         if image_path:
             hdu = fits.open(image_path)[0]
@@ -186,38 +265,10 @@ class StarPlot:
             print('Target Coordinates:',
                   co.to_string(style='hmsdms', sep=':'),
                   'in {0} arcmin'.format(radi))
-            try:
-                server_img = SkyView.get_images(position=co,
-                                                survey=['DSS'],
-                                                radius=radi * u.arcmin)
-                hdu = server_img[0][0]
-            except Exception as e:
-                print("SkyView could not get the image from DSS server.")
-                print(e)
-                raise SystemExit
-
-        wcs = WCS(hdu.header)
-
-        data = hdu.data.astype(float)
-
-        bkg = sep.Background(data)
-        # bkg_image = bkg.back()
-        # bkg_rms = bkg.rms()
-        data_sub = data - bkg
-        m, s = np.mean(data_sub), np.std(data_sub)
-
-        ax = plt.subplot(projection=wcs)
-
-        plt.imshow(data_sub, interpolation='nearest',
-                   cmap='gray', vmin=m - s, vmax=m + s, origin='lower')
-        ax.coords.grid(True, color='white', ls='solid')
-        ax.coords[0].set_axislabel('Galactic Longitude')
-        ax.coords[1].set_axislabel('Galactic Latitude')
-
-        overlay = ax.get_coords_overlay('icrs')
-        overlay.grid(color='white', ls='dotted')
-        overlay[0].set_axislabel('Right Ascension (ICRS)')
-        overlay[1].set_axislabel('Declination (ICRS)')
+            hdu = CutoutCache(cache_dir).get(co, radi, survey='DSS')
+        else:
+            print("No image or target coordinates provided!")
+            raise SystemExit
 
         sb = Query()
         ac = AstCalc()
@@ -225,11 +276,8 @@ class StarPlot:
             fo = FitsOps(image_path)
             if not odate:
                 odate = fo.get_header('date-obs')
-            else:
-                odate = odate
             ra_dec = ac.center_finder(image_path, wcs_ref=True)
-        elif not image_path and ra and dec and odate:
-            odate = odate
+        else:
             ra_dec = [co.ra, co.dec]
 
         request0 = sb.find_skybot_objects(odate,
@@ -255,52 +303,184 @@ class StarPlot:
             print(request1[1])
             raise SystemExit
 
-        for i in range(len(asteroids)):
-            if float(asteroids['m_v'][i]) <= max_mag:
-                c = coordinates.SkyCoord('{0} {1}'.format(
-                    asteroids['ra(h)'][i],
-                    asteroids['dec(deg)'][i]),
-                    unit=(u.hourangle, u.deg),
-                    frame='icrs')
-
-                c_after = coordinates.SkyCoord('{0} {1}'.format(
-                    asteroids_after['ra(h)'][i],
-                    asteroids_after['dec(deg)'][i]),
-                    unit=(u.hourangle, u.deg),
-                    frame='icrs')
-
-                r = FancyArrowPatch(
-                    (c.ra.degree, c.dec.degree),
-                    (c_after.ra.degree, c_after.dec.degree),
-                    arrowstyle='->',
-                    mutation_scale=10,
-                    transform=ax.get_transform('icrs'))
-
-                p = Circle((c.ra.degree, c.dec.degree), 0.005,
-                           edgecolor=circle_color,
-                           facecolor='none',
-                           transform=ax.get_transform('icrs'))
-                ax.text(c.ra.degree,
-                        c.dec.degree - 0.007,
-                        asteroids['name'][i],
-                        size=12,
-                        color='black',
-                        ha='center',
-                        va='center',
-                        transform=ax.get_transform('icrs'))
-
-                r.set_facecolor('none')
-                r.set_edgecolor(arrow_color)
-                ax.add_patch(p)
-                ax.add_patch(r)
-        # plt.gca().invert_xaxis()
-        plt.gca().invert_yaxis()
+        bright = np.asarray(asteroids['m_v']).astype(float) <= max_mag
+
+        return({"header": hdu.header,
+                "data": hdu.data,
+                "asteroids": asteroids[bright],
+                "asteroids_after": asteroids_after[bright]})
+
+    def draw_asteroids(self, fig, chart,
+                       circle_color='yellow',
+                       arrow_color='red'):
+
+        """
+        Draws a finder chart into a figure.
+        @param fig: Figure to be drawn.
+        @type fig: matplotlib.figure.Figure
+        @param chart: Return of the asteroids_data.
+        @type chart: dict
+        @param circle_color: Color of the asteroids marks
+        @type circle_color: str
+        @param arrow_color: Color of the asteroids direction marks
+        @type arrow_color: str
+        @return: axes
+        """
+
+        wcs = WCS(chart['header']).celestial
+
+        data = chart['data'].astype(float)
+
+        bkg = sep.Background(data)
+        data_sub = data - bkg
+        vmin, vmax = self.zscale(data_sub)
+
+        ax = fig.add_subplot(projection=wcs)
+
+        ax.imshow(data_sub, interpolation='nearest',
+                  cmap='gray', vmin=vmin, vmax=vmax, origin='lower')
+        ax.coords.grid(True, color='white', ls='solid')
+        ax.coords[0].set_axislabel('Galactic Longitude')
+        ax.coords[1].set_axislabel('Galactic Latitude')
+
+        overlay = ax.get_coords_overlay('icrs')
+        overlay.grid(color='white', ls='dotted')
+        overlay[0].set_axislabel('Right Ascension (ICRS)')
+        overlay[1].set_axislabel('Declination (ICRS)')
+
+        asteroids = chart['asteroids']
+        asteroids_after = chart['asteroids_after']
+
+        if len(asteroids) > 0:
+            # all asteroids in one call, marks drawn in pixels
+            c = coordinates.SkyCoord(asteroids['ra(h)'],
+                                     asteroids['dec(deg)'],
+                                     unit=(u.hourangle, u.deg),
+                                     frame='icrs')
+            c_after = coordinates.SkyCoord(asteroids_after['ra(h)'],
+                                           asteroids_after['dec(deg)'],
+                                           unit=(u.hourangle, u.deg),
+                                           frame='icrs')
+
+            x, y = wcs.all_world2pix(c.ra.degree, c.dec.degree, 0)
+            x_after, y_after = wcs.all_world2pix(c_after.ra.degree,
+                                                 c_after.dec.degree, 0)
+            x_text, y_text = wcs.all_world2pix(c.ra.degree,
+                                               c.dec.degree - 0.007, 0)
+
+            # 0.005 degree circles
+            scales = proj_plane_pixel_scales(wcs)
+            n = len(asteroids)
+            circles = EllipseCollection(
+                np.repeat(2 * 0.005 / scales[0], n),
+                np.repeat(2 * 0.005 / scales[1], n),
+                np.zeros(n),
+                units='xy',
+                offsets=np.column_stack((x, y)),
+                offset_transform=ax.transData,
+                facecolors='none',
+                edgecolors=circle_color)
+            ax.add_collection(circles, autolim=False)
+
+            ax.quiver(x, y, x_after - x, y_after - y,
+                      angles='xy',
+                      scale_units='xy',
+                      scale=1,
+                      color=arrow_color,
+                      width=0.002,
+                      headwidth=4,
+                      headlength=5)
+
+            self.text_collection(ax, x_text, y_text, asteroids['name'],
+                                 size=12, color='black')
+
+        ax.invert_yaxis()
+
+        return(ax)
+
+    def asteroids_plot(self,
+                       image_path=None,
+                       ra=None,
+                       dec=None,
+                       odate=None,
+                       time_travel=1,
+                       radi=6,
+                       max_mag=20.0,
+                       circle_color='yellow',
+                       arrow_color='red',
+                       cache_dir=None):
+
+        """
+        Source plot module.
+        @param image_path: data part of the FITS image
+        @type image_path: numpy array
+        @param ra: RA coordinate of target area.
+        @type ra: str in "HH MM SS"
+        @param dec: DEC coordinate of target area
+        @type dec: str in "+DD MM SS"
+        @param radi: Radius in arcmin.
+        @type radi: float
+        @param odate: Ephemeris date of observation in date
+        @type odate: "2017-08-15T19:50:00.95" format in str
+        @param time_travel: Jump into time after given date (in hour).
+        @type time_travel: float
+        @param max_mag: Limit magnitude to be queried object(s)
+        @type max_mag: float
+        @param circle_color: Color of the asteroids marks
+        @type circle_color: str
+        @param arrow_color: Color of the asteroids direction marks
+        @type arrow_color: str
+        @param cache_dir: DSS cutout cache directory. If None,
+        ~/.astrolib/cutouts is used.
+        @type cache_dir: path
+        @returns: boolean
+        """
+
+        chart = self.asteroids_data(image_path=image_path,
+                                    ra=ra,
+                                    dec=dec,
+                                    odate=odate,
+                                    time_travel=time_travel,
+                                    radi=radi,
+                                    max_mag=max_mag,
+                                    cache_dir=cache_dir)
+
+        fig = plt.figure(figsize=[15., 12.])
+        self.draw_asteroids(fig, chart,
+                            circle_color=circle_color,
+                            arrow_color=arrow_color)
         plt.show()
-        print(asteroids)
+
         return True
 
-    def lc_plot_general(self,
-                        result_file_path=None,
+    def read_result(self, result_file_path):
+
+        """
+        Reads photometry result file of an asteroid. Columnar results
+        (<ast_num>.npz) are memory-mapped, others are read as ASCII tables.
+        @param result_file_path: Result file path
+        @type result_file_path: path
+        @return: astropy.table
+        """
+
+        if result_file_path.endswith('.npz'):
+            return(ResultSink().read_file(result_file_path))
+
+        return(Table.read(result_file_path,
+                          format='ascii.commented_header'))
+
+    def result_name(self, result_file_path):
+
+        """
+        Name of a result file, used in titles and output files.
+        @param result_file_path: Result file path
+        @type result_file_path: path
+        @return: str
+        """
+
+        return(os.path.basename(result_file_path).split('.')[0])
+
+    def draw_lc_general(self, fig, result_file, title,
                         xcol='jd',
                         ycol='magt_i',
                         errcol='magt_i_err',
@@ -308,9 +488,13 @@ class StarPlot:
                         bar_color="red"):
 
         """
-        Plot light curve of photometry result.
-        @param result_file_path: Result file path
-        @type result_file_path: path
+        Draws the light curve of photometry result into a figure.
+        @param fig: Figure to be drawn.
+        @type fig: matplotlib.figure.Figure
+        @param result_file: Photometry results of an asteroid.
+        @type result_file: astropy.table
+        @param title: Title of the plot.
+        @type title: str
         @param xcol: X-axis data for plotting
         @type xcol: array
         @param ycol: Y-axis data for plotting
@@ -321,35 +505,29 @@ class StarPlot:
         @type mark_color: str
         @param bar_color: Bar marker color
         @type bar_color: str
-        @return: str
+        @return: list of axes
         """
 
-        print("Plotting asteroid's LC...")
-
-        fn = os.path.basename(result_file_path).split('.')[0]
-
-        result_file = Table.read(result_file_path,
-                                 format='ascii.commented_header')
+        # first row of every frame
+        frames = GroupOps(np.asarray(result_file['jd']))
+        rows = frames.order[frames.starts]
+        x = np.asarray(result_file[xcol], dtype=float)[rows]
+        y = np.asarray(result_file[ycol], dtype=float)[rows]
+        err = np.asarray(result_file[errcol], dtype=float)[rows]
 
-        result_unique_by_keys = table.unique(result_file, keys='jd')
-
-        rcParams['figure.figsize'] = [10., 8.]
-        figlc = plt.figure(1)
-        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2])
+        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2], figure=fig)
 
         # Two subplots, the axes array is 1-d
-        axlc1 = figlc.add_subplot(gs[0])
-        axlc2 = figlc.add_subplot(gs[1])
-        axlc1.set_title(fn)
+        axlc1 = fig.add_subplot(gs[0])
+        axlc2 = fig.add_subplot(gs[1])
+        axlc1.set_title(title)
 
-        filtered_data = sigma_clip(result_unique_by_keys[ycol], sigma=3,
-                                   iters=10, stdfunc=mad_std)
+        keep = GroupOps(np.zeros(len(y))).sigma_clip(y, sigma=3, iters=10)
 
         axlc1.errorbar(
-            result_unique_by_keys[xcol][np.logical_not(filtered_data.mask)],
-            result_unique_by_keys[ycol][np.logical_not(filtered_data.mask)],
-            yerr=result_unique_by_keys[errcol][np.logical_not(
-                filtered_data.mask)],
+            x[keep],
+            y[keep],
+            yerr=err[keep],
             fmt='o',
             ecolor=bar_color,
             color=mark_color,
@@ -361,239 +539,405 @@ class StarPlot:
         axlc1.set_ylabel("Magnitude (R - INST)", fontsize=12)
         axlc2.set_ylabel("STD", fontsize=12)
 
-        fit = np.polyfit(
-            result_unique_by_keys[xcol][np.logical_not(filtered_data.mask)],
-            result_unique_by_keys[errcol][np.logical_not(filtered_data.mask)],
-            1)
-        fit_fn = np.poly1d(fit)
+        fit_fn = np.poly1d(np.polyfit(x[keep], err[keep], 1))
         axlc2.plot(
-            result_unique_by_keys[xcol][np.logical_not(filtered_data.mask)],
-            result_unique_by_keys[errcol][np.logical_not(filtered_data.mask)],
+            x[keep],
+            err[keep],
             'yo',
-            result_unique_by_keys[xcol][np.logical_not(filtered_data.mask)],
-            fit_fn(result_unique_by_keys[xcol][np.logical_not(
-                filtered_data.mask)]),
+            x[keep],
+            fit_fn(x[keep]),
             '--k')
 
         axlc1.grid(True)
         axlc2.grid(True)
-        axlc1.legend(loc=2, numpoints=1)
 
-        figlc.savefig("{0}/{1}_jd_vs_magi_lc.pdf".format(os.getcwd(), fn))
-        # plt.show()
+        return([axlc1, axlc2])
 
-    def lc_plot_std_mag(self, result_file_path=None,
-                        xcol='magc_i',
-                        ycol='star_Rmag',
-                        errcol='magc_i_err',
+    def lc_plot_general(self,
+                        result_file_path=None,
+                        xcol='jd',
+                        ycol='magt_i',
+                        errcol='magt_i_err',
                         mark_color="blue",
                         bar_color="red"):
 
+        """
+        Plot light curve of photometry result.
+        @param result_file_path: Result file path
+        @type result_file_path: path
+        @param xcol: X-axis data for plotting
+        @type xcol: array
+        @param ycol: Y-axis data for plotting
+        @type ycol: array
+        @param errcol: Error bar data for plotting
+        @type errcol: array
+        @param mark_color: Marker color
+        @type mark_color: str
+        @param bar_color: Bar marker color
+        @type bar_color: str
+        @return: str
+        """
+
         print("Plotting asteroid's LC...")
 
-        # Fixing random state for reproducibility
-        np.random.seed(19680801)
+        fn = self.result_name(result_file_path)
 
-        fn = os.path.basename(result_file_path).split('.')[0]
+        result_file = self.read_result(result_file_path)
 
-        # Two subplots, the axes array is 1-d
-        # Plotting settings
-        rcParams['figure.figsize'] = [10., 8.]
+        figlc = plt.figure(figsize=[10., 8.])
+        self.draw_lc_general(figlc, result_file, fn,
+                             xcol=xcol,
+                             ycol=ycol,
+                             errcol=errcol,
+                             mark_color=mark_color,
+                             bar_color=bar_color)
+
+        figlc.savefig("{0}/{1}_jd_vs_magi_lc.pdf".format(os.getcwd(), fn))
+        # plt.show()
+
+    def std_mag_curve(self, result_file,
+                      xcol='magc_i',
+                      ycol='star_Rmag',
+                      errcol='magc_i_err'):
 
-        lc = plt.figure(1)
-        lc_ast_std = plt.figure()
-        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2])
+        """
+        Standard magnitudes of an asteroid from the comparison stars of
+        every frame. Outliers of every frame are sigma clipped, then the
+        catalogue magnitudes and errors of the comparison stars are
+        fitted against their instrumental magnitudes. All frames are
+        computed at once.
+        @param result_file: Photometry results of an asteroid.
+        @type result_file: astropy.table
+        @param xcol: Instrumental magnitude column.
+        @type xcol: str
+        @param ycol: Catalogue magnitude column.
+        @type ycol: str
+        @param errcol: Instrumental magnitude error column.
+        @type errcol: str
+        @return: dict
+        """
+
+        frames = GroupOps(np.asarray(result_file['jd']))
+
+        x = np.asarray(result_file[xcol], dtype=float)
+        magt_i = np.asarray(result_file['magt_i'], dtype=float)
+
+        # for reject outliers
+        keep = frames.sigma_clip(magt_i, sigma=3, iters=10)
+
+        # magci vs catalogue and magci vs error fits
+        cat_fit = frames.polyfit(x, result_file[ycol], 1, mask=keep)
+        err_fit = frames.polyfit(x, result_file[errcol], 1, mask=keep)
+
+        # asteroid's magnitude at the first not rejected row of a frame
+        n_rows = len(x)
+        sorted_rows = np.where(keep[frames.order],
+                               np.arange(n_rows), n_rows)
+        first_kept = np.minimum.reduceat(sorted_rows, frames.starts)
+        has_rows = first_kept < n_rows
+
+        magt_std = np.full(frames.n_groups, np.nan)
+        rows = frames.order[first_kept[has_rows]]
+        magt_std[has_rows] = (cat_fit[has_rows, 0] * magt_i[rows] +
+                              cat_fit[has_rows, 1])
+
+        jd = frames.keys[has_rows]
+        magt_std = magt_std[has_rows]
+        magt_err = frames.first(result_file['magt_i_err'])[has_rows]
+
+        curve_keep = GroupOps(np.zeros(len(jd))).sigma_clip(magt_std,
+                                                            sigma=3,
+                                                            iters=10)
+
+        return({"frames": frames,
+                "keep": keep,
+                "cat_fit": cat_fit,
+                "err_fit": err_fit,
+                "jd": jd,
+                "magt_std": magt_std,
+                "magt_err": magt_err,
+                "curve_keep": curve_keep})
+
+    def fit_segments(self, frames, fit, x, keep):
+
+        """
+        Line segments of the fits of every group over the range
+        of its not rejected rows.
+        @param frames: Groups of the rows.
+        @type frames: lightcurve.GroupOps
+        @param fit: Return of the GroupOps.polyfit (degree 1).
+        @type fit: numpy array
+        @param x: X values of the rows.
+        @type x: array
+        @param keep: True for not rejected rows.
+        @type keep: array
+        @return: numpy array ([group, point, xy])
+        """
+
+        x_sorted = np.asarray(x, dtype=float)[frames.order]
+        keep_sorted = keep[frames.order]
+
+        x_min = np.minimum.reduceat(np.where(keep_sorted, x_sorted, np.inf),
+                                    frames.starts)
+        x_max = np.maximum.reduceat(np.where(keep_sorted, x_sorted, -np.inf),
+                                    frames.starts)
+        good = np.isfinite(x_min) & np.isfinite(fit[:, 0])
+
+        ends = np.stack((x_min[good], x_max[good]), axis=1)
+        values = fit[good, 0:1] * ends + fit[good, 1:2]
+
+        return(np.stack((ends, values), axis=2))
+
+    def draw_std_mag_fits(self, fig, curve, result_file, title,
+                          xcol='magc_i',
+                          ycol='star_Rmag',
+                          errcol='magc_i_err',
+                          mark_color="blue",
+                          bar_color="red"):
+
+        """
+        Draws the comparison star fits of every frame into a figure.
+        @param fig: Figure to be drawn.
+        @type fig: matplotlib.figure.Figure
+        @param curve: Return of the std_mag_curve.
+        @type curve: dict
+        @param result_file: Photometry results of an asteroid.
+        @type result_file: astropy.table
+        @param title: Title of the plot.
+        @type title: str
+        @return: list of axes
+        """
+
+        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2], figure=fig)
 
         # magi vs catalogue
-        lc1 = lc.add_subplot(gs[0])
-        lc1.set_title(fn)
+        lc1 = fig.add_subplot(gs[0])
+        lc1.set_title(title)
         lc1.grid(True)
         lc1.set_ylabel("Magnitude (R - NOMAD1)", fontsize=12)
         lc1.invert_yaxis()
 
         # magi vs STD
-        lc2 = lc.add_subplot(gs[1])
-        lc2.set_title(fn)
+        lc2 = fig.add_subplot(gs[1])
+        lc2.set_title(title)
         lc2.grid(True)
         lc2.set_xlabel("Magnitude (Inst)", fontsize=12)
         lc2.set_ylabel("$STD$", fontsize=12)
 
+        keep = curve['keep']
+
+        # magci vs catalogue with error bar
+        lc1.errorbar(
+            np.asarray(result_file[xcol])[keep],
+            np.asarray(result_file[ycol])[keep],
+            yerr=np.asarray(result_file[errcol])[keep],
+            fmt='o',
+            ecolor=bar_color,
+            color=mark_color,
+            capsize=5,
+            elinewidth=2)
+
+        # magci vs catalogue fit plot
+        lc1.add_collection(LineCollection(
+            self.fit_segments(curve['frames'], curve['cat_fit'],
+                              result_file[xcol], keep),
+            colors='k', linestyles='--'))
+
+        # magi vs STD fit plot
+        lc2.plot(
+            np.asarray(result_file[xcol])[keep],
+            np.asarray(result_file[errcol])[keep],
+            'yo')
+        lc2.add_collection(LineCollection(
+            self.fit_segments(curve['frames'], curve['err_fit'],
+                              result_file[xcol], keep),
+            colors='k', linestyles='--'))
+
+        return([lc1, lc2])
+
+    def draw_std_mag_curve(self, fig, curve, title,
+                           mark_color="blue",
+                           bar_color="red"):
+
+        """
+        Draws the standard magnitude light curve into a figure.
+        @param fig: Figure to be drawn.
+        @type fig: matplotlib.figure.Figure
+        @param curve: Return of the std_mag_curve.
+        @type curve: dict
+        @param title: Title of the plot.
+        @type title: str
+        @return: axes
+        """
+
+        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2], figure=fig)
+
         # magt vs estimated mag
-        lc3 = lc_ast_std.add_subplot(gs[0])
-        lc3.set_title(fn)
-        lc3.legend(loc=2, numpoints=1)
+        lc3 = fig.add_subplot(gs[0])
+        lc3.set_title(title)
         lc3.grid(True)
         lc3.invert_yaxis()
         lc3.set_xlabel("$JD$", fontsize=12)
         lc3.set_ylabel("Magnitude (R - Estimated from NOMAD1)",
                        fontsize=12)
-        # Plotting settings
 
-        result_file = Table.read(result_file_path,
-                                 format='ascii.commented_header')
-
-        # result_unique_by_keys = table.unique(result_file, keys='nomad1')
-        result_unique_by_jd = table.unique(result_file, keys='jd')
-
-        magt_std_list = []
-        for jd in result_unique_by_jd['jd']:
-            frame_results = result_file[(result_file['jd'] == jd)]
-
-            # for reject outliers
-            filtered_frame_results = sigma_clip(frame_results['magt_i'],
-                                                sigma=3,
-                                                iters=10, stdfunc=mad_std)
-
-            # use only not rejected data (because umask used)
-            filtered_f_umask = np.logical_not(filtered_frame_results.mask)
-
-            # magci vs catalogue with error bar
-            lc1.errorbar(
-                frame_results[xcol][filtered_f_umask],
-                frame_results[ycol][filtered_f_umask],
-                yerr=frame_results[errcol][filtered_f_umask],
-                fmt='o',
-                ecolor=bar_color,
-                color=mark_color,
-                capsize=5,
-                elinewidth=2)
-
-            # magci vs catalogue fit calculation
-            fit = np.polyfit(
-                frame_results[xcol][filtered_f_umask],
-                frame_results[ycol][filtered_f_umask],
-                1)
-
-            fit_fn = np.poly1d(fit)
-
-            magt_to_std = fit_fn(frame_results['magt_i'][filtered_f_umask])
-            magt_std_list.append([jd, magt_to_std[0], frame_results['magt_i_err'][0]])
-
-            # magci vs catalogue fit plot
-            lc1.plot(
-                frame_results[xcol][filtered_f_umask],
-                fit_fn(frame_results[xcol][filtered_f_umask]),
-                '--k')
-
-            # magi vs catalogue error fit calc.
-            fit = np.polyfit(
-                frame_results[xcol][filtered_f_umask],
-                frame_results[errcol][filtered_f_umask],
-                1)
-            fit_fn = np.poly1d(fit)
-
-            # magi vs STD fit plot
-            lc2.plot(
-                frame_results[xcol][filtered_f_umask],
-                frame_results[errcol][filtered_f_umask],
-                'yo',
-                frame_results[xcol][filtered_f_umask],
-                fit_fn(frame_results[xcol][filtered_f_umask]),
-                '--k')
-
-        # jd vs magt_std
-        jd_vs_magt = np.asanyarray(magt_std_list)
-        filtered_jd_vs_magt = sigma_clip(jd_vs_magt[:, 1],
-                                         sigma=3,
-                                         iters=10, stdfunc=mad_std)
-        # use only not rejected data (because umask used)
-        filtered_f_umask = np.logical_not(filtered_jd_vs_magt.mask)
+        # use only not rejected data
+        curve_keep = curve['curve_keep']
 
         # jd vs magt plotting with error bars
         lc3.errorbar(
-            jd_vs_magt[:, 0][filtered_f_umask],
-            jd_vs_magt[:, 1][filtered_f_umask],
-            yerr=jd_vs_magt[:, 2][filtered_f_umask],
+            curve['jd'][curve_keep],
+            curve['magt_std'][curve_keep],
+            yerr=curve['magt_err'][curve_keep],
             fmt='o',
             ecolor=bar_color,
             color=mark_color,
             capsize=5,
             elinewidth=2,
-            label='{0} - R (Estimated)'.format(fn))
+            label='{0} - R (Estimated)'.format(title))
 
         lc3.legend(loc=2, numpoints=1)
+
+        return(lc3)
+
+    def lc_plot_std_mag(self, result_file_path=None,
+                        xcol='magc_i',
+                        ycol='star_Rmag',
+                        errcol='magc_i_err',
+                        mark_color="blue",
+                        bar_color="red"):
+
+        print("Plotting asteroid's LC...")
+
+        fn = self.result_name(result_file_path)
+
+        result_file = self.read_result(result_file_path)
+
+        # all frames are aggregated before plotting
+        curve = self.std_mag_curve(result_file,
+                                   xcol=xcol,
+                                   ycol=ycol,
+                                   errcol=errcol)
+
+        lc = plt.figure(figsize=[10., 8.])
+        self.draw_std_mag_fits(lc, curve, result_file, fn,
+                               xcol=xcol,
+                               ycol=ycol,
+                               errcol=errcol,
+                               mark_color=mark_color,
+                               bar_color=bar_color)
+
+        lc_ast_std = plt.figure(figsize=[10., 8.])
+        self.draw_std_mag_curve(lc_ast_std, curve, fn,
+                                mark_color=mark_color,
+                                bar_color=bar_color)
+
         lc_ast_std.savefig("{0}/{1}_jd_vs_mag_std_lc.pdf".format(os.getcwd(), fn))
 
         # plt.show()
 
-    def find_best_comp(self, result_file_path=None,
-                       best_comparison_star=None):
+    def comp_stats(self, result_file, best_comparison_star=None):
 
-        result_file = Table.read(result_file_path,
-                                 format='ascii.commented_header')
+        """
+        Differential magnitudes of an asteroid with the comparison stars
+        whose differential light curves have the minimum, mean and
+        maximum standard deviation, and against the ensemble of all
+        comparison stars (EnsembleOps). All stars are computed at once.
+        @param result_file: Photometry results of an asteroid.
+        @type result_file: astropy.table
+        @param best_comparison_star: Use only this NOMAD1 star.
+        @type best_comparison_star: str
+        @return: dict
+        """
 
-        # read comparison star list
         # and check manual assigned comp star
-        if best_comparison_star is None:
-            result_unique_by_cat = table.unique(result_file, keys='nomad1')
-        else:
-            result_unique_by_cat = table.unique(
-                result_file[(result_file['nomad1'] == best_comparison_star)],
-                                                keys='nomad1')
-
-        std_list = []
-        t_c_list = []
-        # calculates diff_mag for all target objects and comp. stars
-        for star in result_unique_by_cat['nomad1']:
-            frame_results = result_file[(result_file['nomad1'] == star)]
-
-            # diff phot.
-            frame_results['t-c'] = frame_results['magt_i'] - frame_results['magc_i']
-            # error propagation
-            frame_results['t-c-err'] = np.sqrt(
-                np.power(frame_results['magt_i_err'], 2) + np.power(frame_results['magc_i_err'], 2))
-
-            # extracting usefull columns
-            t_c_list.append(frame_results['ast_num', 'nomad1', 'jd', 't-c', 't-c-err'])
-
-            # calculating all t-c stars STD then adding list
-            std_list.append(np.std(frame_results['t-c']))
+        if best_comparison_star is not None:
+            result_file = result_file[
+                (result_file['nomad1'] == best_comparison_star)]
+
+        # diff phot. of all target objects and comp. stars
+        t_c = Table(result_file['ast_num', 'nomad1', 'jd'])
+        t_c['t-c'] = (np.asarray(result_file['magt_i']) -
+                      np.asarray(result_file['magc_i']))
+        # error propagation
+        t_c['t-c-err'] = np.sqrt(
+            np.power(result_file['magt_i_err'], 2) +
+            np.power(result_file['magc_i_err'], 2))
+
+        # all t-c stars STD at once
+        stars = GroupOps(np.asarray(result_file['nomad1']))
+        std_list = stars.std(t_c['t-c'])
+
         # calculating all STD's mean and its index number in the list
-        mean_idx = (np.abs(np.asanyarray(std_list) - np.mean(std_list))).argmin()
+        mean_idx = (np.abs(std_list - np.mean(std_list))).argmin()
 
         # choosing STD with min, mean and max stars
-        diff_stats = {'min': [std_list.index(min(std_list)), min(std_list)],
+        diff_stats = {'min': [std_list.argmin(), std_list.min()],
                       'mean': [mean_idx, np.mean(std_list)],
-                      'max': [std_list.index(max(std_list)), max(std_list)]
+                      'max': [std_list.argmax(), std_list.max()]
                       }
         # getting these diff mags and their other columns
-        results = {'with_min_comp': t_c_list[diff_stats['min'][0]],
-                   'with_mean_comp': t_c_list[diff_stats['mean'][0]],
-                   'with_max_comp': t_c_list[diff_stats['max'][0]]
+        results = {'with_min_comp': t_c[stars.rows(diff_stats['min'][0])],
+                   'with_mean_comp': t_c[stars.rows(diff_stats['mean'][0])],
+                   'with_max_comp': t_c[stars.rows(diff_stats['max'][0])]
                    }
 
+        # zero points of all comparison stars solved together
+        ensemble = EnsembleOps().solve(result_file)['light_curves']
+        results['ensemble'] = Table([ensemble['ast_num'],
+                                     np.repeat('ensemble', len(ensemble)),
+                                     ensemble['jd'],
+                                     ensemble['mag'],
+                                     ensemble['mag_err']],
+                                    names=('ast_num', 'nomad1', 'jd',
+                                           't-c', 't-c-err'))
+
         return results
 
-    def lc_plot_diff_mag(self, result_file_path=None,
-                         best_comparison_star=None,
-                         mark_color="blue",
-                         bar_color="red"):
+    def find_best_comp(self, result_file_path=None,
+                       best_comparison_star=None):
 
-        print("Plotting asteroid's LC...")
+        """
+        Differential magnitudes of an asteroid with the comparison stars
+        whose differential light curves have the minimum, mean and
+        maximum standard deviation.
+        @param result_file_path: Result file path
+        @type result_file_path: path
+        @param best_comparison_star: Use only this NOMAD1 star.
+        @type best_comparison_star: str
+        @return: dict
+        """
 
-        fn = os.path.basename(result_file_path).split('.')[0]
+        result_file = self.read_result(result_file_path)
 
-        # Two subplots, the axes array is 1-d
-        # Plotting settings
-        rcParams['figure.figsize'] = [10., 8.]
+        return(self.comp_stats(result_file,
+                               best_comparison_star=best_comparison_star))
 
-        lc_ast_diff = plt.figure()
-        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2])
+    def draw_lc_diff_mag(self, fig, results, title,
+                         mark_color="blue",
+                         bar_color="red"):
 
-        results = self.find_best_comp(result_file_path=result_file_path,
-                                      best_comparison_star=best_comparison_star)['with_mean_comp']
+        """
+        Draws a differential light curve into a figure.
+        @param fig: Figure to be drawn.
+        @type fig: matplotlib.figure.Figure
+        @param results: A table of the comp_stats.
+        @type results: astropy.table
+        @param title: Title of the plot.
+        @type title: str
+        @return: axes
+        """
 
-        filtered_jd_vs_mag_diff = sigma_clip(results['t-c'],
-                                         sigma=3,
-                                         iters=10, stdfunc=mad_std)
+        gs = gridspec.GridSpec(2, 1, height_ratios=[6, 2], figure=fig)
 
-        # use only not rejected data (because umask used)
-        filtered_diff_umask = np.logical_not(filtered_jd_vs_mag_diff.mask)
+        # use only not rejected data
+        keep = GroupOps(np.zeros(len(results))).sigma_clip(results['t-c'],
+                                                          sigma=3,
+                                                          iters=10)
 
         # jd vs magt - magi
-        lc = lc_ast_diff.add_subplot(gs[0])
-        lc.set_title(fn)
-        lc.legend(loc=2, numpoints=1)
+        lc = fig.add_subplot(gs[0])
+        lc.set_title(title)
         lc.grid(True)
         lc.invert_yaxis()
         lc.set_xlabel("$JD$", fontsize=12)
@@ -604,17 +948,185 @@ class StarPlot:
         # Plotting settings
 
         lc.errorbar(
-            results['jd'][filtered_diff_umask],
-            results['t-c'][filtered_diff_umask],
-            yerr=results['t-c-err'][filtered_diff_umask],
+            np.asarray(results['jd'])[keep],
+            np.asarray(results['t-c'])[keep],
+            yerr=np.asarray(results['t-c-err'])[keep],
             fmt='o',
             ecolor=bar_color,
             color=mark_color,
             capsize=5,
             elinewidth=2,
-            label='{0} - {1}'.format(fn, results['nomad1'][0]))
+            label='{0} - {1}'.format(title, results['nomad1'][0]))
 
         lc.legend(loc=2, numpoints=1)
+
+        return(lc)
+
+    def lc_plot_diff_mag(self, result_file_path=None,
+                         best_comparison_star=None,
+                         mark_color="blue",
+                         bar_color="red"):
+
+        print("Plotting asteroid's LC...")
+
+        fn = self.result_name(result_file_path)
+
+        results = self.find_best_comp(result_file_path=result_file_path,
+                                      best_comparison_star=best_comparison_star)['with_mean_comp']
+
+        lc_ast_diff = plt.figure(figsize=[10., 8.])
+        self.draw_lc_diff_mag(lc_ast_diff, results, fn,
+                              mark_color=mark_color,
+                              bar_color=bar_color)
+
         lc_ast_diff.savefig("{0}/{1}_jd_vs_diff_mag_lc.pdf".format(os.getcwd(), fn))
 
         # plt.show()
+
+    def render(self, kind, out_file, **kwargs):
+
+        """
+        Renders a plot to a file with its own Agg figure, without
+        pyplot. Nothing is shared with other plots.
+        @param kind: "lc_general", "std_mag", "std_mag_fits",
+        "diff_mag", "ensemble_mag" or "asteroids".
+        @type kind: str
+        @param out_file: Output file, its extension sets the format
+        (e.g. png, pdf).
+        @type out_file: path
+        @param kwargs: Arguments of the plot. lc_general, std_mag,
+        std_mag_fits, diff_mag and ensemble_mag take result_file_path,
+        asteroids takes the arguments of the asteroids_data; colors and
+        columns of the plots may be given as well.
+        @type kwargs: dict
+        @return: path
+        """
+
+        colors = {key: kwargs.pop(key) for key in
+                  ('mark_color', 'bar_color', 'circle_color', 'arrow_color')
+                  if key in kwargs}
+        columns = {key: kwargs.pop(key) for key in ('xcol', 'ycol', 'errcol')
+                   if key in kwargs}
+
+        if kind == "asteroids":
+            fig = Figure(figsize=(15., 12.))
+            FigureCanvasAgg(fig)
+            self.draw_asteroids(fig, self.asteroids_data(**kwargs), **colors)
+        else:
+            result_file_path = kwargs.pop('result_file_path')
+            result_file = self.read_result(result_file_path)
+            fn = self.result_name(result_file_path)
+
+            fig = Figure(figsize=(10., 8.))
+            FigureCanvasAgg(fig)
+
+            if kind == "lc_general":
+                self.draw_lc_general(fig, result_file, fn,
+                                     **dict(colors, **columns))
+            elif kind in ("std_mag", "std_mag_fits"):
+                curve = self.std_mag_curve(result_file, **columns)
+                if kind == "std_mag":
+                    self.draw_std_mag_curve(fig, curve, fn, **colors)
+                else:
+                    self.draw_std_mag_fits(fig, curve, result_file, fn,
+                                           **dict(colors, **columns))
+            elif kind in ("diff_mag", "ensemble_mag"):
+                results = self.comp_stats(result_file, **kwargs)
+                self.draw_lc_diff_mag(fig, results[
+                    'with_mean_comp' if kind == "diff_mag" else 'ensemble'],
+                    fn, **colors)
+            else:
+                print("Unknown plot kind: {0}".format(kind))
+                raise SystemExit
+
+        fig.savefig(out_file)
+
+        return(out_file)
+
+    def render_batch(self, jobs, n_jobs=None):
+
+        """
+        Renders many plots across a process pool.
+        @param jobs: Plots, dicts of the render arguments
+        (kind, out_file, ...).
+        @type jobs: list
+        @param n_jobs: Number of processes. 1 renders in this process,
+        None uses all CPUs.
+        @type n_jobs: int
+        @return: list of rendered files (None for failed plots)
+        """
+
+        if n_jobs == 1:
+            return([render_plot(job) for job in jobs])
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return(list(executor.map(render_plot, jobs)))
+
+    def report(self, result_dir=None,
+               out_dir=None,
+               kinds=("lc_general", "std_mag", "diff_mag", "ensemble_mag"),
+               fmt="png",
+               n_jobs=None):
+
+        """
+        Renders the light curves of all asteroids of a results directory.
+        @param result_dir: Directory of <ast_num>.npz (or .txt) results.
+        If None, cwd is used.
+        @type result_dir: path
+        @param out_dir: Output directory. If None, result_dir is used.
+        @type out_dir: path
+        @param kinds: Plots of every asteroid.
+        @type kinds: tuple
+        @param fmt: Output format (png, pdf, ...).
+        @type fmt: str
+        @param n_jobs: Number of processes. None uses all CPUs.
+        @type n_jobs: int
+        @return: list of rendered files
+        """
+
+        if result_dir is None:
+            result_dir = os.getcwd()
+
+        if out_dir is None:
+            out_dir = result_dir
+
+        npz_files = sorted(glob.glob(os.path.join(result_dir, '*.npz')))
+        roots = set(os.path.splitext(f)[0] for f in npz_files)
+        txt_files = [f for f in
+                     sorted(glob.glob(os.path.join(result_dir, '*.txt')))
+                     if os.path.splitext(f)[0] not in roots]
+
+        suffixes = {"lc_general": "jd_vs_magi_lc",
+                    "std_mag": "jd_vs_mag_std_lc",
+                    "std_mag_fits": "magi_vs_cat_fits",
+                    "diff_mag": "jd_vs_diff_mag_lc",
+                    "ensemble_mag": "jd_vs_ensemble_mag_lc"}
+
+        jobs = []
+        for result_file_path in npz_files + txt_files:
+            fn = self.result_name(result_file_path)
+            for kind in kinds:
+                jobs.append({"kind": kind,
+                             "result_file_path": result_file_path,
+                             "out_file": os.path.join(
+                                 out_dir, "{0}_{1}.{2}".format(
+                                     fn, suffixes[kind], fmt))})
+
+        return(self.render_batch(jobs, n_jobs=n_jobs))
+
+
+def render_plot(job):
+
+    """
+    Renders a plot job of the StarPlot.render_batch, a failed plot
+    does not stop the batch.
+    @param job: Arguments of the StarPlot.render.
+    @type job: dict
+    @return: path or None
+    """
+
+    try:
+        return(StarPlot().render(**dict(job)))
+    except (Exception, SystemExit) as e:
+        print("{0} could not be rendered: {1}".format(job.get('out_file'), e))
+        return(None)